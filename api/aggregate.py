@@ -0,0 +1,342 @@
+import re
+import datetime
+
+import numpy as np
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import INTERVAL
+
+from models.base import SmartSession
+from models.reports import Report, REPORT_STATUSES
+from models.detections import Detection, OBJECT_TYPES
+
+from api.query import reports_statement, detections_statement, known_values
+from api.rollups import ROLLUP_TABLES
+
+# buckets that are whole calendar units, computed with date_trunc()
+TRUNCATE_UNITS = ["second", "minute", "hour", "day", "week", "month", "quarter", "year"]
+
+# buckets of several months or years (e.g., "3 months"), which date_bin() does not support
+CALENDAR_BUCKET = re.compile(r"\s*(\d+)\s*(month|year)s?\s*")
+
+# any other bucket size is computed with date_bin(), relative to this time
+# (buckets of several months or years also start a whole number of buckets after it)
+BUCKET_ORIGIN = datetime.datetime(2000, 1, 1)
+
+# the categorical columns that can be used for grouping, and their possible values
+CATEGORIES = {"type": OBJECT_TYPES, "status": REPORT_STATUSES}
+
+# how each aggregate is computed from the columns of the rollup tables
+ROLLUP_AGGREGATES = {
+    "count": lambda rollup: sa.cast(sa.func.sum(rollup.c.count), sa.BigInteger),
+    "sum": lambda rollup: sa.func.sum(rollup.c.value_sum),
+    "avg": lambda rollup: sa.func.sum(rollup.c.value_sum) / sa.func.sum(rollup.c.count),
+    "min": lambda rollup: sa.func.min(rollup.c.value_min),
+    "max": lambda rollup: sa.func.max(rollup.c.value_max),
+}
+
+
+def bucket_expression(column, bucket):
+    """
+    Get an SQL expression that rounds the times in a column down to the start of their time bucket.
+
+    Parameters
+    ----------
+    column: sqlalchemy.Column
+        The time column.
+    bucket: str or datetime.timedelta
+        The size of each bucket. Either a calendar unit (e.g., "hour", "day" or "month"),
+        an interval string (e.g., "5 minutes" or "3 months") or a timedelta.
+        Intervals with months or years must be a whole number of months, or of years.
+
+    Returns
+    -------
+    sqlalchemy.sql.ColumnElement
+        The start time of the bucket of each row.
+    """
+    if isinstance(bucket, str) and bucket in TRUNCATE_UNITS:
+        return sa.func.date_trunc(bucket, column)
+
+    if isinstance(bucket, str):
+        match = CALENDAR_BUCKET.fullmatch(bucket)
+        if match is not None:
+            return calendar_bucket_expression(column, int(match.group(1)), match.group(2))
+        if re.search(r"\d\s*(mon|y)", bucket):  # e.g., "1 month 2 days", which cannot be computed with date_bin()
+            raise ValueError(
+                f'Unsupported bucket "{bucket}". Buckets with months or years must be a whole number of months '
+                'or of years (e.g., "3 months" or "2 years"), or a calendar unit ("month", "quarter" or "year").'
+            )
+        bucket = sa.cast(sa.literal(bucket), INTERVAL)
+    else:
+        bucket = sa.literal(bucket, INTERVAL)
+
+    return sa.func.date_bin(bucket, column, sa.literal(BUCKET_ORIGIN, sa.DateTime))
+
+
+def calendar_bucket_expression(column, number, unit):
+    """
+    Get an SQL expression that rounds the times in a column down to the start of their bucket
+    of a number of calendar months or years (e.g., 3 months), counting the buckets from BUCKET_ORIGIN.
+    """
+    start = sa.func.date_trunc(unit, column)
+    if number == 1:
+        return start
+
+    units = sa.extract("year", column) - BUCKET_ORIGIN.year
+    if unit == "month":
+        units = units * 12 + sa.extract("month", column) - BUCKET_ORIGIN.month
+    offset = sa.cast((units % number + number) % number, sa.Integer)  # also for times before the origin
+
+    return start - offset * sa.cast(sa.literal(f"1 {unit}"), INTERVAL)
+
+
+def aggregate_expression(name, value_column):
+    """
+    Get the SQL aggregate function for a name like "count", "avg", "min", "max", "sum", "stddev",
+    or "p<N>" for the N-th percentile (e.g., "p50" for the median, or "p99.9").
+    """
+    if name == "count":
+        return sa.func.count()
+    if name in ["avg", "min", "max", "sum", "stddev"]:
+        return getattr(sa.func, name)(value_column)
+    if name.startswith("p"):
+        try:
+            fraction = float(name[1:]) / 100
+        except ValueError:
+            fraction = None
+        if fraction is not None and 0 <= fraction <= 1:
+            return sa.func.percentile_cont(fraction).within_group(value_column)
+
+    raise ValueError(f'Unknown aggregate "{name}". Use count, avg, min, max, sum, stddev, or p<N> for percentiles.')
+
+
+def rollup_resolution(bucket):
+    """
+    Get the coarsest resolution of the rollup tables ("hour" or "minute")
+    whose buckets fit a whole number of times into the given time bucket.
+    Returns None if the bucket is smaller than a minute, or not a whole number of minutes,
+    or an interval string that is not of the form "<N> <unit>" (e.g., "5 minutes").
+    """
+    if bucket is None:  # not grouped by time
+        return "hour"
+    if isinstance(bucket, str) and bucket in TRUNCATE_UNITS:
+        return {"second": None, "minute": "minute"}.get(bucket, "hour")
+    if isinstance(bucket, str) and CALENDAR_BUCKET.fullmatch(bucket) is not None:
+        return "hour"
+    if isinstance(bucket, str):
+        match = re.fullmatch(r"\s*(\d+)\s*(second|minute|hour|day|week)s?\s*", bucket)
+        if match is None:
+            return None
+        bucket = datetime.timedelta(**{f"{match.group(2)}s": int(match.group(1))})
+
+    for resolution, size in [("hour", datetime.timedelta(hours=1)), ("minute", datetime.timedelta(minutes=1))]:
+        if bucket > datetime.timedelta(0) and bucket % size == datetime.timedelta(0):
+            return resolution
+
+    return None
+
+
+def run_aggregation(table, stmt, bucket, group_by, aggregates, value_column=None, session=None):
+    """
+    Group the rows matching the filters of a select statement by time bucket (and other columns),
+    compute the aggregates of each group in the database, and return the results as arrays.
+    See aggregate_detections() for the parameters and return value.
+    """
+    if isinstance(aggregates, str):
+        aggregates = [aggregates]
+    values = {name: aggregate_expression(name, value_column) for name in aggregates}
+
+    # the same filters used by the query functions
+    return group_rows(table, table.c.timestamp, stmt.whereclause, bucket, group_by, values, session=session)
+
+
+def run_rollup_aggregation(
+    table, bucket, group_by, aggregates, categories=None, start_time=None, end_time=None, vehicle_id=None, session=None
+):
+    """
+    Same as run_aggregation(), but reads the rollup table of the given raw table,
+    instead of the raw rows, using the coarsest resolution that fits into the bucket.
+    Only the aggregates in ROLLUP_AGGREGATES can be computed,
+    and the rows are filtered by whole rollup buckets: the results include all the rows in any rollup bucket
+    that overlaps with the time range [start_time, end_time].
+    """
+    rollup, category = ROLLUP_TABLES[table.name]
+    resolution = rollup_resolution(bucket)
+    if resolution is None:
+        raise ValueError(f"Cannot aggregate by {bucket} using the rollups, which have buckets of whole minutes.")
+    if isinstance(aggregates, str):
+        aggregates = [aggregates]
+    for name in aggregates:
+        if name not in ROLLUP_AGGREGATES:
+            raise ValueError(f'Cannot compute "{name}" from the rollups. Use one of {list(ROLLUP_AGGREGATES)}.')
+    values = {name: ROLLUP_AGGREGATES[name](rollup) for name in aggregates}
+
+    categories = known_values(categories, CATEGORIES[category])
+    conditions = [rollup.c.resolution == resolution]
+    if categories is not None:
+        conditions.append(rollup.c[category].in_(categories))
+    if start_time is not None:  # the bucket that contains the start time is included
+        conditions.append(
+            rollup.c.bucket >= sa.func.date_trunc(resolution, sa.cast(sa.literal(start_time), sa.DateTime))
+        )
+    if end_time is not None:
+        conditions.append(rollup.c.bucket <= end_time)
+    if vehicle_id is not None:
+        conditions.append(rollup.c.vehicle_id == vehicle_id)
+
+    return group_rows(rollup, rollup.c.bucket, sa.and_(*conditions), bucket, group_by, values, session=session)
+
+
+def group_rows(table, time_column, whereclause, bucket, group_by, values, session=None):
+    """
+    Group the rows of a table that match a where clause by time bucket (and other columns),
+    compute the given aggregate expressions (a dictionary keyed by name) for each group,
+    and return the results as a dictionary of arrays.
+    """
+    if isinstance(group_by, str):
+        group_by = [group_by]
+
+    keys = []
+    if bucket is not None:
+        keys.append(bucket_expression(time_column, bucket).label("bucket"))
+    for name in group_by:
+        if name not in ["vehicle_id"] + [c for c in CATEGORIES if c in table.c]:
+            raise ValueError(f'Cannot group {table.name} by "{name}".')
+        keys.append(table.c[name].label(name))
+
+    query = sa.select(*keys, *[value.label(name) for name, value in values.items()]).select_from(table)
+    if whereclause is not None:
+        query = query.where(whereclause)
+    if len(keys) > 0:
+        query = query.group_by(*keys).order_by(*keys)
+
+    with SmartSession(session, role="read") as session:
+        rows = session.execute(query).all()
+
+    names = [key.name for key in keys] + list(values)
+    columns = list(zip(*rows)) if len(rows) > 0 else [()] * len(names)
+    arrays = {}
+    for name, column in zip(names, columns):
+        if name == "bucket":
+            arrays[name] = np.array(column, dtype="datetime64[us]")
+        elif name in CATEGORIES:  # codes into the list of possible values
+            arrays[name] = np.array([CATEGORIES[name].index(v) for v in column], dtype=np.int8)
+        elif name == "vehicle_id":
+            arrays[name] = np.array(column, dtype=object)
+        elif name == "count":
+            arrays[name] = np.array(column, dtype=np.int64)
+        else:  # groups where all values are NULL (e.g., stddev of a single value) become NaN
+            arrays[name] = np.array([np.nan if v is None else v for v in column], dtype=np.float64)
+
+    return arrays
+
+
+def aggregate_detections(
+    bucket="5 minutes",
+    group_by="type",
+    aggregates="count",
+    types=None,
+    exact_values=None,
+    value_minimum=None,
+    value_maximum=None,
+    start_time=None,
+    end_time=None,
+    vehicle_id=None,
+    from_rollups=False,
+    session=None,
+):
+    """
+    Count the detections (or compute statistics of their values) per time bucket,
+    and optionally per type and/or vehicle, inside the database,
+    without loading the individual detections.
+    Accepts the same filters as api.query.get_detections().
+
+    Parameters
+    ----------
+    bucket: str or datetime.timedelta, optional
+        The size of each time bucket: a calendar unit ("second", "minute", "hour", "day", "week", "month", ...),
+        an interval string (e.g., "5 minutes", "2 hours" or "3 months") or a timedelta.
+        If None, do not group by time.
+    group_by: str or list of str
+        Other columns to group by: "type" and/or "vehicle_id". Use an empty list to group only by time.
+    aggregates: str or list of str
+        What to compute for each group: "count", or a statistic of the detection values:
+        "avg", "min", "max", "sum", "stddev", or "p<N>" for the N-th percentile (e.g., "p50", "p95").
+    from_rollups: bool
+        If True, read the per-minute or per-hour rollup tables (see api.rollups) instead of the detections,
+        which is much faster for long time ranges.
+        Requires a bucket of whole minutes (or whole hours, for the fastest queries),
+        only supports the "count", "sum", "avg", "min" and "max" aggregates,
+        and cannot filter by the detection values.
+        The time range is extended to whole rollup buckets (e.g., to the start of the hour of start_time).
+
+    Returns
+    -------
+    dict
+        A dictionary with one array per group column and one per aggregate, with one element per group,
+        sorted by time bucket and then by the other group columns:
+        - bucket: datetime64[us] array with the start time of each bucket.
+        - type: int8 array of codes, where each code is the index of the type in models.detections.OBJECT_TYPES.
+        - vehicle_id: array of strings (dtype object).
+        - count: int64 array.
+        - any other aggregate: float64 array.
+        Groups without any detections are not included.
+    """
+    table = Detection.__table__
+    if from_rollups:
+        if exact_values is not None or value_minimum is not None or value_maximum is not None:
+            raise ValueError("Cannot filter by the detection values when using the rollups.")
+        return run_rollup_aggregation(
+            table, bucket, group_by, aggregates, types, start_time, end_time, vehicle_id, session=session
+        )
+
+    stmt = detections_statement(
+        types=types,
+        exact_values=exact_values,
+        value_minimum=value_minimum,
+        value_maximum=value_maximum,
+        start_time=start_time,
+        end_time=end_time,
+        vehicle_id=vehicle_id,
+    )
+
+    return run_aggregation(table, stmt, bucket, group_by, aggregates, value_column=table.c.value, session=session)
+
+
+def aggregate_reports(
+    bucket="hour",
+    group_by="status",
+    statuses=None,
+    start_time=None,
+    end_time=None,
+    vehicle_id=None,
+    from_rollups=False,
+    session=None,
+):
+    """
+    Count the reports per time bucket, and optionally per status and/or vehicle, inside the database,
+    without loading the individual reports (e.g., the number of accidents per hour).
+    Accepts the same filters as api.query.get_reports().
+
+    Parameters
+    ----------
+    bucket: str or datetime.timedelta, optional
+        The size of each time bucket (see aggregate_detections()). If None, do not group by time.
+    group_by: str or list of str
+        Other columns to group by: "status" and/or "vehicle_id". Use an empty list to group only by time.
+    from_rollups: bool
+        If True, read the rollup tables instead of the reports (see aggregate_detections()).
+
+    Returns
+    -------
+    dict
+        A dictionary with one array per group column, and the "count" of each group (see aggregate_detections()).
+        The status is given as int8 codes into models.reports.REPORT_STATUSES.
+    """
+    if from_rollups:
+        return run_rollup_aggregation(
+            Report.__table__, bucket, group_by, "count", statuses, start_time, end_time, vehicle_id, session=session
+        )
+
+    stmt = reports_statement(statuses=statuses, start_time=start_time, end_time=end_time, vehicle_id=vehicle_id)
+
+    return run_aggregation(Report.__table__, stmt, bucket, group_by, "count", session=session)
@@ -0,0 +1,73 @@
+"""
+Asyncio versions of the ingest functions in api.ingest, for use in async applications (e.g., an async web server).
+They use an async session (see models.base.AsyncSession()) with the asyncpg driver,
+so the event loop can run other tasks while waiting for the database.
+The data is validated and written exactly as in the synchronous functions
+(including loading the rows with COPY), and the same status reports are returned.
+"""
+import json
+import traceback
+
+from models.base import run_sync
+
+from api.ingest import make_empty_status, ingest_data, ingest_payloads
+
+
+async def async_ingest(data, session=None, bulk=True):
+    """
+    Read the content of a string of data (JSON formatted), verify that the data is compatible,
+    and save it into the database. This is the asyncio version of api.ingest.ingest().
+
+    Parameters
+    ----------
+    data: str
+        A JSON formatted string with the content of a file or stream of data.
+    session: sqlalchemy.ext.asyncio.AsyncSession, optional
+        An async session to use for the database connection. If not given, a new session will be created.
+        If a new session is created, it will also be closed at the end of the call.
+    bulk: bool
+        If True (default), write all rows at once using COPY. If False, create one ORM object per row.
+
+    Returns
+    -------
+    status_report: dict
+        A dictionary with a report on success/failure and any errors (see api.ingest.ingest()).
+    """
+    status_report = make_empty_status()
+
+    try:
+        data_dict = json.loads(data)
+    except Exception:
+        status_report["status"] = "failure"
+        status_report["errors"].append(f"Could not parse data: {traceback.format_exc()}")
+        return status_report
+
+    return await async_ingest_data(data_dict, status_report, session=session, bulk=bulk)
+
+
+async def async_ingest_data(data_dict, status_report=None, session=None, bulk=True):
+    """
+    Save data that was already parsed from JSON into the database.
+    This is the asyncio version of api.ingest.ingest_data(), see it for the parameters,
+    except that the session must be an async session (or None).
+
+    Returns
+    -------
+    status_report: dict
+        The same status report that was given (or a new one), with the results of the ingestion.
+    """
+    return await run_sync(ingest_data, data_dict, status_report, session=session, bulk=bulk)
+
+
+async def async_ingest_payloads(payloads, session=None, bulk=True):
+    """
+    Save several payloads into the database in a single transaction.
+    This is the asyncio version of api.ingest.ingest_payloads(), see it for the parameters,
+    except that the session must be an async session (or None).
+
+    Returns
+    -------
+    statuses: list of dict
+        One status report per payload, in the same order as the payloads.
+    """
+    return await run_sync(ingest_payloads, payloads, session=session, bulk=bulk)
@@ -0,0 +1,129 @@
+"""
+Asyncio versions of the query functions in api.query and api.aggregate, for use in async applications.
+Each function accepts the same criteria as its synchronous version,
+and an async session (see models.base.AsyncSmartSession()) instead of a regular one.
+The query cache of api.query is not used by these functions.
+
+The returned objects are detached from the session (or the session is still open if one was given),
+but lazy loading their relationships is not possible with asyncio,
+so use async_get_fleet() to get vehicles together with their reports and detections.
+"""
+from models.base import AsyncSmartSession, run_sync
+
+from api.query import (
+    get_vehicle,
+    get_fleet,
+    get_reports,
+    get_detections,
+    get_detections_columns,
+    get_current_statuses,
+    reports_statement,
+    detections_statement,
+)
+from api.aggregate import aggregate_detections, aggregate_reports
+
+
+async def async_get_vehicle(vehicle_id, session=None):
+    """
+    Get a vehicle by its ID (see api.query.get_vehicle()).
+    """
+    return await run_sync(get_vehicle, vehicle_id, session=session)
+
+
+async def async_get_fleet(vehicle_ids, session=None, **kwargs):
+    """
+    Get many vehicles together with their reports and detections (see api.query.get_fleet()).
+    """
+    return await run_sync(get_fleet, vehicle_ids, session=session, **kwargs)
+
+
+async def async_get_reports(session=None, **kwargs):
+    """
+    Get reports matching the given criteria (see api.query.get_reports()).
+    """
+    return await run_sync(get_reports, session=session, **kwargs)
+
+
+async def async_get_detections(session=None, **kwargs):
+    """
+    Get detections matching the given criteria (see api.query.get_detections()).
+    """
+    return await run_sync(get_detections, session=session, **kwargs)
+
+
+async def async_get_detections_columns(session=None, **kwargs):
+    """
+    Get the columns of the detections matching the given criteria as arrays (see api.query.get_detections_columns()).
+    """
+    return await run_sync(get_detections_columns, session=session, **kwargs)
+
+
+async def async_get_current_statuses(session=None, **kwargs):
+    """
+    Get the latest status of each vehicle (see api.query.get_current_statuses()).
+    """
+    return await run_sync(get_current_statuses, session=session, **kwargs)
+
+
+async def async_aggregate_detections(session=None, **kwargs):
+    """
+    Aggregate the detections in time buckets (see api.aggregate.aggregate_detections()).
+    """
+    return await run_sync(aggregate_detections, session=session, **kwargs)
+
+
+async def async_aggregate_reports(session=None, **kwargs):
+    """
+    Aggregate the reports in time buckets (see api.aggregate.aggregate_reports()).
+    """
+    return await run_sync(aggregate_reports, session=session, **kwargs)
+
+
+async def async_iter_results(stmt, chunk_size=1000, chunks=False, session=None):
+    """
+    Run a select statement and yield its results a few at a time, using a server-side cursor.
+    This is the asyncio version of api.query.iter_results(), used with "async for".
+    If a session is given, the caller must not use it for other queries until the iteration is done.
+
+    Parameters
+    ----------
+    stmt: sqlalchemy.sql.Select
+        The statement to run.
+    chunk_size: int
+        Number of rows to fetch from the database at a time.
+    chunks: bool
+        If True, yield lists of (up to) chunk_size objects, instead of one object at a time.
+    session: sqlalchemy.ext.asyncio.AsyncSession, optional
+        An async session to use for the database connection. If not given, a new session will be created,
+        and closed when the iteration ends.
+
+    Yields
+    ------
+    object or list of objects
+        The ORM objects matching the statement, one at a time (or one chunk at a time).
+    """
+    async with AsyncSmartSession(session) as session:
+        result = await session.stream_scalars(stmt.execution_options(yield_per=chunk_size))
+        try:
+            if chunks:
+                async for partition in result.partitions():
+                    yield partition
+            else:
+                async for obj in result:
+                    yield obj
+        finally:
+            await result.close()
+
+
+def async_iter_reports(chunk_size=1000, chunks=False, session=None, **kwargs):
+    """
+    Iterate over the reports matching the given criteria (see api.query.iter_reports()), using "async for".
+    """
+    return async_iter_results(reports_statement(**kwargs), chunk_size=chunk_size, chunks=chunks, session=session)
+
+
+def async_iter_detections(chunk_size=1000, chunks=False, session=None, **kwargs):
+    """
+    Iterate over the detections matching the given criteria (see api.query.iter_detections()), using "async for".
+    """
+    return async_iter_results(detections_statement(**kwargs), chunk_size=chunk_size, chunks=chunks, session=session)
@@ -0,0 +1,220 @@
+import json
+import time
+import queue
+import threading
+import traceback
+from concurrent.futures import Future
+
+from api.ingest import ingest_payloads, make_empty_status
+
+_STOP = object()  # put into the queue to tell a flusher thread to finish
+
+
+def count_rows(payload):
+    """
+    Count the number of rows (reports and detections) in a parsed payload.
+    This is done before the payload is validated, so anything that is not a dictionary is counted as one row,
+    and fields that are not lists are counted as no rows (the payload fails later, when it is ingested).
+    """
+    if not isinstance(payload, dict):
+        return 1
+    reports = payload.get("vehicle_status")
+    events = payload.get("objects_detection_events")
+    num_rows = len(reports) if isinstance(reports, list) else 0
+    for event in events if isinstance(events, list) else []:
+        detections = event.get("detections") if isinstance(event, dict) else None
+        num_rows += len(detections) if isinstance(detections, list) else 1
+
+    return max(num_rows, 1)
+
+
+class IngestBatcher:
+    """
+    Collect payloads from many producers (e.g., a folder watcher, an HTTP server, or library code)
+    and save them into the database together, with one commit for many payloads (a "group commit").
+
+    Each call to submit() puts a payload into a queue and returns a Future.
+    A flusher thread takes payloads from the queue until the batch has at least max_batch_rows rows,
+    or until max_delay seconds passed since the first payload in the batch arrived,
+    and then saves the whole batch using ingest_payloads().
+    Each payload still gets its own status report (the result of its Future),
+    and a bad payload fails on its own, without affecting the rest of the batch.
+    This adds up to max_delay seconds of latency to each payload,
+    but saves a commit (and a disk flush in the database) for each payload in the batch.
+
+    Use close() (or a "with" statement) to save all the queued payloads and stop the flusher threads.
+    """
+
+    def __init__(self, max_batch_rows=5000, max_delay=0.01, max_queue=0, flushers=1, bulk=True):
+        """
+        Parameters
+        ----------
+        max_batch_rows: int
+            Flush a batch once it has at least this many rows (reports and detections).
+        max_delay: float
+            Flush a batch at most this many seconds after its first payload arrived.
+        max_queue: int
+            Maximal number of payloads waiting to be flushed.
+            When the queue is full, submit() blocks or raises queue.Full.
+            If 0 (default), the queue size is not limited.
+        flushers: int
+            Number of batches that can be written to the database concurrently
+            (each in its own thread, with its own session).
+        bulk: bool
+            If True (default), write the rows using COPY. If False, create one ORM object per row.
+        """
+        self.max_batch_rows = max_batch_rows
+        self.max_delay = max_delay
+        self.bulk = bulk
+
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.closed = False
+        self.submitting = 0  # the number of submit() calls that are putting a payload into the queue right now
+        self.closed_condition = threading.Condition()  # so no payload is queued after close() stopped the flushers
+        self.counters = {"payloads": 0, "batches": 0, "rows": 0}
+        self.counters_lock = threading.Lock()
+
+        self.threads = [
+            threading.Thread(target=self.flush_loop, name=f"ingest-batcher-{i}", daemon=True) for i in range(flushers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, payload, block=True, timeout=None):
+        """
+        Queue a payload to be saved in the next batch.
+
+        Parameters
+        ----------
+        payload: dict
+            A dictionary with the data (as given to ingest_data()).
+        block: bool
+            If the queue is full, wait until there is room for the payload (default).
+            If False, raise queue.Full right away.
+        timeout: float, optional
+            Maximal time in seconds to wait for room in the queue, before raising queue.Full.
+
+        Returns
+        -------
+        concurrent.futures.Future
+            A future that is resolved to the status report of this payload, once its batch is committed.
+        """
+        future = Future()
+        num_rows = count_rows(payload)
+        with self.closed_condition:
+            if self.closed:
+                raise RuntimeError("Cannot submit data to a closed IngestBatcher.")
+            self.submitting += 1
+
+        # waiting for room in the queue does not hold the lock, so it does not block close() or other producers
+        try:
+            self.queue.put((payload, num_rows, future), block=block, timeout=timeout)
+        finally:
+            with self.closed_condition:
+                self.submitting -= 1
+                self.closed_condition.notify_all()
+
+        return future
+
+    def submit_file(self, filename):
+        """
+        Read a (small) JSON file and queue its data to be saved in the next batch.
+        The whole file is loaded into memory, so large files should be saved using ingest_file() instead.
+        Returns a Future, like submit(). If the file cannot be parsed, the Future is already resolved
+        to a failed status report.
+        """
+        try:
+            with open(filename) as f:
+                payload = json.load(f)
+        except Exception:
+            status = make_empty_status()
+            status["status"] = "failure"
+            status["errors"].append(f"Could not parse data: {traceback.format_exc()}")
+            future = Future()
+            future.set_result(status)
+            return future
+
+        return self.submit(payload)
+
+    def ingest(self, payload):
+        """
+        Save a payload in the next batch, and wait until it is committed.
+        Returns the status report of the payload.
+        """
+        return self.submit(payload).result()
+
+    def flush_loop(self):
+        """
+        Take batches of payloads from the queue and save each batch in a single transaction.
+        Runs in each of the flusher threads, until it gets the stop signal from close().
+        """
+        while True:
+            item = self.queue.get()
+            if item is _STOP:
+                return
+            payload, num_rows, future = item
+            batch = [(payload, future)]
+            deadline = time.monotonic() + self.max_delay
+            stop = False
+
+            # keep collecting payloads until the batch is big enough, or the first payload waited long enough
+            while num_rows < self.max_batch_rows:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stop = True
+                    break
+                payload, rows, future = item
+                batch.append((payload, future))
+                num_rows += rows
+
+            self.flush(batch, num_rows)
+            if stop:
+                return
+
+    def flush(self, batch, num_rows):
+        """
+        Save a batch of (payload, future) pairs and resolve each future with the status report of its payload.
+        """
+        try:
+            statuses = ingest_payloads([p for p, _ in batch], bulk=self.bulk)
+        except Exception:
+            status = make_empty_status()
+            status["status"] = "failure"
+            status["errors"].append(f"Could not ingest data: {traceback.format_exc()}")
+            statuses = [dict(status, errors=list(status["errors"])) for _ in batch]
+
+        with self.counters_lock:
+            self.counters["payloads"] += len(batch)
+            self.counters["batches"] += 1
+            self.counters["rows"] += num_rows
+
+        for (_, future), status in zip(batch, statuses):
+            future.set_result(status)
+
+    def close(self):
+        """
+        Stop accepting new payloads, save all the payloads that are already queued,
+        and wait for the flusher threads to finish.
+        """
+        with self.closed_condition:
+            if self.closed:
+                return
+            self.closed = True
+            # the payloads that are being queued right now are still saved (the flushers make room for them)
+            self.closed_condition.wait_for(lambda: self.submitting == 0)
+        for _ in self.threads:
+            self.queue.put(_STOP)
+        for thread in self.threads:
+            thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,218 @@
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+# inotify event masks, from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+INOTIFY_EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
+
+
+def list_files(path, suffix=".json"):
+    """
+    Get a sorted list of the full paths of all files in the directory that end with the given suffix.
+    """
+    with os.scandir(path) as entries:
+        return sorted(entry.path for entry in entries if entry.name.endswith(suffix) and entry.is_file())
+
+
+class PollingWatch:
+    """
+    Find new files in a directory by listing it every few seconds.
+    Works on any platform, but reacts to new files only after up to one interval.
+    """
+
+    def __init__(self, path, suffix=".json", interval=1):
+        self.path = path
+        self.suffix = suffix
+        self.interval = interval
+
+    def wait(self, timeout=None):
+        """
+        Get the files currently in the directory.
+        If there are none, sleep for one interval (or until the timeout) and check again.
+
+        Parameters
+        ----------
+        timeout: float, optional
+            Maximal time in seconds to wait for new files. If None, wait for one interval.
+
+        Returns
+        -------
+        list of str
+            Sorted full paths of the files found in the directory. May be empty.
+        """
+        files = list_files(self.path, self.suffix)
+        if len(files) > 0:
+            return files
+
+        time.sleep(self.interval if timeout is None else max(0, min(self.interval, timeout)))
+
+        return list_files(self.path, self.suffix)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class InotifyWatch:
+    """
+    Find new files in a directory using the Linux inotify API.
+    A file is reported as soon as it is closed after writing (IN_CLOSE_WRITE),
+    or moved into the directory (IN_MOVED_TO), so it is never picked up half-written.
+    While waiting for events, the process sleeps in select() and uses no CPU.
+    Files that are already in the directory when the watch starts are reported on the first call to wait().
+    """
+
+    def __init__(self, path, suffix=".json"):
+        self.path = path
+        self.suffix = suffix
+
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, f"inotify_init1 failed: {os.strerror(err)}")
+
+        wd = libc.inotify_add_watch(self.fd, os.fsencode(path), IN_CLOSE_WRITE | IN_MOVED_TO)
+        if wd < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, f"inotify_add_watch failed on {path}: {os.strerror(err)}")
+
+        # the watch is already active, so files written from now on will also generate events
+        self.pending = list_files(self.path, self.suffix)
+
+    def read_events(self):
+        """
+        Read all available events from the inotify file descriptor.
+        Returns a list of file names, or None if the event queue overflowed
+        (in which case the directory should be listed instead).
+        """
+        names = []
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+
+            offset = 0
+            while offset < len(data):
+                _, mask, _, length = INOTIFY_EVENT_HEADER.unpack_from(data, offset)
+                offset += INOTIFY_EVENT_HEADER.size
+                name = os.fsdecode(data[offset : offset + length].rstrip(b"\0"))
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    return None
+                if mask & (IN_ISDIR | IN_IGNORED):
+                    continue
+                names.append(name)
+
+        return names
+
+    def wait(self, timeout=None):
+        """
+        Wait until new files are written into (or moved into) the directory.
+
+        Parameters
+        ----------
+        timeout: float, optional
+            Maximal time in seconds to wait for new files. If None, wait until there are new files.
+
+        Returns
+        -------
+        list of str
+            Sorted full paths of the new files that still exist. May be empty if the timeout was reached.
+        """
+        if len(self.pending) > 0:
+            files, self.pending = self.pending, []
+            return files
+
+        readable, _, _ = select.select([self.fd], [], [], None if timeout is None else max(0, timeout))
+        if len(readable) == 0:
+            return []
+
+        names = self.read_events()
+        if names is None:  # missed some events, so look at everything in the directory
+            return list_files(self.path, self.suffix)
+
+        files = {os.path.join(self.path, name) for name in names if name.endswith(self.suffix)}
+
+        return sorted(f for f in files if os.path.isfile(f))
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def inotify_available():
+    """
+    Check if the inotify API can be used on this system.
+    """
+    if not sys.platform.startswith("linux"):
+        return False
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6")
+        return hasattr(libc, "inotify_init1")
+    except OSError:
+        return False
+
+
+def watch_directory(path, suffix=".json", backend="auto", interval=1):
+    """
+    Start watching a directory for new files.
+
+    Parameters
+    ----------
+    path: str
+        The directory to watch.
+    suffix: str
+        Only files ending with this suffix are reported.
+    backend: str
+        Which method to use for finding new files:
+        - "inotify": get events from the Linux kernel as soon as files are written.
+        - "poll": list the directory every interval seconds.
+        - "auto" (default): use inotify if it is available, otherwise use polling.
+    interval: float
+        Time in seconds between checks of the directory, for the polling backend.
+
+    Returns
+    -------
+    PollingWatch or InotifyWatch
+        An object with a wait(timeout) method that returns a list of new files.
+        Should be closed when done (it can be used as a context manager).
+    """
+    if backend == "auto":
+        backend = "inotify" if inotify_available() else "poll"
+
+    if backend == "inotify":
+        return InotifyWatch(path, suffix=suffix)
+    if backend == "poll":
+        return PollingWatch(path, suffix=suffix, interval=interval)
+
+    raise ValueError(f'Unknown backend "{backend}". Use "auto", "inotify" or "poll".')
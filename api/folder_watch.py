@@ -1,63 +1,316 @@
 import os
 import time
+import socket
+import logging
+import functools
+import threading
+from concurrent.futures import ProcessPoolExecutor
 
-from api.ingest import ingest
+from models.base import reset_engine
+from models.partitions import create_upcoming_partitions, PARTITIONS_CHECK_INTERVAL
+from api.ingest import ingest_file
+from api.dir_watch import watch_directory
+from api.metrics import IngestMetrics, serve_metrics
+
+PROCESSING_DIR = "processing"  # sub-directory of the watched directory, where files are moved while ingested
+
+logger = logging.getLogger(__name__)
+
+
+def get_worker_id():
+    """
+    A unique name for this watcher process, made of the host name and the process ID.
+    """
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def claim_file(filename, claim_dir):
+    """
+    Claim a file for this watcher, by moving it into the watcher's own processing directory.
+    Renaming is atomic (on the same filesystem), so if several watchers try to claim
+    the same file, exactly one of them succeeds.
+
+    Parameters
+    ----------
+    filename: str
+        Full path to the file to claim.
+    claim_dir: str
+        The processing directory of this watcher. Must be on the same filesystem as the file.
+
+    Returns
+    -------
+    str or None
+        The new path of the claimed file, or None if another watcher already claimed it.
+    """
+    claimed = os.path.join(claim_dir, os.path.basename(filename))
+    try:
+        os.rename(filename, claimed)
+    except FileNotFoundError:
+        return None
+
+    return claimed
+
+
+def is_stale_claim(claim_dir, stale_timeout):
+    """
+    Check if a processing directory belongs to a watcher that is no longer running.
+    For watchers on this host, check if the process still exists.
+    For watchers on other hosts, check if the directory was not touched for stale_timeout seconds
+    (each watcher touches its own processing directory regularly, as a heartbeat).
+    """
+    host, _, pid = os.path.basename(claim_dir).rpartition("-")
+    if host == socket.gethostname() and pid.isdigit():
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:  # the process exists, but belongs to another user
+            return False
+        return False
+
+    try:
+        return time.time() - os.stat(claim_dir).st_mtime > stale_timeout
+    except FileNotFoundError:
+        return False
+
+
+def unused_filename(directory, name):
+    """
+    Get a path in the directory for a file with the given name, that does not overwrite an existing file.
+    If a file with this name already exists (e.g., a new file with the same name was dropped into
+    the directory while the old one was claimed), a suffix is added before the extension:
+    name.recovered-1.json, name.recovered-2.json, etc.
+    """
+    base, ext = os.path.splitext(name)
+    filename = os.path.join(directory, name)
+    counter = 0
+    while os.path.exists(filename):
+        counter += 1
+        filename = os.path.join(directory, f"{base}.recovered-{counter}{ext}")
+
+    return filename
+
+
+def keep_alive(claim_dir, interval, stop):
+    """
+    Touch the processing directory of a watcher every interval seconds, until the stop event is set,
+    so other watchers do not consider it dead while it is busy ingesting large files (see is_stale_claim()).
+    Meant to run in a background thread.
+    """
+    while not stop.wait(interval):
+        try:
+            os.utime(claim_dir)
+        except FileNotFoundError:
+            pass
+
+
+def recover_stale_claims(working_dir, stale_timeout):
+    """
+    Move files claimed by watchers that are no longer running back into the watched directory,
+    so they are claimed and ingested by one of the running watchers.
+    Files may be ingested twice if a watcher died after saving a file but before deleting it,
+    but since ingestion skips duplicates, this does not change the database.
+
+    Parameters
+    ----------
+    working_dir: str
+        The watched directory.
+    stale_timeout: float
+        Time in seconds after which a watcher on another host that did not touch its
+        processing directory is considered dead.
+
+    Returns
+    -------
+    list of str
+        The full paths of the files that were moved back into the watched directory.
+    """
+    processing_dir = os.path.join(working_dir, PROCESSING_DIR)
+    if not os.path.isdir(processing_dir):
+        return []
+
+    recovered = []
+    for entry in os.scandir(processing_dir):
+        if not entry.is_dir() or entry.name == get_worker_id() or not is_stale_claim(entry.path, stale_timeout):
+            continue
+        for claimed in os.scandir(entry.path):
+            filename = unused_filename(working_dir, claimed.name)
+            try:
+                os.rename(claimed.path, filename)
+                recovered.append(filename)
+            except FileNotFoundError:  # another watcher recovered it first
+                pass
+        try:
+            os.rmdir(entry.path)
+        except OSError:
+            pass
+
+    return recovered
 
 
 def watcher(
-    working_dir=None, interval=1, timeout=None, delay=None, session=None, statuses=None
+    working_dir=None,
+    interval=1,
+    timeout=None,
+    delay=None,
+    session=None,
+    statuses=None,
+    workers=None,
+    backend="auto",
+    stale_timeout=60,
+    batcher=None,
+    metrics=None,
+    metrics_port=None,
 ):
     """
     Watches a directory for new files and ingests them.
+    Several watchers (processes or hosts) can safely watch the same directory:
+    each file is first claimed by moving it into the watcher's own sub-directory
+    (processing/<host>-<pid>), so it is ingested by exactly one watcher.
+    Files claimed by watchers that died are moved back into the directory and ingested again.
+    If the tables are partitioned, the partitions for the next few intervals are created while watching
+    (see models.partitions.create_upcoming_partitions()), so they do not have to be created while ingesting.
 
     Parameters
     ----------
     working_dir: str
         Directory to watch. Defaults to current working directory.
     interval: float
-        Time in seconds between checks for new files.
+        Time in seconds between checks for new files, when using the polling backend.
     timeout: float, optional
         Time in seconds to watch the directory. If None, watch forever.
     delay: delay, optional
         Time in seconds to wait before starting to watch the directory.
     session: sqlalchemy.orm.Session, optional
         Database session to use. If None, will create a new session each time ingest is called.
+        Cannot be used together with workers.
+    workers: int, optional
+        Number of worker processes used to ingest files concurrently.
+        Each worker process has its own database engine.
+        If None (default), files are ingested one at a time in this process.
+    backend: str
+        How to find new files in the directory:
+        - "inotify": react to Linux kernel events as soon as a file is written (or moved) into the directory.
+        - "poll": list the directory every interval seconds.
+        - "auto" (default): use inotify if it is available, otherwise use polling.
+    stale_timeout: float
+        Time in seconds after which the files claimed by a silent watcher on another host are recovered.
+        Watchers on the same host are recovered as soon as their process is gone.
+    batcher: api.batcher.IngestBatcher, optional
+        If given, the files are given to this batcher, which saves many files in one transaction
+        (possibly together with data from other producers that use the same batcher).
+        This is much faster when the directory gets many small files,
+        but each file is loaded into memory in full.
+        Cannot be used together with session or workers.
+    metrics: api.metrics.IngestMetrics, optional
+        If given, the status report of each file is added to these metrics,
+        and the files are ingested with instrumentation, so the metrics include the time of each stage
+        and the number of SQL statements (see api.metrics.record_metrics()).
+        The timings are not available for files given to a batcher.
+    metrics_port: int, optional
+        If given, serve the metrics in the Prometheus text format on http://localhost:<metrics_port>/metrics
+        while watching (see api.metrics.serve_metrics()). A new IngestMetrics is made if metrics is not given.
 
     Returns
     -------
     statuses: list
         A list of dictionaries with the status of each ingest call.
+        In each check of the directory, files are ingested (and their statuses added)
+        in alphabetical order, even when using multiple workers.
     """
     if working_dir is None:
         working_dir = os.getcwd()
 
+    if workers is not None and session is not None:
+        raise ValueError("Cannot use a session with multiple workers, as sessions cannot be shared between processes.")
+
+    if batcher is not None and (workers is not None or session is not None):
+        raise ValueError("Cannot use a batcher together with a session or with multiple workers.")
+
     start_time = time.time()
 
     if statuses is None:  # if not None, will append to input as an output
         statuses = []
 
-    while True:
-        if timeout is not None and time.time() - start_time > timeout:
-            break
-        if delay is not None and time.time() - start_time < delay:
-            continue
+    if delay is not None:
+        time.sleep(delay if timeout is None else min(delay, timeout))
+
+    claim_dir = os.path.join(working_dir, PROCESSING_DIR, get_worker_id())
+    os.makedirs(claim_dir, exist_ok=True)
+    heartbeat = stale_timeout / 4
+    last_recovery = 0
+    last_partitions = None
+
+    # the heartbeat runs in the background, so it continues while a long batch or a large file is ingested
+    stop_heartbeat = threading.Event()
+    heartbeat_thread = threading.Thread(target=keep_alive, args=(claim_dir, heartbeat, stop_heartbeat), daemon=True)
+    heartbeat_thread.start()
+
+    if metrics_port is not None and metrics is None:
+        metrics = IngestMetrics()
+    ingest_function = ingest_file if metrics is None else functools.partial(ingest_file, instrument=True)
+
+    executor = None
+    if workers is not None:
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=reset_engine)
+
+    metrics_server = None
+    if metrics_port is not None:
+        metrics_server = serve_metrics(metrics, metrics_port)
+
+    try:
+        with watch_directory(working_dir, suffix=".json", backend=backend, interval=interval) as watch:
+            while True:
+                now = time.time()
+                remaining = None if timeout is None else timeout - (now - start_time)
+                if remaining is not None and remaining <= 0:
+                    break
+
+                if now - last_recovery > heartbeat:
+                    recover_stale_claims(working_dir, stale_timeout)
+                    last_recovery = now
+
+                if last_partitions is None or now - last_partitions > PARTITIONS_CHECK_INTERVAL:
+                    try:
+                        create_upcoming_partitions()
+                    except Exception:  # the partitions are still created while ingesting, if needed
+                        logger.exception("Could not create the upcoming partitions")
+                    last_partitions = now
+
+                wait_time = heartbeat if remaining is None else min(remaining, heartbeat)
+                json_files = watch.wait(wait_time)  # sleeps until there are new files (or the timeout)
+                # print(f'files in {working_dir}: {json_files}')
+
+                # other watchers may have taken some of the files already
+                json_files = [c for c in (claim_file(f, claim_dir) for f in json_files) if c is not None]
+
+                if batcher is not None:  # submit all files first, so they can share one commit
+                    new_statuses = [future.result() for future in [batcher.submit_file(f) for f in json_files]]
+                elif executor is None:
+                    new_statuses = (ingest_function(f, session=session) for f in json_files)
+                else:
+                    new_statuses = executor.map(ingest_function, json_files)  # results are returned in order
+
+                for f, status in zip(json_files, new_statuses):
+                    statuses.append(status)
+                    if metrics is not None:
+                        metrics.observe(status)
+                    try:
+                        os.remove(f)  # TODO: add option to send file to archive instead of deleting it
+                    except FileNotFoundError:  # another watcher thought this one died, and recovered the file
+                        pass
 
-        json_files = [
-            os.path.join(working_dir, f)
-            for f in os.listdir(working_dir)
-            if f.endswith(".json")
-        ]
-        # print(f'files in {working_dir}: {json_files}')
-
-        for f in json_files:
-            with open(f) as fid:
-                json_string = fid.read()
-            status = ingest(json_string, session=session)
-            statuses.append(status)
-            os.remove(
-                f
-            )  # TODO: add option to send file to archive instead of deleting it
-
-        time.sleep(interval)
+    finally:
+        stop_heartbeat.set()
+        heartbeat_thread.join()
+        if executor is not None:
+            executor.shutdown()
+        if metrics_server is not None:
+            metrics_server.shutdown()
+            metrics_server.server_close()
+        for d in [claim_dir, os.path.dirname(claim_dir)]:
+            try:
+                os.rmdir(d)  # only succeeds if all claimed files were ingested (and no other watchers are running)
+            except OSError:
+                pass
 
     return statuses
@@ -1,11 +1,33 @@
+import io
+import csv
 import json
+import threading
 import traceback
+from collections import OrderedDict
+
 import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.util import await_only
 
-from models.base import SmartSession
-from models.reports import Report
-from models.detections import Detection
+from models.base import SmartSession, utcnow
+from models.reports import Report, REPORT_STATUSES
+from models.detections import Detection, OBJECT_TYPES
 from models.vehicles import Vehicle
+from models.partitions import is_partitioned, create_missing_partitions
+
+from api.json_stream import iter_json_items
+from api.rollups import derived_statements
+from api.metrics import record_metrics, stage, count_sql
+
+# maximal number of vehicle IDs that are remembered as existing in the database
+VEHICLE_CACHE_SIZE = 100_000
+
+_known_vehicles = OrderedDict()  # used as an LRU cache of vehicle IDs that are known to exist in the DB
+_known_vehicles_lock = threading.Lock()
+
+FOREIGN_KEY_VIOLATION = "23503"  # the PostgreSQL error code of writing a row with a missing vehicle
+
+_ingest_listeners = []  # functions that are told which rows were saved, after each commit (see add_ingest_listener())
 
 
 def make_empty_status():
@@ -14,6 +36,8 @@ def make_empty_status():
         "errors": [],
         "reports saved": 0,
         "detections saved": 0,
+        "reports skipped": 0,
+        "detections skipped": 0,
     }
 
 
@@ -48,7 +72,364 @@ def get_vehicle(vehicle_id, session=None):
         return vehicle
 
 
-def ingest(data, session=None):
+@stage("validate")
+def reports_to_columns(report_list):
+    """
+    Turn a list of status reports into column buffers that can be written in bulk.
+    The status values are validated here, since no ORM objects are constructed.
+
+    Parameters
+    ----------
+    report_list: list
+        A list of status reports, as given to ingest_reports().
+
+    Returns
+    -------
+    columns: dict
+        A dictionary with one list per column of the reports table:
+        vehicle_id, status and timestamp.
+    """
+    columns = {"vehicle_id": [], "status": [], "timestamp": []}
+    for report in report_list:
+        if report["status"] not in REPORT_STATUSES:
+            raise ValueError(f"Invalid status value: {report['status']}")
+        columns["vehicle_id"].append(report["vehicle_id"])
+        columns["status"].append(report["status"])
+        columns["timestamp"].append(report["report_time"])
+
+    return columns
+
+
+@stage("validate")
+def detections_to_columns(event_list):
+    """
+    Turn a list of detection events into column buffers that can be written in bulk.
+    Each event is flattened into one row per detection, with the event's vehicle ID and time.
+    The object types are validated here, since no ORM objects are constructed.
+
+    Parameters
+    ----------
+    event_list: list
+        A list of object detection events, as given to ingest_detections().
+
+    Returns
+    -------
+    columns: dict
+        A dictionary with one list per column of the detections table:
+        vehicle_id, type, value and timestamp.
+    """
+    columns = {"vehicle_id": [], "type": [], "value": [], "timestamp": []}
+    for event in event_list:
+        vehicle_id = event["vehicle_id"]
+        time = event["detection_time"]
+        for detection in event["detections"]:
+            if detection["object_type"] not in OBJECT_TYPES:
+                raise ValueError(f"Invalid object type: {detection['object_type']}")
+            columns["vehicle_id"].append(vehicle_id)
+            columns["type"].append(detection["object_type"])
+            columns["value"].append(float(detection["object_value"]))
+            columns["timestamp"].append(time)
+
+    return columns
+
+
+@stage("vehicles")
+def resolve_vehicles(vehicle_ids, session):
+    """
+    Make sure all the given vehicle IDs exist in the vehicles table.
+    IDs that were already seen by this process are skipped without any database traffic.
+    The rest are added using a single INSERT ... ON CONFLICT DO NOTHING,
+    and then verified using a single SELECT ... WHERE id IN (...).
+    Does not commit the session, so the newly resolved IDs are returned
+    and should be given to remember_vehicles() only after the session is committed.
+
+    Parameters
+    ----------
+    vehicle_ids: iterable of str
+        The IDs of the vehicles that need to exist in the database.
+        May contain repeated IDs (e.g., one per row of a file).
+    session: sqlalchemy.orm.session.Session
+        The session to use for the database connection.
+
+    Returns
+    -------
+    new_ids: list of str
+        The vehicle IDs that were not in the cache and had to be resolved against the database.
+    """
+    vehicle_ids = set(vehicle_ids)
+    with _known_vehicles_lock:
+        for vid in vehicle_ids.intersection(_known_vehicles):
+            _known_vehicles.move_to_end(vid)
+        new_ids = sorted(vehicle_ids.difference(_known_vehicles))  # sorted, so concurrent inserts lock in order
+
+    if len(new_ids) == 0:
+        return new_ids
+
+    session.execute(pg_insert(Vehicle).values([{"id": vid} for vid in new_ids]).on_conflict_do_nothing())
+    found_ids = set(session.scalars(sa.select(Vehicle.id).where(Vehicle.id.in_(new_ids))).all())
+    if len(found_ids) != len(new_ids):
+        raise RuntimeError(f"Could not find or create vehicles: {sorted(set(new_ids) - found_ids)}")
+
+    return new_ids
+
+
+def remember_vehicles(vehicle_ids):
+    """
+    Add the given vehicle IDs to the in-process cache of vehicles known to exist in the database.
+    The least recently used IDs are dropped when the cache grows beyond VEHICLE_CACHE_SIZE.
+    Only call this after the session that created the vehicles was committed.
+    """
+    with _known_vehicles_lock:
+        for vid in vehicle_ids:
+            _known_vehicles[vid] = True
+            _known_vehicles.move_to_end(vid)
+        while len(_known_vehicles) > VEHICLE_CACHE_SIZE:
+            _known_vehicles.popitem(last=False)
+
+
+def forget_vehicles(vehicle_ids=None):
+    """
+    Remove the given vehicle IDs from the in-process cache of known vehicles.
+    If vehicle_ids is None, clear the entire cache.
+    Deleting Vehicle objects through the ORM does this automatically,
+    but this must be called after deleting vehicles using raw SQL or Core statements.
+    """
+    with _known_vehicles_lock:
+        if vehicle_ids is None:
+            _known_vehicles.clear()
+        else:
+            for vid in vehicle_ids:
+                _known_vehicles.pop(vid, None)
+
+
+@sa.event.listens_for(Vehicle, "after_delete")
+def _forget_deleted_vehicle(mapper, connection, target):
+    forget_vehicles([target.id])
+
+
+def add_ingest_listener(listener):
+    """
+    Register a function that is called whenever ingested data is committed
+    (e.g., to invalidate cached query results, see api.query).
+    The function is called once for each table that was written, as listener(table_name, vehicle_ids, start, end),
+    with the set of vehicle IDs and the earliest and latest timestamps of the rows that were written.
+    Only ingestion in this process is reported.
+    """
+    if listener not in _ingest_listeners:
+        _ingest_listeners.append(listener)
+
+
+def remove_ingest_listener(listener):
+    """
+    Stop calling a function that was registered using add_ingest_listener().
+    """
+    if listener in _ingest_listeners:
+        _ingest_listeners.remove(listener)
+
+
+def _record_ingested(table, staging, session):
+    """
+    Keep the vehicle IDs and time range of the rows in the staging table in the session's info dictionary,
+    to be given to the ingest listeners once the session is committed (see publish_ingested()).
+    """
+    stmt = sa.select(
+        sa.func.array_agg(sa.distinct(staging.c.vehicle_id)),
+        sa.func.min(staging.c.timestamp),
+        sa.func.max(staging.c.timestamp),
+    )
+    vehicle_ids, start, end = session.execute(stmt).one()
+    ingested = session.info.setdefault("ingested", {})
+    if table.name in ingested:
+        old_ids, old_start, old_end = ingested[table.name]
+        vehicle_ids, start, end = old_ids.union(vehicle_ids), min(old_start, start), max(old_end, end)
+    ingested[table.name] = (set(vehicle_ids), start, end)
+
+
+def publish_ingested(session):
+    """
+    Tell the ingest listeners which rows were committed in this session.
+    Called by the ingest functions that commit the session (e.g., ingest_payloads() and api.async_ingest).
+    """
+    for table_name, (vehicle_ids, start, end) in session.info.pop("ingested", {}).items():
+        for listener in list(_ingest_listeners):
+            listener(table_name, vehicle_ids, start, end)
+
+
+def _finish_transaction(session, new_vehicle_ids, commit):
+    """
+    Commit the session, remember the newly created vehicles, and tell the ingest listeners what was saved.
+    If commit is False, the vehicle IDs are kept in the session's info dictionary,
+    to be remembered by whoever commits the session (see ingest_payloads()).
+    """
+    if commit:
+        with stage("commit"):
+            session.commit()
+        remember_vehicles(new_vehicle_ids)
+        publish_ingested(session)
+    else:
+        session.info.setdefault("new_vehicle_ids", []).extend(new_vehicle_ids)
+
+
+@stage("write")
+def bulk_write(table, columns, session, saved_rows=None):
+    """
+    Write column buffers into a table, skipping rows that already exist.
+    The rows are first loaded into a temporary staging table, using PostgreSQL's COPY FROM STDIN
+    when the driver supports it (psycopg2, or asyncpg when called from api.async_ingest),
+    and otherwise using a single multi-row INSERT.
+    Then they are moved into the table with a single INSERT ... SELECT ... ON CONFLICT DO NOTHING,
+    so rows that violate the table's unique natural key (i.e., duplicates) are skipped,
+    without looking up any rows one by one.
+    The created_at and modified columns are filled with the current (UTC) database time.
+    If the table is partitioned, any partitions needed for the new rows are created first.
+    The saved rows also update the tables derived from the table (the rollups and the current status of each vehicle,
+    see api.rollups) in the same statement.
+    If any ingest listeners are registered, the vehicle IDs and time range of the rows are recorded,
+    to be published when the session is committed (see add_ingest_listener()).
+    Does not commit the session.
+
+    Parameters
+    ----------
+    table: sqlalchemy.Table
+        The table to write into.
+    columns: dict
+        A dictionary of equal length lists, keyed by column name.
+    session: sqlalchemy.orm.session.Session
+        The session to use for the database connection.
+    saved_rows: list, optional
+        If given, the indices (in the column buffers) of the rows that were saved are appended to this list.
+        When a row appears more than once in the buffers, the first appearance is counted as saved.
+
+    Returns
+    -------
+    num_saved: int
+        The number of rows that were written into the table.
+    num_skipped: int
+        The number of rows that were skipped because they already exist in the table
+        (or appear more than once in the column buffers).
+    """
+    names = list(columns.keys())
+    num_rows = len(columns[names[0]]) if len(names) > 0 else 0
+    if num_rows == 0:
+        return 0, 0
+
+    # the staging table only lives in this connection and is emptied on commit
+    staging = sa.table(f"staging_{table.name}", *[sa.column(name) for name in names + ["row_index"]])
+    session.execute(
+        sa.text(
+            f"CREATE TEMP TABLE IF NOT EXISTS {staging.name} ON COMMIT DELETE ROWS AS "
+            f"SELECT {', '.join(names)}, 0::bigint AS row_index FROM {table.name} WITH NO DATA"
+        )
+    )
+
+    if saved_rows is not None:  # keep track of where each row came from
+        columns = dict(columns, row_index=range(num_rows))
+        names = names + ["row_index"]
+
+    raw_connection = session.connection().connection
+    driver_connection = raw_connection.driver_connection
+    cursor = raw_connection.cursor()
+    try:
+        if hasattr(cursor, "copy_expert") or hasattr(driver_connection, "copy_to_table"):
+            buffer = io.StringIO()
+            csv.writer(buffer).writerows(zip(*(columns[name] for name in names)))
+            buffer.seek(0)
+        if hasattr(cursor, "copy_expert"):
+            cursor.copy_expert(f"COPY {staging.name} ({', '.join(names)}) FROM STDIN WITH (FORMAT csv)", buffer)
+            count_sql()
+        elif hasattr(driver_connection, "copy_to_table"):  # asyncpg, running inside AsyncSession.run_sync()
+            source = io.BytesIO(buffer.getvalue().encode())
+            await_only(driver_connection.copy_to_table(staging.name, source=source, columns=names, format="csv"))
+            count_sql()
+        else:
+            session.execute(sa.insert(staging), [dict(zip(names, row)) for row in zip(*columns.values())])
+    finally:
+        cursor.close()
+
+    if is_partitioned(table):
+        create_missing_partitions(table, staging, session)
+
+    # sort by the natural key, so concurrent writers lock the unique index entries in the same order
+    key_columns = [col.name for idx in table.indexes if idx.unique for col in idx.columns]
+    data_columns = [staging.c[name] for name in names if name != "row_index"]
+    stmt = pg_insert(table).from_select(
+        [col.name for col in data_columns] + ["created_at", "modified"],
+        sa.select(*data_columns, utcnow, utcnow).order_by(*[staging.c[name] for name in key_columns]),
+    )
+    stmt = stmt.on_conflict_do_nothing()
+
+    # the rows that were actually inserted (not the skipped duplicates) are also added to the rollup tables
+    # and the current statuses, in the same statement, using data-modifying CTEs
+    inserted = stmt.returning(*[table.c[col.name] for col in data_columns]).cte("inserted")
+    derived = [derived.cte(f"derived_{i}") for i, derived in enumerate(derived_statements(table, inserted))]
+
+    if saved_rows is None:
+        num_saved = session.scalar(sa.select(sa.func.count()).select_from(inserted).add_cte(*derived))
+    else:  # match the inserted rows back to the staging table, to find their indices
+        match = sa.and_(*[staging.c[name] == inserted.c[name] for name in key_columns])
+        indices = sa.select(sa.func.min(staging.c.row_index)).select_from(staging.join(inserted, match))
+        indices = indices.group_by(*[staging.c[name] for name in key_columns]).add_cte(*derived)
+        indices = session.scalars(indices).all()
+        saved_rows.extend(indices)
+        num_saved = len(indices)
+
+    if num_saved > 0 and len(_ingest_listeners) > 0:
+        _record_ingested(table, staging, session)
+
+    # in case another batch is written in the same transaction (TRUNCATE is much slower for small batches)
+    session.execute(sa.delete(staging))
+
+    return num_saved, num_rows - num_saved
+
+
+def resolve_and_write(table, columns, session, saved_rows=None):
+    """
+    Make sure the vehicles of the rows exist (see resolve_vehicles()), and write the rows (see bulk_write()).
+    The rows are written inside a savepoint. If they fail with a foreign key violation,
+    one of the vehicles in the cache was deleted (e.g., by another process),
+    so the vehicles of the rows are removed from the cache, resolved again against the database,
+    and the rows are written once more.
+    Does not commit the session.
+
+    Returns
+    -------
+    new_ids: list of str
+        The vehicle IDs that had to be resolved against the database (see resolve_vehicles()).
+    num_saved: int
+        The number of rows that were written into the table.
+    num_skipped: int
+        The number of rows that were skipped because they already exist in the table.
+    """
+    if len(columns["vehicle_id"]) == 0:
+        return [], 0, 0
+
+    new_ids = resolve_vehicles(columns["vehicle_id"], session)
+    num_indices = len(saved_rows) if saved_rows is not None else 0
+    savepoint = session.begin_nested()
+    try:
+        num_saved, num_skipped = bulk_write(table, columns, session, saved_rows=saved_rows)
+        savepoint.commit()
+    except sa.exc.IntegrityError as e:
+        savepoint.rollback()
+        if getattr(e.orig, "pgcode", None) != FOREIGN_KEY_VIOLATION:
+            raise
+        if saved_rows is not None:
+            del saved_rows[num_indices:]
+        forget_vehicles(set(columns["vehicle_id"]))
+        new_ids = sorted(set(new_ids).union(resolve_vehicles(columns["vehicle_id"], session)))
+        num_saved, num_skipped = bulk_write(table, columns, session, saved_rows=saved_rows)
+
+    return new_ids, num_saved, num_skipped
+
+
+def objects_to_columns(objects, names):
+    """
+    Turn a list of ORM objects into column buffers that can be given to bulk_write().
+    """
+    return {name: [getattr(obj, name) for obj in objects] for name in names}
+
+
+def ingest(data, session=None, bulk=True, instrument=False):
     """
     Read the content of a string of data (JSON formatted), verify that the data is compatible,
     and save it into the database.
@@ -62,6 +443,12 @@ def ingest(data, session=None):
     session: sqlalchemy.orm.session.Session, optional
         A session to use for the database connection. If not given, a new session will be created.
         If a new session is created, it will also be closed at the end of the call.
+    bulk: bool
+        If True (default), the data is turned into column buffers and written using COPY,
+        which is much faster for large files. If False, one ORM object is created (and validated) per row.
+    instrument: bool
+        If True, measure the time spent in each stage of the ingestion, and count the SQL statements
+        and database round trips, adding them to the status report (see api.metrics.record_metrics()).
 
     Returns
     -------
@@ -76,28 +463,292 @@ def ingest(data, session=None):
             The number of reports saved into the database.
         - detections saved: int
             The number of detections saved into the database.
+        - reports skipped: int
+            The number of reports that were not saved because they already exist in the database.
+        - detections skipped: int
+            The number of detections that were not saved because they already exist in the database.
+        If instrument is True, it also contains the timings, sql statements, sql round trips
+        and rows per second (see api.metrics.record_metrics()).
     """
     status_report = make_empty_status()
 
     try:
+        with record_metrics(status_report, enabled=instrument):
+            try:
+                data_dict = json.loads(data)
+            except Exception:
+                status_report["status"] = "failure"
+                status_report["errors"].append(f"Could not parse data: {traceback.format_exc()}")
+                return  # will go to finally and return the status_report from there
+
+            ingest_data(data_dict, status_report, session=session, bulk=bulk)
+
+    finally:
+        return status_report  # will accumulate errors along the way
+
+
+def ingest_data(data_dict, status_report=None, session=None, bulk=True, commit=True):
+    """
+    Save data that was already parsed from JSON into the database.
+    The dictionary can contain a list of reports (under "vehicle_status")
+    and/or a list of detection events (under "objects_detection_events").
+    Any other keys are ignored.
+
+    Parameters
+    ----------
+    data_dict: dict
+        The parsed content of a file or stream of data.
+    status_report: dict, optional
+        A dictionary with a report on success/failure and any errors.
+        If not given, a new one is created.
+    session: sqlalchemy.orm.session.Session, optional
+        A session to use for the database connection. If not given, a new session will be created.
+        If a new session is created, it will also be closed at the end of the call.
+    bulk: bool
+        If True (default), write all rows at once using COPY. If False, create one ORM object per row.
+    commit: bool
+        If True (default), commit the session after saving the reports and after saving the detections.
+        If False, the caller must commit the session.
+
+    Returns
+    -------
+    status_report: dict
+        The same status report that was given (or a new one), with the results of the ingestion.
+    """
+    if status_report is None:
+        status_report = make_empty_status()
+
+    if not isinstance(data_dict, dict):
+        status_report["status"] = "failure"
+        status_report["errors"].append(f"Data must be a dictionary, got {type(data_dict)} instead.")
+        return status_report
+
+    # are we allowing a file to have both detections and reports? if not, turn into an if-else
+    if "vehicle_status" in data_dict.keys():  # we got a file with status reports:
+        ingest_reports(data_dict["vehicle_status"], status_report, session=session, bulk=bulk, commit=commit)
+    if "objects_detection_events" in data_dict.keys():
+        events = data_dict["objects_detection_events"]
+        ingest_detections(events, status_report, session=session, bulk=bulk, commit=commit)
+
+    return status_report
+
+
+def ingest_payloads(payloads, session=None, bulk=True):
+    """
+    Save several payloads (e.g., from different clients) into the database in a single transaction,
+    so they all share one commit, instead of committing each payload separately.
+    Each payload is validated separately, so an invalid payload fails without affecting the others.
+    In bulk mode, the rows of all the valid payloads are written together (one COPY per table).
+    If that fails in the database (e.g., because of a timestamp that cannot be parsed),
+    the payloads are written again one by one, each inside its own savepoint,
+    so only the payload that caused the failure is rolled back.
+
+    Parameters
+    ----------
+    payloads: list
+        A list of payloads, each either a JSON formatted string (as given to ingest()),
+        or a dictionary that was already parsed (as given to ingest_data()).
+    session: sqlalchemy.orm.session.Session, optional
+        A session to use for the database connection. If not given, a new session will be created.
+        If a new session is created, it will also be closed at the end of the call.
+    bulk: bool
+        If True (default), write the rows using COPY. If False, create one ORM object per row.
+
+    Returns
+    -------
+    statuses: list of dict
+        One status report per payload, in the same order as the payloads.
+        If the final commit fails, all the reports are marked as failed.
+    """
+    statuses = [make_empty_status() for _ in payloads]
+
+    parsed = []
+    for payload, status_report in zip(payloads, statuses):
+        if isinstance(payload, (str, bytes)):
+            try:
+                payload = json.loads(payload)
+            except Exception:
+                status_report["status"] = "failure"
+                status_report["errors"].append(f"Could not parse data: {traceback.format_exc()}")
+                continue
+        parsed.append((payload, status_report))
+
+    try:
+        with SmartSession(session) as session:
+            new_vehicle_ids = session.info.setdefault("new_vehicle_ids", [])
+            merged = False
+            if bulk:
+                savepoint = session.begin_nested()
+                try:
+                    _ingest_merged(parsed, session)
+                    savepoint.commit()
+                    merged = True
+                except Exception:
+                    savepoint.rollback()
+                    del new_vehicle_ids[:]
+
+            if not merged:
+                for payload, status_report in parsed:
+                    status_report.update(make_empty_status())  # start over, without the results of the merged write
+                    num_new_vehicles = len(new_vehicle_ids)
+                    savepoint = session.begin_nested()
+                    ingest_data(payload, status_report, session=session, bulk=bulk, commit=False)
+                    if status_report["status"] == "success":
+                        savepoint.commit()
+                    else:
+                        savepoint.rollback()
+                        del new_vehicle_ids[num_new_vehicles:]  # these vehicles were rolled back
+                        _clear_counts(status_report)
+
+            with stage("commit"):
+                session.commit()
+            remember_vehicles(session.info.pop("new_vehicle_ids"))
+            publish_ingested(session)
+
+    except Exception:
+        for status_report in statuses:
+            status_report["status"] = "failure"
+            status_report["errors"].append(f"Could not commit data: {traceback.format_exc()}")
+            _clear_counts(status_report)
+
+    return statuses
+
+
+def _ingest_merged(parsed, session):
+    """
+    Validate each of the parsed payloads, and write the rows of all the valid ones
+    with a single bulk_write() per table. Payloads that fail validation are marked as failed.
+    The saved and skipped counts of each payload are filled according to which of its rows were saved.
+    Raises an exception if the database rejects the merged rows, in which case the counts are not valid.
+    """
+    report_columns = {"vehicle_id": [], "status": [], "timestamp": []}
+    detection_columns = {"vehicle_id": [], "type": [], "value": [], "timestamp": []}
+    report_owners = []  # for each row, the status report of the payload it came from
+    detection_owners = []
+
+    for payload, status_report in parsed:
+        if not isinstance(payload, dict):
+            status_report["status"] = "failure"
+            status_report["errors"].append(f"Data must be a dictionary, got {type(payload)} instead.")
+            continue
+        try:
+            reports = reports_to_columns(payload.get("vehicle_status", []))
+        except Exception:
+            status_report["status"] = "failure"
+            status_report["errors"].append(f"Could not parse reports: {traceback.format_exc()}")
+            continue
         try:
-            data_dict = json.loads(data)
+            detections = detections_to_columns(payload.get("objects_detection_events", []))
         except Exception:
             status_report["status"] = "failure"
-            status_report["errors"].append(f"Could not parse data: {traceback.format_exc()}")
-            return  # will go to finally and return the status_report from there
+            status_report["errors"].append(f"Could not parse detections: {traceback.format_exc()}")
+            continue
+
+        for columns, new_columns, owners in [
+            (report_columns, reports, report_owners),
+            (detection_columns, detections, detection_owners),
+        ]:
+            for name in columns:
+                columns[name].extend(new_columns[name])
+            owners.extend([status_report] * len(new_columns["vehicle_id"]))
+
+    new_vehicle_ids = session.info.setdefault("new_vehicle_ids", [])
+    for table, columns, owners, kind in [
+        (Report.__table__, report_columns, report_owners, "reports"),
+        (Detection.__table__, detection_columns, detection_owners, "detections"),
+    ]:
+        saved_rows = []
+        new_ids, _, _ = resolve_and_write(table, columns, session, saved_rows=saved_rows)
+        new_vehicle_ids.extend(new_ids)
+        saved_rows = set(saved_rows)
+        for i, status_report in enumerate(owners):
+            status_report[f"{kind} saved" if i in saved_rows else f"{kind} skipped"] += 1
 
-        # are we allowing a file to have both detections and reports? if not, turn into an if-else
-        if "vehicle_status" in data_dict.keys():  # we got a file with status reports:
-            ingest_reports(data_dict["vehicle_status"], status_report, session=session)
-        if "objects_detection_events" in data_dict.keys():
-            ingest_detections(data_dict["objects_detection_events"], status_report, session=session)
+
+def _clear_counts(status_report):
+    """
+    Set all the saved/skipped counts of a status report to zero, after its data was rolled back.
+    """
+    for key in ["reports saved", "detections saved", "reports skipped", "detections skipped"]:
+        status_report[key] = 0
+
+
+def ingest_file(source, session=None, bulk=True, chunk_size=10000, instrument=False):
+    """
+    Read a JSON file (or stream) element by element, and save it into the database
+    in chunks of a fixed number of rows, so memory use does not grow with the file size.
+    The file has the same format as the data given to ingest().
+    Each chunk is committed separately, so if one chunk fails,
+    the chunks before it are still saved in the database.
+    Returns a dictionary with a report on success/failure and any errors.
+
+    Parameters
+    ----------
+    source: str, os.PathLike or file-like object
+        A path to a JSON file, or an open (binary or text) stream.
+    session: sqlalchemy.orm.session.Session, optional
+        A session to use for the database connection. If not given, a new session will be created.
+        If a new session is created, it will also be closed at the end of the call.
+    bulk: bool
+        If True (default), write each chunk using COPY. If False, create one ORM object per row.
+    chunk_size: int
+        Number of rows (reports or detections) to accumulate before saving them to the database.
+    instrument: bool
+        If True, add the timings and SQL counters to the status report (see ingest()).
+
+    Returns
+    -------
+    status_report: dict
+        A dictionary with a report on success/failure and any errors.
+        Has the same keys as the output of ingest().
+    """
+    status_report = make_empty_status()
+    with record_metrics(status_report, enabled=instrument):
+        _ingest_stream(source, status_report, session=session, bulk=bulk, chunk_size=chunk_size)
+
+    return status_report
+
+
+def _ingest_stream(source, status_report, session=None, bulk=True, chunk_size=10000):
+    """
+    Read the items of a JSON file or stream and save them in chunks (see ingest_file()).
+    """
+    reports = []
+    events = []
+    num_detections = 0
+
+    try:
+        for key, item in iter_json_items(source):
+            if key == "vehicle_status":
+                reports.append(item)
+                if len(reports) >= chunk_size:
+                    ingest_reports(reports, status_report, session=session, bulk=bulk)
+                    reports = []
+            elif key == "objects_detection_events":
+                events.append(item)
+                num_detections += len(item.get("detections", []))
+                if num_detections >= chunk_size:
+                    ingest_detections(events, status_report, session=session, bulk=bulk)
+                    events = []
+                    num_detections = 0
+
+            if status_report["status"] != "success":
+                return  # will go to finally and return the status_report from there
+
+        if len(reports) > 0:
+            ingest_reports(reports, status_report, session=session, bulk=bulk)
+        if len(events) > 0 and status_report["status"] == "success":
+            ingest_detections(events, status_report, session=session, bulk=bulk)
+
+    except Exception:
+        status_report["status"] = "failure"
+        status_report["errors"].append(f"Could not parse data: {traceback.format_exc()}")
 
     finally:
         return status_report  # will accumulate errors along the way
 
 
-def ingest_reports(report_list, status_report=None, session=None):
+def ingest_reports(report_list, status_report=None, session=None, bulk=True, commit=True):
     """
     Ingest a list of status reports into the database.
 
@@ -117,6 +768,10 @@ def ingest_reports(report_list, status_report=None, session=None):
     session: sqlalchemy.orm.session.Session, optional
         A session to use for the database connection. If not given, a new session will be created.
         If a new session is created, it will also be closed at the end of the call.
+    bulk: bool
+        If True (default), write all rows at once using COPY. If False, create one ORM object per row.
+    commit: bool
+        If True (default), commit the session after saving. If False, the caller must commit the session.
 
     Returns
     -------
@@ -125,31 +780,39 @@ def ingest_reports(report_list, status_report=None, session=None):
     try:
         if status_report is None:
             status_report = make_empty_status()
+        if bulk:
+            _ingest_reports_bulk(report_list, status_report, session=session, commit=commit)
+            return
+
         with SmartSession(session) as session:
-            for report in report_list:
-                try:
-                    vehicle = get_vehicle(report["vehicle_id"], session=session)
-                    # TODO: this would be a great place to check for duplicates!
-                    db_report = Report(
-                        vehicle=vehicle,
-                        status=report["status"],
-                        timestamp=report["report_time"],
-                    )
-                    session.add(db_report)
-                    status_report["reports saved"] += 1
-                except Exception:
-                    status_report["status"] = "failure"
-                    status_report["errors"].append(f"Could not save report: {traceback.format_exc()}")
-                    return
+            with stage("validate"):
+                db_reports = []
+                for report in report_list:
+                    try:
+                        db_report = Report(
+                            vehicle_id=report["vehicle_id"],
+                            status=report["status"],
+                            timestamp=report["report_time"],
+                        )
+                        db_reports.append(db_report)
+                    except Exception:
+                        status_report["status"] = "failure"
+                        status_report["errors"].append(f"Could not save report: {traceback.format_exc()}")
+                        return
 
-            session.commit()
+            # duplicates are skipped by the database, instead of adding the objects to the session
+            columns = objects_to_columns(db_reports, ["vehicle_id", "status", "timestamp"])
+            new_vehicle_ids, num_saved, num_skipped = resolve_and_write(Report.__table__, columns, session)
+            _finish_transaction(session, new_vehicle_ids, commit)
+            status_report["reports saved"] += num_saved
+            status_report["reports skipped"] += num_skipped
 
     except Exception:
         status_report["status"] = "failure"
         status_report["errors"].append(f"Could not save reports: {traceback.format_exc()}")
 
 
-def ingest_detections(event_list, status_report=None, session=None):
+def ingest_detections(event_list, status_report=None, session=None, bulk=True, commit=True):
     """
     Ingest a list of events, each containing a list of detections that go into the database.
 
@@ -173,6 +836,10 @@ def ingest_detections(event_list, status_report=None, session=None):
     session: sqlalchemy.orm.session.Session, optional
         A session to use for the database connection. If not given, a new session will be created.
         If a new session is created, it will also be closed at the end of the call.
+    bulk: bool
+        If True (default), write all rows at once using COPY. If False, create one ORM object per row.
+    commit: bool
+        If True (default), commit the session after saving. If False, the caller must commit the session.
 
     Returns
     -------
@@ -182,34 +849,82 @@ def ingest_detections(event_list, status_report=None, session=None):
     try:
         if status_report is None:
             status_report = make_empty_status()
+        if bulk:
+            _ingest_detections_bulk(event_list, status_report, session=session, commit=commit)
+            return
+
         with SmartSession(session) as session:
-            for event in event_list:
-                try:
-                    vehicle = get_vehicle(event["vehicle_id"], session=session)
-                    time = event["detection_time"]
-                    for detection in event["detections"]:
-                        try:
-                            # TODO: this would be a great place to check for duplicates!
-                            db_detection = Detection(
-                                vehicle=vehicle,
-                                type=detection["object_type"],
-                                value=detection["object_value"],
-                                timestamp=time,
-                            )
-                            session.add(db_detection)
-                            status_report["detections saved"] += 1
-                        except Exception:
-                            status_report["status"] = "failure"
-                            status_report["errors"].append(f"Could not save detection: {traceback.format_exc()}")
-                            return
+            with stage("validate"):
+                db_detections = []
+                for event in event_list:
+                    try:
+                        time = event["detection_time"]
+                        for detection in event["detections"]:
+                            try:
+                                db_detection = Detection(
+                                    vehicle_id=event["vehicle_id"],
+                                    type=detection["object_type"],
+                                    value=detection["object_value"],
+                                    timestamp=time,
+                                )
+                                db_detections.append(db_detection)
+                            except Exception:
+                                status_report["status"] = "failure"
+                                status_report["errors"].append(f"Could not save detection: {traceback.format_exc()}")
+                                return
 
-                except Exception:
-                    status_report["status"] = "failure"
-                    status_report["errors"].append(f"Could not save event: {traceback.format_exc()}")
-                    return
+                    except Exception:
+                        status_report["status"] = "failure"
+                        status_report["errors"].append(f"Could not save event: {traceback.format_exc()}")
+                        return
 
-            session.commit()
+            # duplicates are skipped by the database, instead of adding the objects to the session
+            columns = objects_to_columns(db_detections, ["vehicle_id", "type", "value", "timestamp"])
+            new_vehicle_ids, num_saved, num_skipped = resolve_and_write(Detection.__table__, columns, session)
+            _finish_transaction(session, new_vehicle_ids, commit)
+            status_report["detections saved"] += num_saved
+            status_report["detections skipped"] += num_skipped
 
     except Exception:
         status_report["status"] = "failure"
         status_report["errors"].append(f"Could not save reports: {traceback.format_exc()}")
+
+
+def _ingest_reports_bulk(report_list, status_report, session=None, commit=True):
+    """
+    Bulk version of ingest_reports(), writing all reports of the list using COPY.
+    Nothing is saved if any of the reports is invalid.
+    """
+    try:
+        columns = reports_to_columns(report_list)
+    except Exception:
+        status_report["status"] = "failure"
+        status_report["errors"].append(f"Could not parse reports: {traceback.format_exc()}")
+        return
+
+    with SmartSession(session) as session:
+        new_vehicle_ids, num_saved, num_skipped = resolve_and_write(Report.__table__, columns, session)
+        _finish_transaction(session, new_vehicle_ids, commit)
+
+    status_report["reports saved"] += num_saved
+    status_report["reports skipped"] += num_skipped
+
+
+def _ingest_detections_bulk(event_list, status_report, session=None, commit=True):
+    """
+    Bulk version of ingest_detections(), writing all detections of all events using COPY.
+    Nothing is saved if any of the events or detections is invalid.
+    """
+    try:
+        columns = detections_to_columns(event_list)
+    except Exception:
+        status_report["status"] = "failure"
+        status_report["errors"].append(f"Could not parse detections: {traceback.format_exc()}")
+        return
+
+    with SmartSession(session) as session:
+        new_vehicle_ids, num_saved, num_skipped = resolve_and_write(Detection.__table__, columns, session)
+        _finish_transaction(session, new_vehicle_ids, commit)
+
+    status_report["detections saved"] += num_saved
+    status_report["detections skipped"] += num_skipped
@@ -0,0 +1,158 @@
+import json
+import codecs
+
+WHITESPACE = " \t\n\r"
+NUMBER_CHARS = "0123456789+-.eE"
+
+
+class JsonStreamReader:
+    """
+    Read a JSON document from a stream, one block at a time,
+    so only a small part of the document is ever held in memory.
+    The document must be a dictionary at the top level.
+    The elements of any list values of that dictionary are parsed
+    and returned one by one, without loading the entire list.
+    """
+
+    def __init__(self, stream, block_size=2**16):
+        """
+        Parameters
+        ----------
+        stream: file-like object
+            A binary (UTF-8 encoded) or text stream with the JSON document.
+        block_size: int
+            Number of bytes (or characters) to read from the stream at a time.
+        """
+        self.stream = stream
+        self.block_size = block_size
+        self.decoder = json.JSONDecoder()
+        self.text_decoder = codecs.getincrementaldecoder("utf-8-sig")()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        """
+        Read another block from the stream into the buffer,
+        dropping the part of the buffer that was already parsed.
+        """
+        data = self.stream.read(self.block_size)
+        if isinstance(data, bytes):
+            text = self.text_decoder.decode(data, final=len(data) == 0)
+        else:
+            text = data
+        self.buffer = self.buffer[self.pos :] + text
+        self.pos = 0
+        if len(data) == 0:
+            self.eof = True
+
+    def peek(self):
+        """
+        Skip any whitespace and return the next character, without consuming it.
+        Returns an empty string at the end of the stream.
+        """
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer) or self.eof:
+                break
+            self.fill()
+
+        return self.buffer[self.pos : self.pos + 1]
+
+    def expect(self, chars):
+        """
+        Consume the next non-whitespace character, making sure it is one of the given characters.
+        Returns the character that was consumed.
+        """
+        char = self.peek()
+        if char == "" or char not in chars:
+            raise ValueError(f"Expected one of {list(chars)} but got {char!r} in JSON stream.")
+        self.pos += 1
+
+        return char
+
+    def read_value(self):
+        """
+        Parse the next JSON value (of any type) from the stream.
+        If the value is not complete in the buffer, read more blocks until it is.
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+                self.fill()
+                continue
+
+            # a number may continue in the next block (e.g., "-1." and then "5e-7")
+            is_number = isinstance(value, (int, float)) and not isinstance(value, bool)
+            if is_number and not self.eof and self.buffer[end:].lstrip(NUMBER_CHARS) == "":
+                self.fill()
+                continue
+
+            self.pos = end
+            return value
+
+    def items(self):
+        """
+        Iterate over the top-level dictionary of the document.
+        For each list value, yields one (key, element) pair per element of the list.
+        Values that are not lists are parsed and skipped.
+        """
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+
+        while True:
+            key = self.read_value()
+            if not isinstance(key, str):
+                raise ValueError(f"Expected a string key but got {key!r} in JSON stream.")
+            self.expect(":")
+
+            if self.peek() == "[":
+                self.pos += 1
+                if self.peek() == "]":
+                    self.pos += 1
+                else:
+                    while True:
+                        yield key, self.read_value()
+                        if self.expect(",]") == "]":
+                            break
+            else:
+                self.read_value()
+
+            if self.expect(",}") == "}":
+                break
+
+        if self.peek() != "":
+            raise ValueError("Extra data after the end of the JSON document.")
+
+
+def iter_json_items(source, block_size=2**16):
+    """
+    Iterate over the elements of the lists in a JSON document,
+    reading the document from a file or stream in fixed-size blocks.
+
+    Parameters
+    ----------
+    source: str, bytes, os.PathLike or file-like object
+        A path to a JSON file, or an open (binary or text) stream.
+    block_size: int
+        Number of bytes to read from the file at a time.
+
+    Yields
+    ------
+    key: str
+        The key in the top-level dictionary of the list this element belongs to.
+    element: object
+        One element of that list, parsed into python objects.
+    """
+    if hasattr(source, "read"):
+        yield from JsonStreamReader(source, block_size=block_size).items()
+    else:
+        with open(source, "rb") as stream:
+            yield from JsonStreamReader(stream, block_size=block_size).items()
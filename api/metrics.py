@@ -0,0 +1,286 @@
+"""
+Opt-in instrumentation of the ingestion: the time spent in each stage, and the number of SQL statements
+and database round trips, recorded into the status report (see record_metrics()),
+and aggregate counters and histograms of many ingest calls, exported in the Prometheus text format
+(see IngestMetrics and serve_metrics(), used by the watcher).
+"""
+import time
+import bisect
+import threading
+import contextvars
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import sqlalchemy as sa
+
+# the stages of an ingest call that are timed (see record_metrics())
+INGEST_STAGES = ["parse", "validate", "vehicles", "write", "commit"]
+
+# upper bounds (in seconds) of the buckets of the duration histograms
+DURATION_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+_current_record = contextvars.ContextVar("ingest_metrics", default=None)
+
+# the SQL statements are only counted while any ingest call is measured (see _enable_sql_counting())
+_sql_counting_lock = threading.Lock()
+_sql_counting_users = 0
+
+
+class MetricsRecord:
+    """
+    The measurements of a single instrumented ingest call (see record_metrics()).
+    """
+
+    def __init__(self):
+        self.timings = {}
+        self.statements = 0
+        self.round_trips = 0
+
+
+@contextmanager
+def record_metrics(status_report, enabled=True):
+    """
+    Measure the ingestion done inside this context, and add the results to the status report:
+    - timings: a dictionary with the wall time (in seconds) of each stage and the total:
+      * parse: reading and parsing the JSON, and anything else that is not in one of the other stages
+        (e.g., opening a session).
+      * validate: checking the data and turning it into columns (or ORM objects).
+      * vehicles: making sure the vehicles exist in the database.
+      * write: writing the rows into the database (COPY and INSERT, or the ORM flush).
+      * commit: committing the transaction.
+    - sql statements: the number of SQL statements sent to the database (including COPY).
+    - sql round trips: the number of times the database was waited for,
+      i.e., the statements plus each BEGIN, COMMIT and ROLLBACK.
+    - rows per second: the number of reports and detections (saved or skipped), divided by the total time.
+    Only the database calls made in this thread (or asyncio task) are counted.
+    If this context is used inside another one (e.g., ingest() calls other ingest functions),
+    only the outer one records the results.
+
+    Parameters
+    ----------
+    status_report: dict
+        The status report of the ingestion (see api.ingest.make_empty_status()).
+    enabled: bool
+        If False, nothing is measured (so callers can make the instrumentation optional).
+    """
+    if not enabled or _current_record.get() is not None:
+        yield
+        return
+
+    record = MetricsRecord()
+    token = _current_record.set(record)
+    _enable_sql_counting()
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        total = time.perf_counter() - t0
+        _disable_sql_counting()
+        _current_record.reset(token)
+        record.timings["parse"] = max(0.0, total - sum(record.timings.values()))
+        status_report["timings"] = {name: round(record.timings.get(name, 0.0), 6) for name in INGEST_STAGES}
+        status_report["timings"]["total"] = round(total, 6)
+        status_report["sql statements"] = record.statements
+        status_report["sql round trips"] = record.round_trips
+        rows = sum(
+            status_report.get(f"{kind} {result}", 0)
+            for kind in ["reports", "detections"]
+            for result in ["saved", "skipped"]
+        )
+        status_report["rows per second"] = round(rows / total, 1) if total > 0 else 0.0
+
+
+@contextmanager
+def stage(name):
+    """
+    Add the time spent inside this context to the given stage of the ingest call being measured.
+    Does nothing if the ingestion is not measured (see record_metrics()).
+    """
+    record = _current_record.get()
+    if record is None:
+        yield
+        return
+
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        record.timings[name] = record.timings.get(name, 0.0) + time.perf_counter() - t0
+
+
+def count_sql(statements=1, round_trips=1):
+    """
+    Count database calls that are not made through SQLAlchemy's cursor execution (e.g., a COPY),
+    for the ingest call being measured (see record_metrics()).
+    """
+    record = _current_record.get()
+    if record is not None:
+        record.statements += statements
+        record.round_trips += round_trips
+
+
+def _count_statement(conn, cursor, statement, parameters, context, executemany):
+    count_sql()
+
+
+def _count_transaction(conn):
+    count_sql(statements=0)
+
+
+# the engine events that count the SQL statements and round trips
+SQL_COUNTING_EVENTS = [
+    ("before_cursor_execute", _count_statement),
+    ("begin", _count_transaction),
+    ("commit", _count_transaction),
+    ("rollback", _count_transaction),
+]
+
+
+def _enable_sql_counting():
+    """
+    Start counting the SQL statements of all engines, when the first ingest call is measured,
+    so uninstrumented ingest calls (and any other use of the engines) do not pay for the event listeners.
+    """
+    global _sql_counting_users
+    with _sql_counting_lock:
+        if _sql_counting_users == 0:
+            for name, listener in SQL_COUNTING_EVENTS:
+                sa.event.listen(sa.engine.Engine, name, listener)
+        _sql_counting_users += 1
+
+
+def _disable_sql_counting():
+    """
+    Stop counting the SQL statements, once no ingest call is measured anymore.
+    """
+    global _sql_counting_users
+    with _sql_counting_lock:
+        _sql_counting_users -= 1
+        if _sql_counting_users == 0:
+            for name, listener in SQL_COUNTING_EVENTS:
+                sa.event.remove(sa.engine.Engine, name, listener)
+
+
+def escape_label_value(value):
+    """
+    Escape a label value for the Prometheus text format (backslashes, double quotes and newlines).
+    """
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class IngestMetrics:
+    """
+    Counters and histograms that summarize the status reports of many ingest calls (e.g., all files of a watcher),
+    which can be rendered in the Prometheus text format (see render() and serve_metrics()).
+    The timings and SQL counters are only available for status reports of instrumented calls
+    (see record_metrics()). Can be updated from several threads.
+    """
+
+    def __init__(self, prefix="mobileye_ingest", buckets=DURATION_BUCKETS):
+        self.prefix = prefix
+        self.buckets = list(buckets)
+        self.lock = threading.Lock()
+        self.counters = {}  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [counts per bucket (the last is +Inf), sum]
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe_value(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        counts, total = self.histograms.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.histograms[key] = (counts, total + value)
+
+    def observe(self, status_report):
+        """
+        Add the results of an ingest call to the metrics.
+        """
+        with self.lock:
+            self.increment("calls_total", status=status_report["status"])
+            for kind in ["reports", "detections"]:
+                for result in ["saved", "skipped"]:
+                    self.increment("rows_total", status_report.get(f"{kind} {result}", 0), table=kind, result=result)
+
+            if "timings" in status_report:
+                self.observe_value("duration_seconds", status_report["timings"]["total"])
+                for name in INGEST_STAGES:
+                    self.observe_value("stage_duration_seconds", status_report["timings"][name], stage=name)
+                self.increment("sql_statements_total", status_report["sql statements"])
+                self.increment("sql_round_trips_total", status_report["sql round trips"])
+
+    def render(self):
+        """
+        Get all the metrics in the Prometheus text exposition format.
+        """
+
+        def labels_string(labels, **extra):
+            labels = list(labels) + list(extra.items())
+            if len(labels) == 0:
+                return ""
+            return "{" + ",".join(f'{key}="{escape_label_value(value)}"' for key, value in labels) + "}"
+
+        lines = []
+        with self.lock:
+            for name in sorted({name for name, _ in self.counters}):
+                lines.append(f"# TYPE {self.prefix}_{name} counter")
+                for (other, labels), value in sorted(self.counters.items()):
+                    if other == name:
+                        lines.append(f"{self.prefix}_{name}{labels_string(labels)} {value}")
+
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f"# TYPE {self.prefix}_{name} histogram")
+                for (other, labels), (counts, total) in sorted(self.histograms.items()):
+                    if other != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(self.buckets + ["+Inf"], counts):
+                        cumulative += count
+                        lines.append(f"{self.prefix}_{name}_bucket{labels_string(labels, le=bound)} {cumulative}")
+                    lines.append(f"{self.prefix}_{name}_sum{labels_string(labels)} {total}")
+                    lines.append(f"{self.prefix}_{name}_count{labels_string(labels)} {cumulative}")
+
+        return "\n".join(lines) + "\n"
+
+
+def serve_metrics(metrics, port, host="127.0.0.1"):
+    """
+    Serve the metrics in the Prometheus text format, on GET requests to /metrics,
+    from a background thread. Call shutdown() on the returned server to stop it.
+
+    Parameters
+    ----------
+    metrics: IngestMetrics
+        The metrics to serve.
+    port: int
+        The port to listen on. Use 0 to pick any free port (see server.server_address).
+    host: str
+        The address to listen on.
+
+    Returns
+    -------
+    http.server.ThreadingHTTPServer
+        The running server.
+    """
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):  # do not print a line for each scrape
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
@@ -1,23 +1,374 @@
+import json
+import time
+import base64
+import datetime
+import threading
+from collections import OrderedDict
+
+import numpy as np
 import sqlalchemy as sa
 
 from models.base import SmartSession
-from models.reports import Report
-from models.detections import Detection
+from models.reports import Report, REPORT_STATUSES
+from models.detections import Detection, OBJECT_TYPES
 from models.vehicles import Vehicle
+from models.current_status import CurrentStatus
+
+from api.ingest import add_ingest_listener
+
+# maximal number of results kept in the query cache, and for how many seconds each result can be reused
+QUERY_CACHE_SIZE = 1000
+QUERY_CACHE_TTL = 60.0
+
+_query_cache = OrderedDict()  # used as an LRU cache of query results, keyed by the table and the normalized criteria
+_query_cache_lock = threading.Lock()
+_query_cache_generation = 0  # incremented on each invalidation, so results of queries that overlap it are not cached
+
+# the orders of the results of the query functions: by time, ascending or descending (ties are broken by the id)
+ORDERS = ["timestamp", "-timestamp"]
+
+
+def known_values(values, allowed):
+    """
+    Turn the values used to filter an enum column (a single string, or a list) into a list,
+    without the values that are not allowed: they match nothing anyway,
+    and the database cannot compare its enum with strings that are not part of it.
+    Returns None if values is None (no filtering).
+    """
+    if values is None:
+        return None
+    if isinstance(values, str):
+        values = [values]
+
+    return [v for v in values if v in allowed]
 
 
 def get_vehicle(vehicle_id, session=None):
     """
     Get a vehicle by its ID.
     """
-    with SmartSession(session) as session:
+    with SmartSession(session, role="read") as session:
         vehicle = session.scalars(sa.select(Vehicle).where(Vehicle.id == vehicle_id)).first()
         return vehicle
 
 
-def get_reports(statuses=None, start_time=None, end_time=None, vehicle_id=None, session=None):
+def get_fleet(vehicle_ids, start_time=None, end_time=None, reports=True, detections=True, session=None):
+    """
+    Get many vehicles together with their reports and detections, using one query per table
+    (three queries in total, no matter how many vehicles), instead of lazy loading
+    the reports and detections of each vehicle separately (two more queries per vehicle).
+
+    Parameters
+    ----------
+    vehicle_ids : list of str
+        The IDs of the vehicles to get. IDs that are not in the database are skipped.
+    start_time : datetime.datetime, optional
+        Only load the reports and detections made after this time. If None, do not filter by start time.
+    end_time : datetime.datetime, optional
+        Only load the reports and detections made before this time. If None, do not filter by end time.
+    reports : bool
+        If True (default), load the reports of the vehicles. If False, they are lazy loaded as usual.
+    detections : bool
+        If True (default), load the detections of the vehicles. If False, they are lazy loaded as usual.
+    session : sqlalchemy.orm.session.Session, optional
+        A session to use for the database connection. If not given, a new session will be created.
+        If a new session is created, it will also be closed at the end of the call,
+        and the reports and detections of the vehicles can still be used (without lazy loading them).
+
+    Returns
+    -------
+    list of Vehicle
+        The vehicles, in the same order as the given IDs.
+        Their reports and detections are sorted by time, and only include the ones in the time range,
+        so they should be treated as read-only (adding or removing items would change the database).
+    """
+    vehicle_ids = list(dict.fromkeys(vehicle_ids))  # remove repeated IDs, but keep the order
+    if len(vehicle_ids) == 0:
+        return []
+
+    loaded = []
+    if reports:
+        loaded.append(("reports", Report, reports_statement(start_time=start_time, end_time=end_time)))
+    if detections:
+        loaded.append(("detections", Detection, detections_statement(start_time=start_time, end_time=end_time)))
+
+    with SmartSession(session, role="read") as session:
+        vehicles = session.scalars(sa.select(Vehicle).where(Vehicle.id.in_(vehicle_ids))).all()
+        vehicles = {vehicle.id: vehicle for vehicle in vehicles}
+
+        for name, model, stmt in loaded:
+            if len(vehicles) == 0:
+                break
+            # only the vehicles that were loaded (not any that were added since the vehicles query)
+            stmt = stmt.where(model.vehicle_id.in_(list(vehicles))).order_by(model.timestamp, model.id)
+            children = {vid: [] for vid in vehicles}
+            for child in session.scalars(stmt):
+                children[child.vehicle_id].append(child)
+                sa.orm.attributes.set_committed_value(child, "vehicle", vehicles[child.vehicle_id])
+            for vid, vehicle in vehicles.items():  # as if these were loaded from the database by the relationship
+                sa.orm.attributes.set_committed_value(vehicle, name, children[vid])
+
+        return [vehicles[vid] for vid in vehicle_ids if vid in vehicles]
+
+
+def reports_statement(statuses=None, start_time=None, end_time=None, vehicle_id=None):
+    """
+    Build the select statement for reports matching the given criteria.
+    See get_reports() for the parameters.
+    """
+    statuses = known_values(statuses, REPORT_STATUSES)
+
+    stmt = sa.select(Report)
+    if statuses is not None:
+        stmt = stmt.where(Report.status.in_(statuses))
+    # compare the bare column to the times, so the planner can skip partitions outside the range
+    if start_time is not None:
+        stmt = stmt.where(Report.timestamp >= start_time)
+    if end_time is not None:
+        stmt = stmt.where(Report.timestamp <= end_time)
+    if vehicle_id is not None:
+        stmt = stmt.where(Report.vehicle_id == vehicle_id)
+
+    return stmt
+
+
+def detections_statement(
+    types=None,
+    exact_values=None,
+    value_minimum=None,
+    value_maximum=None,
+    start_time=None,
+    end_time=None,
+    vehicle_id=None,
+):
+    """
+    Build the select statement for detections matching the given criteria.
+    See get_detections() for the parameters.
+    """
+    types = known_values(types, OBJECT_TYPES)
+    if isinstance(exact_values, float):
+        exact_values = [exact_values]
+
+    stmt = sa.select(Detection)
+    if types is not None:
+        stmt = stmt.where(Detection.type.in_(types))
+    if exact_values is not None:
+        stmt = stmt.where(Detection.value.in_(exact_values))
+    if value_minimum is not None:
+        stmt = stmt.where(Detection.value >= value_minimum)
+    if value_maximum is not None:
+        stmt = stmt.where(Detection.value <= value_maximum)
+    # compare the bare column to the times, so the planner can skip partitions outside the range
+    if start_time is not None:
+        stmt = stmt.where(Detection.timestamp >= start_time)
+    if end_time is not None:
+        stmt = stmt.where(Detection.timestamp <= end_time)
+    if vehicle_id is not None:
+        stmt = stmt.where(Detection.vehicle_id == vehicle_id)
+
+    return stmt
+
+
+def get_current_statuses(statuses=None, vehicle_ids=None, session=None):
+    """
+    Get the latest status of each vehicle, from the table of current statuses that is kept up to date
+    when reports are ingested (see models.current_status), instead of scanning all the reports.
+    For example, get_current_statuses("accident") finds the vehicles that are in an accident right now.
+
+    Parameters
+    ----------
+    statuses : str or list of str, optional
+        Only get vehicles whose latest status is one of these. If None, get vehicles with any status.
+    vehicle_ids : str or list of str, optional
+        Only get the statuses of these vehicles. If None, get all the vehicles that have any reports.
+
+    Returns
+    -------
+    list of CurrentStatus
+        One object per vehicle (with the vehicle_id, status and timestamp of its latest report),
+        sorted by vehicle ID.
+    """
+    statuses = known_values(statuses, REPORT_STATUSES)
+    if isinstance(vehicle_ids, str):
+        vehicle_ids = [vehicle_ids]
+
+    stmt = sa.select(CurrentStatus).order_by(CurrentStatus.vehicle_id)
+    if statuses is not None:
+        stmt = stmt.where(CurrentStatus.status.in_(statuses))
+    if vehicle_ids is not None:
+        stmt = stmt.where(CurrentStatus.vehicle_id.in_(vehicle_ids))
+
+    with SmartSession(session, role="read") as session:
+        return session.scalars(stmt).all()
+
+
+def normalize_time(value):
+    """
+    Turn a time given as an ISO formatted string or a datetime into a naive datetime (in UTC),
+    the way it is compared to the timestamps in the database,
+    so the same time given in different ways has the same cache key.
+    Returns the value unchanged if it cannot be parsed.
+    """
+    if isinstance(value, str):
+        try:  # the database ignores the time zone of a string compared to a timestamp
+            return datetime.datetime.fromisoformat(value).replace(tzinfo=None)
+        except ValueError:
+            return value
+    if isinstance(value, datetime.datetime) and value.tzinfo is not None:
+        return value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+    return value
+
+
+def _cache_key(table_name, vehicle_id, start_time, end_time, **criteria):
+    """
+    Make a (hashable) cache key out of the criteria of a query.
+    Lists of values are sorted, so the same criteria in a different order share a key.
+    """
+    items = []
+    for name, value in sorted(criteria.items()):
+        if isinstance(value, str):
+            value = (value,)
+        elif isinstance(value, (list, tuple, set)):
+            value = tuple(sorted(set(value)))
+        items.append((name, value))
+
+    return table_name, vehicle_id, normalize_time(start_time), normalize_time(end_time), tuple(items)
+
+
+def _cached_query(key, query, cache):
+    """
+    Run a query (a function without arguments that returns a list),
+    or return a copy of its cached result if it is still valid.
+    The result is cached only if no ingested data was committed while the query was running.
+    """
+    if not cache:
+        return query()
+
+    add_ingest_listener(invalidate_query_cache)  # only pay for tracking ingested rows once the cache is used
+
+    try:
+        hash(key)
+    except TypeError:  # e.g., a numpy array as one of the criteria
+        return query()
+
+    with _query_cache_lock:
+        entry = _query_cache.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            _query_cache.move_to_end(key)
+            return list(entry[1])
+        generation = _query_cache_generation
+
+    results = query()
+
+    with _query_cache_lock:
+        if generation == _query_cache_generation:
+            _query_cache[key] = (time.monotonic() + QUERY_CACHE_TTL, results)
+            _query_cache.move_to_end(key)
+            while len(_query_cache) > QUERY_CACHE_SIZE:
+                _query_cache.popitem(last=False)
+
+    return list(results)
+
+
+def invalidate_query_cache(table_name=None, vehicle_ids=None, start_time=None, end_time=None):
+    """
+    Remove the cached query results that could include rows of the given table,
+    belonging to any of the given vehicles, with timestamps between start_time and end_time.
+    Arguments that are None match everything (e.g., call with no arguments to clear the whole cache).
+    This is called automatically after data is ingested by this process (see api.ingest.add_ingest_listener()).
+    Data changed in any other way (e.g., by another process) is only seen after the cached results expire,
+    unless this is called explicitly.
+    """
+    global _query_cache_generation
+
+    start_time = normalize_time(start_time)
+    end_time = normalize_time(end_time)
+
+    with _query_cache_lock:
+        _query_cache_generation += 1
+        for key in list(_query_cache):
+            table, vehicle_id, start, end, _ = key
+            if table_name is not None and table != table_name:
+                continue
+            if vehicle_ids is not None and vehicle_id is not None and vehicle_id not in vehicle_ids:
+                continue
+            # times that could not be parsed are treated as unbounded
+            if isinstance(start, datetime.datetime) and end_time is not None and start > end_time:
+                continue
+            if isinstance(end, datetime.datetime) and start_time is not None and end < start_time:
+                continue
+            del _query_cache[key]
+
+
+def make_cursor(obj, order_by="timestamp"):
+    """
+    Get an opaque cursor pointing after the given report or detection (usually the last one of a page),
+    that can be given to get_reports() or get_detections(), with the same order_by, to get the next page.
+    """
+    if order_by not in ORDERS:
+        raise ValueError(f"Unknown order: {order_by}. Use one of {ORDERS}.")
+    data = json.dumps([order_by, obj.timestamp.isoformat(), obj.id])
+
+    return base64.urlsafe_b64encode(data.encode()).decode()
+
+
+def order_statement(stmt, model, order_by=None, limit=None, cursor=None):
+    """
+    Sort the results of a select statement on reports or detections by (timestamp, id),
+    start after the position of a cursor (see make_cursor()), and limit the number of results.
+    Since the cursor is turned into a condition on (timestamp, id), instead of an OFFSET,
+    which is matched by an index (see models.indexes), getting a deep page costs the same as getting the first one.
+    If a cursor is given without order_by, the order of the cursor is used.
+    """
+    if cursor is not None:
+        try:
+            cursor_order, timestamp, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            timestamp = datetime.datetime.fromisoformat(timestamp)
+        except Exception:
+            raise ValueError(f"Invalid cursor: {cursor}")
+        if order_by is None:
+            order_by = cursor_order
+        if order_by != cursor_order:
+            raise ValueError(f"The cursor was made for order {cursor_order}, not {order_by}.")
+
+    if order_by is not None:
+        if order_by not in ORDERS:
+            raise ValueError(f"Unknown order: {order_by}. Use one of {ORDERS}.")
+        descending = order_by.startswith("-")
+        if cursor is not None:
+            keys = sa.tuple_(model.timestamp, model.id)
+            position = sa.tuple_(sa.literal(timestamp, sa.DateTime), sa.literal(row_id, sa.BigInteger))
+            # the condition on the bare timestamp column lets the planner skip partitions before the cursor
+            if descending:
+                stmt = stmt.where(keys < position, model.timestamp <= timestamp)
+            else:
+                stmt = stmt.where(keys > position, model.timestamp >= timestamp)
+        if descending:
+            stmt = stmt.order_by(model.timestamp.desc(), model.id.desc())
+        else:
+            stmt = stmt.order_by(model.timestamp, model.id)
+
+    if limit is not None:
+        stmt = stmt.limit(limit)
+
+    return stmt
+
+
+def get_reports(
+    statuses=None,
+    start_time=None,
+    end_time=None,
+    vehicle_id=None,
+    order_by=None,
+    limit=None,
+    cursor=None,
+    cache=False,
+    session=None,
+):
     """
     Get reports matching the given criteria.
+    All the matching reports are loaded into memory. For very large results, use iter_reports() instead.
 
     Parameters
     ----------
@@ -27,23 +378,33 @@ def get_reports(statuses=None, start_time=None, end_time=None, vehicle_id=None,
         Match reports that were made after this time. If None, do not filter by start time.
     end_time : datetime.datetime, optional
         Match reports that were made before this time. If None, do not filter by end time.
+    order_by : str, optional
+        Sort the reports by "timestamp" (oldest first) or "-timestamp" (newest first),
+        with ties broken by the report ID. If None, the order is not defined.
+    limit : int, optional
+        The maximal number of reports to get. If None, get all the matching reports.
+    cursor : str, optional
+        Only get the reports after this position in the order, given by make_cursor(),
+        usually with the last report of the previous page. For example:
+        >>> page = get_reports(vehicle_id=vid, order_by="timestamp", limit=100)
+        >>> next_page = get_reports(vehicle_id=vid, order_by="timestamp", limit=100, cursor=make_cursor(page[-1]))
+    cache : bool
+        If True, reuse the results of an earlier call with the same criteria,
+        as long as they are not older than QUERY_CACHE_TTL seconds,
+        and no data that could match the criteria was ingested since (see invalidate_query_cache()).
+        The cached reports are shared between callers, and should not be modified.
+        The cache is only used when no session is given.
     """
-    if isinstance(statuses, str):
-        statuses = [statuses]
+    stmt = reports_statement(statuses=statuses, start_time=start_time, end_time=end_time, vehicle_id=vehicle_id)
+    stmt = order_statement(stmt, Report, order_by=order_by, limit=limit, cursor=cursor)
 
-    with SmartSession(session) as session:
-        stmt = sa.select(Report)
-        if statuses is not None:
-            stmt = stmt.where(Report.status.in_(statuses))
-        if start_time is not None:
-            stmt = stmt.where(Report.timestamp >= start_time)
-        if end_time is not None:
-            stmt = stmt.where(Report.timestamp <= end_time)
-        if vehicle_id is not None:
-            stmt = stmt.where(Report.vehicle_id == vehicle_id)
-        reports = session.scalars(stmt).all()
+    def query():
+        with SmartSession(session, role="read") as s:
+            return s.scalars(stmt).all()
 
-        return reports
+    paging = dict(order_by=order_by, limit=limit, cursor=cursor)
+    key = _cache_key("reports", vehicle_id, start_time, end_time, statuses=statuses, **paging)
+    return _cached_query(key, query, cache and session is None)
 
 
 def get_detections(
@@ -54,10 +415,15 @@ def get_detections(
     start_time=None,
     end_time=None,
     vehicle_id=None,
+    order_by=None,
+    limit=None,
+    cursor=None,
+    cache=False,
     session=None,
 ):
     """
     Get detections matching the given criteria.
+    All the matching detections are loaded into memory. For very large results, use iter_detections() instead.
 
     Parameters
     ----------
@@ -73,29 +439,236 @@ def get_detections(
         Match detections that were made after this time. If None, do not filter by start time.
     end_time : datetime.datetime, optional
         Match detections that were made before this time. If None, do not filter by end time.
+    order_by : str, optional
+        Sort the detections by "timestamp" or "-timestamp" (see get_reports()).
+    limit : int, optional
+        The maximal number of detections to get. If None, get all the matching detections.
+    cursor : str, optional
+        Only get the detections after this position in the order, given by make_cursor() (see get_reports()).
+    cache : bool
+        If True, reuse the results of an earlier call with the same criteria (see get_reports()).
     """
-    if isinstance(types, str):
-        types = [types]
-    if isinstance(exact_values, float):
-        exact_values = [exact_values]
+    stmt = detections_statement(
+        types=types,
+        exact_values=exact_values,
+        value_minimum=value_minimum,
+        value_maximum=value_maximum,
+        start_time=start_time,
+        end_time=end_time,
+        vehicle_id=vehicle_id,
+    )
+    stmt = order_statement(stmt, Detection, order_by=order_by, limit=limit, cursor=cursor)
+
+    def query():
+        with SmartSession(session, role="read") as s:
+            return s.scalars(stmt).all()
+
+    key = _cache_key(
+        "detections",
+        vehicle_id,
+        start_time,
+        end_time,
+        types=types,
+        exact_values=exact_values,
+        value_minimum=value_minimum,
+        value_maximum=value_maximum,
+        order_by=order_by,
+        limit=limit,
+        cursor=cursor,
+    )
+    return _cached_query(key, query, cache and session is None)
+
+
+DETECTION_COLUMNS = ["timestamp", "vehicle_id", "type", "value", "id"]
+
+
+def get_detections_columns(
+    columns=None,
+    types=None,
+    exact_values=None,
+    value_minimum=None,
+    value_maximum=None,
+    start_time=None,
+    end_time=None,
+    vehicle_id=None,
+    session=None,
+):
+    """
+    Get some columns of the detections matching the given criteria, as numpy arrays.
+    This selects only the requested columns, and does not create any ORM objects,
+    so it is much faster than get_detections() for analyzing many detections.
+    Accepts the same criteria as get_detections().
+
+    Parameters
+    ----------
+    columns: list of str, optional
+        The columns to get, out of "timestamp", "vehicle_id", "type", "value" and "id".
+        Defaults to all of them except "id".
+
+    Returns
+    -------
+    dict
+        A dictionary with one array per column (all with the same length, one element per detection):
+        - timestamp: datetime64[us] array.
+        - vehicle_id: array of strings (dtype object).
+        - type: int8 array of codes, where each code is the index of the type in models.detections.OBJECT_TYPES.
+        - value: float64 array.
+        - id: int64 array.
+    """
+    if columns is None:
+        columns = ["timestamp", "vehicle_id", "type", "value"]
+    unknown = [c for c in columns if c not in DETECTION_COLUMNS]
+    if unknown:
+        raise ValueError(f"Unknown columns: {unknown}. Use any of {DETECTION_COLUMNS}.")
+
+    stmt = detections_statement(
+        types=types,
+        exact_values=exact_values,
+        value_minimum=value_minimum,
+        value_maximum=value_maximum,
+        start_time=start_time,
+        end_time=end_time,
+        vehicle_id=vehicle_id,
+    )
+
+    table = Detection.__table__
+    selected = []
+    for name in columns:
+        if name == "timestamp":  # microseconds since the epoch, as an integer (much faster than datetime objects)
+            # date_part() returns a double, which is much faster to compute than the numeric returned by extract()
+            selected.append(sa.cast(sa.func.date_part("epoch", table.c.timestamp) * 1_000_000, sa.BigInteger))
+        elif name == "type":  # the index of the type in OBJECT_TYPES
+            # compared with the column (not given as value=), so the names are bound as the enum type
+            selected.append(sa.case(*[(table.c.type == t, i) for i, t in enumerate(OBJECT_TYPES)]))
+        else:
+            selected.append(table.c[name])
+
+    with SmartSession(session, role="read") as session:
+        connection = session.connection()
+        stmt = stmt.with_only_columns(*selected)
+        if connection.dialect.driver == "psycopg2":
+            # run the query directly on the driver's cursor, which returns plain tuples,
+            # without the overhead of building and processing sqlalchemy rows
+            compiled = stmt.compile(dialect=connection.dialect, compile_kwargs={"render_postcompile": True})
+            cursor = connection.connection.cursor()
+            try:
+                cursor.execute(str(compiled), compiled.params)
+                rows = cursor.fetchall()
+            finally:
+                cursor.close()
+        else:  # other drivers (e.g., asyncpg) use other parameter styles, and need sqlalchemy's typed parameters
+            rows = connection.execute(stmt).all()
+
+    values = list(zip(*rows)) if len(rows) > 0 else [()] * len(columns)
+    arrays = {}
+    for name, column in zip(columns, values):
+        if name == "timestamp":
+            arrays[name] = np.fromiter(column, dtype=np.int64, count=len(column)).view("datetime64[us]")
+        elif name == "vehicle_id":
+            arrays[name] = np.array(column, dtype=object)
+        elif name == "type":
+            arrays[name] = np.fromiter(column, dtype=np.int8, count=len(column))
+        elif name == "value":
+            arrays[name] = np.fromiter(column, dtype=np.float64, count=len(column))
+        else:
+            arrays[name] = np.fromiter(column, dtype=np.int64, count=len(column))
+
+    return arrays
+
+
+def iter_results(stmt, chunk_size=1000, chunks=False, session=None):
+    """
+    Run a select statement and yield its results a few at a time, using a server-side cursor,
+    so only chunk_size rows are held in memory at once, no matter how many rows match.
+
+    If no session is given, a new session is opened when iteration starts,
+    and closed when the iteration ends, or when the generator is closed
+    (e.g., by breaking out of a for loop, and letting the generator be garbage collected).
+    The yielded objects are still usable after that, but lazy loading their relationships
+    requires them to be attached to another session (or use an external session).
+    If a session is given, the caller must not use it for other queries until the iteration is done.
+
+    Parameters
+    ----------
+    stmt: sqlalchemy.sql.Select
+        The statement to run.
+    chunk_size: int
+        Number of rows to fetch from the database at a time.
+    chunks: bool
+        If True, yield lists of (up to) chunk_size objects, instead of one object at a time.
+    session: sqlalchemy.orm.session.Session, optional
+        A session to use for the database connection. If not given, a new session will be created.
+
+    Yields
+    ------
+    object or list of objects
+        The ORM objects matching the statement, one at a time (or one chunk at a time).
+    """
+    with SmartSession(session, role="read") as session:
+        result = session.scalars(stmt.execution_options(yield_per=chunk_size))  # implies stream_results
+        try:
+            if chunks:
+                yield from result.partitions()
+            else:
+                yield from result
+        finally:
+            result.close()  # releases the server-side cursor if the iteration was stopped early
+
+
+def iter_reports(
+    statuses=None,
+    start_time=None,
+    end_time=None,
+    vehicle_id=None,
+    chunk_size=1000,
+    chunks=False,
+    session=None,
+):
+    """
+    Iterate over the reports matching the given criteria, with constant memory use.
+    Accepts the same criteria as get_reports(), and the chunk_size, chunks and session
+    parameters of iter_results().
+
+    Yields
+    ------
+    Report or list of Report
+        The matching reports, one at a time (or one chunk at a time).
+    """
+    stmt = reports_statement(statuses=statuses, start_time=start_time, end_time=end_time, vehicle_id=vehicle_id)
+
+    return iter_results(stmt, chunk_size=chunk_size, chunks=chunks, session=session)
+
+
+def iter_detections(
+    types=None,
+    exact_values=None,
+    value_minimum=None,
+    value_maximum=None,
+    start_time=None,
+    end_time=None,
+    vehicle_id=None,
+    chunk_size=1000,
+    chunks=False,
+    session=None,
+):
+    """
+    Iterate over the detections matching the given criteria, with constant memory use.
+    Accepts the same criteria as get_detections(), and the chunk_size, chunks and session
+    parameters of iter_results().
+
+    Yields
+    ------
+    Detection or list of Detection
+        The matching detections, one at a time (or one chunk at a time).
+    """
+    stmt = detections_statement(
+        types=types,
+        exact_values=exact_values,
+        value_minimum=value_minimum,
+        value_maximum=value_maximum,
+        start_time=start_time,
+        end_time=end_time,
+        vehicle_id=vehicle_id,
+    )
 
-    with SmartSession(session) as session:
-        stmt = sa.select(Detection)
-        if types is not None:
-            stmt = stmt.where(Detection.type.in_(types))
-        if exact_values is not None:
-            stmt = stmt.where(Detection.value.in_(exact_values))
-        if value_minimum is not None:
-            stmt = stmt.where(Detection.value >= value_minimum)
-        if value_maximum is not None:
-            stmt = stmt.where(Detection.value <= value_maximum)
-        if start_time is not None:
-            stmt = stmt.where(Detection.timestamp >= start_time)
-        if end_time is not None:
-            stmt = stmt.where(Detection.timestamp <= end_time)
-        if vehicle_id is not None:
-            stmt = stmt.where(Detection.vehicle_id == vehicle_id)
-
-        detections = session.scalars(stmt).all()
-
-        return detections
+    return iter_results(stmt, chunk_size=chunk_size, chunks=chunks, session=session)
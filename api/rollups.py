@@ -0,0 +1,223 @@
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.postgresql import INTERVAL
+
+from models.base import SmartSession, utcnow
+from models.reports import Report
+from models.detections import Detection
+from models.rollups import DetectionRollup, ReportRollup, ROLLUP_RESOLUTIONS
+from models.current_status import CurrentStatus
+
+# for each raw table: the rollup table that summarizes it, and the category column it is grouped by
+ROLLUP_TABLES = {
+    "detections": (DetectionRollup.__table__, "type"),
+    "reports": (ReportRollup.__table__, "status"),
+}
+
+
+def rollup_statements(table, source):
+    """
+    Get the statements that add rows to the rollup tables of a raw table.
+    Each statement groups the rows of the source by vehicle, category and time bucket (one statement per resolution),
+    and adds the counts and value sums of each group to the existing rollup rows (or creates them),
+    using INSERT ... SELECT ... ON CONFLICT DO UPDATE.
+
+    Parameters
+    ----------
+    table: sqlalchemy.Table
+        The raw table (detections or reports) the rows belong to.
+    source: sqlalchemy.sql.FromClause
+        The new rows to add, e.g., a CTE of the rows that were just inserted into the table.
+        Must have the same column names as the table.
+
+    Returns
+    -------
+    list of sqlalchemy.sql.Insert
+        The statements to execute. Empty if the table does not have any rollups.
+    """
+    if table.name not in ROLLUP_TABLES:
+        return []
+
+    rollup, category = ROLLUP_TABLES[table.name]
+    statements = []
+    for resolution in ROLLUP_RESOLUTIONS:
+        bucket = sa.func.date_trunc(resolution, source.c.timestamp)
+        keys = [source.c.vehicle_id, source.c[category], bucket]
+        columns = {
+            "resolution": sa.cast(sa.literal(resolution), rollup.c.resolution.type),
+            "vehicle_id": source.c.vehicle_id,
+            category: source.c[category],
+            "bucket": bucket,
+            "count": sa.func.count(),
+        }
+        if "value_sum" in rollup.c:
+            columns.update(
+                value_sum=sa.func.sum(source.c.value),
+                value_min=sa.func.min(source.c.value),
+                value_max=sa.func.max(source.c.value),
+            )
+        columns.update(created_at=utcnow, modified=utcnow)
+
+        # sorted by the primary key, so concurrent writers lock the rollup rows in the same order
+        select = sa.select(*columns.values()).group_by(*keys).order_by(*keys)
+        stmt = pg_insert(rollup).from_select(list(columns), select)
+        updates = {"count": rollup.c.count + stmt.excluded.count, "modified": utcnow}
+        if "value_sum" in rollup.c:
+            updates.update(
+                value_sum=rollup.c.value_sum + stmt.excluded.value_sum,
+                value_min=sa.func.least(rollup.c.value_min, stmt.excluded.value_min),
+                value_max=sa.func.greatest(rollup.c.value_max, stmt.excluded.value_max),
+            )
+        statements.append(stmt.on_conflict_do_update(index_elements=rollup.primary_key.columns, set_=updates))
+
+    return statements
+
+
+def current_status_statements(table, source):
+    """
+    Get the statements that update the current status of each vehicle (see models.current_status)
+    with the latest of the given reports, unless the stored status is newer (since reports can arrive out of order).
+    When a vehicle has several reports with the same timestamp, the most severe status is kept
+    (the last one in models.reports.REPORT_STATUSES).
+
+    Parameters
+    ----------
+    table: sqlalchemy.Table
+        The raw table the rows belong to. Only the reports table has a current status.
+    source: sqlalchemy.sql.FromClause
+        The new reports, e.g., a CTE of the rows that were just inserted into the table.
+
+    Returns
+    -------
+    list of sqlalchemy.sql.Insert
+        The statements to execute. Empty if the table is not the reports table.
+    """
+    if table.name != "reports":
+        return []
+
+    current = CurrentStatus.__table__
+    latest = (
+        sa.select(source.c.vehicle_id, source.c.status, source.c.timestamp, utcnow, utcnow)
+        .distinct(source.c.vehicle_id)
+        .order_by(source.c.vehicle_id, source.c.timestamp.desc(), source.c.status.desc())
+    )
+    stmt = pg_insert(current).from_select(["vehicle_id", "status", "timestamp", "created_at", "modified"], latest)
+    newer = sa.tuple_(current.c.timestamp, current.c.status) < sa.tuple_(stmt.excluded.timestamp, stmt.excluded.status)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[current.c.vehicle_id],
+        set_={"status": stmt.excluded.status, "timestamp": stmt.excluded.timestamp, "modified": utcnow},
+        where=newer,
+    )
+
+    return [stmt]
+
+
+def derived_statements(table, source):
+    """
+    Get all the statements that update the tables derived from a raw table (the rollups and the current statuses)
+    with new rows of that table. See rollup_statements() and current_status_statements().
+    """
+    return rollup_statements(table, source) + current_status_statements(table, source)
+
+
+def backfill_rollups(start_time=None, end_time=None, session=None):
+    """
+    Recompute the rollup tables from the raw detections and reports,
+    e.g., for data that was ingested before the rollups existed.
+    Creates the rollup tables if they do not exist yet.
+    The time range is extended to whole hours, and the existing rollup rows inside it are replaced.
+    The raw tables are locked against writes until the end of the transaction,
+    so any ingestion running at the same time waits for the backfill to finish.
+
+    Parameters
+    ----------
+    start_time: str or datetime.datetime, optional
+        Only recompute the rollups from this time. If not given, start from the earliest data.
+    end_time: str or datetime.datetime, optional
+        Only recompute the rollups up to this time. If not given, continue to the latest data.
+    session: sqlalchemy.orm.session.Session, optional
+        A session to use for the database connection. If not given, a new session will be created.
+        If a new session is created, it will also be closed at the end of the call.
+
+    Returns
+    -------
+    dict
+        The number of rollup rows written into each rollup table (by table name).
+    """
+    hour = sa.literal("1 hour", INTERVAL)
+    counts = {}
+    with SmartSession(session) as session:
+        # databases created before the rollups existed also need the tables
+        for rollup, _ in ROLLUP_TABLES.values():
+            rollup.create(session.connection(), checkfirst=True)
+
+        # reports before detections, in the same order they are written by ingest_data()
+        session.execute(sa.text("LOCK TABLE reports, detections IN SHARE MODE"))
+
+        for table in [Report.__table__, Detection.__table__]:
+            rollup, category = ROLLUP_TABLES[table.name]
+            names = ["vehicle_id", category, "timestamp"] + (["value"] if "value" in table.c else [])
+            source = sa.select(*[table.c[name] for name in names])
+            delete = sa.delete(rollup)
+            if start_time is not None:
+                start = sa.func.date_trunc("hour", sa.cast(sa.literal(start_time), sa.DateTime))
+                source = source.where(table.c.timestamp >= start)
+                delete = delete.where(rollup.c.bucket >= start)
+            if end_time is not None:
+                end = sa.func.date_trunc("hour", sa.cast(sa.literal(end_time), sa.DateTime)) + hour
+                source = source.where(table.c.timestamp < end)
+                delete = delete.where(rollup.c.bucket < end)
+
+            session.execute(delete)
+            source = source.subquery("source")
+            counts[rollup.name] = sum(session.execute(stmt).rowcount for stmt in rollup_statements(table, source))
+
+        session.commit()
+
+    return counts
+
+
+def backfill_current_status(session=None):
+    """
+    Recompute the current status of all vehicles from all their reports,
+    e.g., for reports that were ingested before the current statuses were kept.
+    Creates the table if it does not exist yet.
+    The reports table is locked against writes until the end of the transaction.
+
+    Parameters
+    ----------
+    session: sqlalchemy.orm.session.Session, optional
+        A session to use for the database connection. If not given, a new session will be created.
+        If a new session is created, it will also be closed at the end of the call.
+
+    Returns
+    -------
+    int
+        The number of vehicles with a current status.
+    """
+    current = CurrentStatus.__table__
+    with SmartSession(session) as session:
+        current.create(session.connection(), checkfirst=True)
+        session.execute(sa.text("LOCK TABLE reports IN SHARE MODE"))
+        session.execute(sa.delete(current))
+        (stmt,) = current_status_statements(Report.__table__, Report.__table__)
+        num_vehicles = session.execute(stmt).rowcount
+        session.commit()
+
+    return num_vehicles
+
+
+if __name__ == "__main__":
+    import argparse
+
+    import models.vehicles  # noqa: F401 (needed to create the tables)
+
+    parser = argparse.ArgumentParser(
+        description="Recompute the rollup tables and the current status of each vehicle from the raw data."
+    )
+    parser.add_argument("--start-time", help="Only recompute the rollups from this time (e.g., 2022-01-01).")
+    parser.add_argument("--end-time", help="Only recompute the rollups up to this time.")
+    args = parser.parse_args()
+
+    print(backfill_rollups(start_time=args.start_time, end_time=args.end_time))
+    print(f"current status of {backfill_current_status()} vehicles")
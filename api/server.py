@@ -0,0 +1,319 @@
+import json
+import queue
+import asyncio
+import logging
+import argparse
+import traceback
+
+from models.partitions import create_upcoming_partitions, PARTITIONS_CHECK_INTERVAL
+from api.ingest import make_empty_status
+from api.batcher import IngestBatcher
+
+HTTP_REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    411: "Length Required",
+    413: "Payload Too Large",
+    422: "Unprocessable Entity",
+    429: "Too Many Requests",
+    500: "Internal Server Error",
+    503: "Service Unavailable",
+}
+
+DISCARD_BODY_SIZE = 64 * 1024  # bodies of requests that are answered without them are skipped up to this size
+THREAD_PARSE_SIZE = 1024**2  # bodies larger than this are parsed in a thread, so they do not block other requests
+
+logger = logging.getLogger(__name__)
+
+
+class BadRequestError(Exception):
+    """
+    A request that cannot be read (e.g., a malformed request line or Content-Length header),
+    so the rest of the connection cannot be read either. Answered with 400, and the connection is closed.
+    """
+
+
+class IngestServer:
+    """
+    An asyncio HTTP server that ingests data sent with POST requests to /ingest.
+    The body of each request has the same JSON format as the files given to api.ingest.ingest().
+
+    Concurrent requests are coalesced: they are given to an IngestBatcher, which saves
+    as many of them as it can (up to max_batch_rows rows, waiting at most max_delay seconds
+    after the first one) in one transaction.
+    Each request still gets its own status report as the JSON response.
+    When the queue is full, new requests are rejected right away with 429 (Too Many Requests),
+    and while the server is shutting down they are rejected with 503 (Service Unavailable),
+    so clients back off instead of piling up requests.
+
+    A GET request to /health returns a few counters about the server.
+
+    If the tables are partitioned, the partitions for the next few intervals are created in the background
+    while the server runs (see models.partitions.create_upcoming_partitions()),
+    so they do not have to be created while ingesting.
+    """
+
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=8080,
+        max_batch_rows=5000,
+        max_delay=0.01,
+        max_queue=1000,
+        flushers=2,
+        max_body_size=64 * 1024**2,
+    ):
+        """
+        Parameters
+        ----------
+        host: str
+            The address to listen on.
+        port: int
+            The port to listen on. Use 0 to pick any free port (see the port attribute after start()).
+        max_batch_rows: int
+            Flush a batch once it has at least this many rows (reports and detections).
+        max_delay: float
+            Flush a batch at most this many seconds after its first request arrived.
+        max_queue: int
+            Maximal number of requests waiting to be flushed, before rejecting new ones with 429.
+        flushers: int
+            Number of batches that can be written to the database concurrently
+            (each in its own thread, with its own session).
+        max_body_size: int
+            Maximal size of a request body, in bytes.
+        """
+        self.host = host
+        self.port = port
+        self.max_batch_rows = max_batch_rows
+        self.max_delay = max_delay
+        self.max_queue = max_queue
+        self.flushers = flushers
+        self.max_body_size = max_body_size
+
+        self.batcher = None
+        self.server = None
+        self.partitions_task = None
+        self.accepting = False
+
+        self.counters = {"requests": 0, "rejected": 0}
+
+    async def start(self):
+        """
+        Start listening for requests, and start the batcher that saves them.
+        """
+        self.batcher = IngestBatcher(
+            max_batch_rows=self.max_batch_rows,
+            max_delay=self.max_delay,
+            max_queue=self.max_queue,
+            flushers=self.flushers,
+        )
+        self.server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.partitions_task = asyncio.create_task(self.maintain_partitions())
+        self.accepting = True
+
+    async def stop(self):
+        """
+        Stop accepting new requests, finish ingesting the requests that are already queued, and shut down.
+        """
+        self.accepting = False
+        self.partitions_task.cancel()
+        self.server.close()
+        await asyncio.get_running_loop().run_in_executor(None, self.batcher.close)
+        await self.server.wait_closed()
+
+    async def maintain_partitions(self):
+        """
+        Create the upcoming partitions now, and again every PARTITIONS_CHECK_INTERVAL seconds.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await loop.run_in_executor(None, create_upcoming_partitions)
+            except Exception:  # the partitions are still created while ingesting, if needed
+                logger.exception("Could not create the upcoming partitions")
+            await asyncio.sleep(PARTITIONS_CHECK_INTERVAL)
+
+    async def serve_forever(self):
+        await self.start()
+        try:
+            await self.server.serve_forever()
+        finally:
+            await self.stop()
+
+    async def submit(self, payload):
+        """
+        Queue a parsed payload for ingestion and wait for its status report.
+        Raises queue.Full if the queue is full.
+        """
+        return await asyncio.wrap_future(self.batcher.submit(payload, block=False))
+
+    async def handle_connection(self, reader, writer):
+        """
+        Read HTTP/1.1 requests from a connection (possibly several, with keep-alive) and answer them.
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                parts = request_line.decode("latin-1").split()
+                if len(parts) != 3:
+                    raise BadRequestError(f"Malformed request line: {request_line[:100]!r}")
+                method, path, _ = parts
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                code, body, keep_alive = await self.handle_request(method, path, headers, reader)
+                keep_alive = keep_alive and headers.get("connection", "").lower() != "close"
+                await self.write_response(writer, code, body, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):  # the client went away
+            pass
+        except BadRequestError as e:
+            logger.warning("Bad request from %s: %s", writer.get_extra_info("peername"), e)
+            await self.try_write_response(writer, 400, {"error": str(e)})
+        except Exception:
+            logger.exception("Error while handling a request from %s", writer.get_extra_info("peername"))
+            await self.try_write_response(writer, 500, {"error": "Internal server error."})
+        finally:
+            writer.close()
+
+    async def handle_request(self, method, path, headers, reader):
+        """
+        Handle a single request.
+        Returns the HTTP status code, the (JSON serializable) response body,
+        and whether the connection can be kept open for the next request.
+        It cannot if the body of the request was not read (e.g., because it is too large),
+        since the rest of the body would then be read as the next request.
+        """
+        if path == "/health" and method == "GET":
+            body = {"status": "ok", "queued": self.batcher.queue.qsize(), **self.counters, **self.batcher.counters}
+            return 200, body, await self.discard_body(headers, reader)
+
+        if path != "/ingest":
+            return 404, {"error": f"Unknown path: {path}"}, await self.discard_body(headers, reader)
+
+        if method != "POST":
+            return 405, {"error": "Use a POST request to ingest data."}, await self.discard_body(headers, reader)
+
+        if "content-length" not in headers:
+            return 411, {"error": "Missing Content-Length header."}, await self.discard_body(headers, reader)
+        length = self.get_content_length(headers)
+        if length > self.max_body_size:
+            return 413, {"error": f"Body is larger than {self.max_body_size} bytes."}, False
+        data = await reader.readexactly(length)
+
+        self.counters["requests"] += 1
+        if not self.accepting:
+            self.counters["rejected"] += 1
+            return 503, {"error": "Server is shutting down."}, True
+
+        try:
+            if len(data) > THREAD_PARSE_SIZE:
+                payload = await asyncio.get_running_loop().run_in_executor(None, json.loads, data)
+            else:
+                payload = json.loads(data)
+        except Exception:
+            status = make_empty_status()
+            status["status"] = "failure"
+            status["errors"].append(f"Could not parse data: {traceback.format_exc()}")
+            return 400, status, True
+
+        try:
+            status = await self.submit(payload)
+        except queue.Full:
+            self.counters["rejected"] += 1
+            return 429, {"error": "Too many requests are waiting to be ingested. Try again later."}, True
+
+        return (200 if status["status"] == "success" else 422), status, True
+
+    @staticmethod
+    def get_content_length(headers):
+        """
+        Get the length of the body of a request from its Content-Length header (0 if there is no such header).
+        Raises a BadRequestError if the header is not a valid length.
+        """
+        try:
+            length = int(headers.get("content-length", 0))
+        except ValueError:
+            raise BadRequestError(f"Invalid Content-Length header: {headers['content-length'][:100]!r}")
+        if length < 0:
+            raise BadRequestError(f"Invalid Content-Length header: {length}")
+
+        return length
+
+    @classmethod
+    async def discard_body(cls, headers, reader):
+        """
+        Read and discard the body of a request that is answered without it (e.g., with 404),
+        so the next request on the connection can be read.
+        Returns False if the body was not read, because it is larger than DISCARD_BODY_SIZE,
+        or its length is not known (a chunked body without a Content-Length header),
+        in which case the connection must be closed.
+        """
+        if "content-length" not in headers and "transfer-encoding" in headers:
+            return False
+        length = cls.get_content_length(headers)
+        if length > DISCARD_BODY_SIZE:
+            return False
+        await reader.readexactly(length)
+
+        return True
+
+    @staticmethod
+    async def write_response(writer, code, body, keep_alive=True):
+        data = json.dumps(body).encode()
+        headers = [
+            f"HTTP/1.1 {code} {HTTP_REASONS.get(code, '')}",
+            "Content-Type: application/json",
+            f"Content-Length: {len(data)}",
+            f"Connection: {'keep-alive' if keep_alive else 'close'}",
+        ]
+        if code in (429, 503):
+            headers.append("Retry-After: 1")
+        writer.write(("\r\n".join(headers) + "\r\n\r\n").encode("latin-1") + data)
+        await writer.drain()
+
+    @classmethod
+    async def try_write_response(cls, writer, code, body):
+        """
+        Answer a request that failed, and close the connection, unless the client already went away.
+        """
+        try:
+            await cls.write_response(writer, code, body, keep_alive=False)
+        except ConnectionError:
+            pass
+
+
+def run_server(**kwargs):
+    """
+    Run an IngestServer until interrupted. Accepts the same arguments as IngestServer.
+    """
+    server = IngestServer(**kwargs)
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="HTTP server that ingests data sent with POST requests to /ingest.")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on.")
+    parser.add_argument("--port", type=int, default=8080, help="Port to listen on.")
+    parser.add_argument("--max-batch-rows", type=int, default=5000, help="Flush a batch once it has this many rows.")
+    parser.add_argument("--max-delay", type=float, default=0.01, help="Flush a batch after this many seconds.")
+    parser.add_argument("--max-queue", type=int, default=1000, help="Requests to queue before rejecting with 429.")
+    parser.add_argument("--flushers", type=int, default=2, help="Number of batches written concurrently.")
+    args = parser.parse_args()
+
+    run_server(**vars(args))
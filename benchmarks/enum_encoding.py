@@ -0,0 +1,95 @@
+"""
+Compare storing the detection type as a string (the old schema), as a native enum (the current schema),
+and as a smallint code.
+Fills two scratch tables with the same random detections, and reports the size of each table and its
+type index, and the time it takes to filter and group by the type. The scratch tables are dropped at the end.
+
+Usage: python -m benchmarks.enum_encoding --rows 5000000
+"""
+import time
+import argparse
+
+import sqlalchemy as sa
+
+from models.base import Session
+from models.detections import OBJECT_TYPES
+
+import models.vehicles  # noqa: F401 (needed to create the tables)
+import models.reports  # noqa: F401
+
+
+def measure(session, table, codes=False, repeats=3):
+    """
+    Get the sizes (in bytes) of a table and its type index, and the best time (in seconds) of a few queries.
+    """
+    results = {
+        "table bytes": session.scalar(sa.text(f"SELECT pg_table_size('{table}')")),
+        "type index bytes": session.scalar(sa.text(f"SELECT pg_relation_size('ix_{table}_type')")),
+    }
+    value = {t: (OBJECT_TYPES.index(t) if codes else f"'{t}'") for t in OBJECT_TYPES}
+    queries = {
+        "filter seconds": f"SELECT count(*) FROM {table} WHERE type = {value['trucks']}",
+        "group seconds": f"SELECT type, count(*) FROM {table} GROUP BY type",
+        "index scan seconds": f"SELECT count(*) FROM {table} WHERE type IN ({value['signs']}, {value['obstacles']})",
+    }
+    for name, query in queries.items():
+        session.execute(sa.text("SET enable_seqscan = " + ("off" if "index" in name else "on")))
+        best = float("inf")
+        for _ in range(repeats):
+            t0 = time.perf_counter()
+            session.execute(sa.text(query)).all()
+            best = min(best, time.perf_counter() - t0)
+        results[name] = best
+    session.execute(sa.text("RESET enable_seqscan"))
+
+    return results
+
+
+def run(rows):
+    types = ", ".join(f"'{t}'" for t in OBJECT_TYPES)
+    columns = {
+        "text": "type varchar NOT NULL",
+        "enum": "type object_type NOT NULL",
+        "smallint": "type smallint NOT NULL",
+    }
+    values = {
+        "text": f"(ARRAY[{types}])[1 + (i % {len(OBJECT_TYPES)})]",
+        "enum": f"(ARRAY[{types}])[1 + (i % {len(OBJECT_TYPES)})]::object_type",
+        "smallint": f"i % {len(OBJECT_TYPES)}",
+    }
+    results = {}
+    with Session() as session:
+        for kind, column in columns.items():
+            table = f"bench_detections_{kind}"
+            session.execute(sa.text(f"DROP TABLE IF EXISTS {table}"))
+            session.execute(sa.text(f"CREATE TABLE {table} (id bigint, {column}, value float, timestamp timestamp)"))
+            session.execute(
+                sa.text(
+                    f"INSERT INTO {table} SELECT i, {values[kind]}, random() * 100, "
+                    f"'2022-01-01'::timestamp + i * interval '1 second' FROM generate_series(1, :rows) AS i"
+                ),
+                {"rows": rows},
+            )
+            session.execute(sa.text(f"CREATE INDEX ix_{table}_type ON {table} (type)"))
+            session.commit()
+            with session.get_bind().connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+                connection.execute(sa.text(f"VACUUM ANALYZE {table}"))  # cannot run inside a transaction
+            results[kind] = measure(session, table, codes=kind == "smallint")
+
+        for kind in columns:
+            session.execute(sa.text(f"DROP TABLE bench_detections_{kind}"))
+        session.commit()
+
+    print(f"{'':20s}" + "".join(f"{kind:>14s}" for kind in columns) + "  (relative to text)")
+    for key in results["text"]:
+        print(f"{key:20s}" + "".join(f"{results[kind][key] / results['text'][key]:14.2f}" for kind in columns))
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the size and speed of storing the type as an enum.")
+    parser.add_argument("--rows", type=int, default=1_000_000, help="Number of detections in each scratch table.")
+    args = parser.parse_args()
+
+    run(args.rows)
@@ -0,0 +1,254 @@
+"""
+Generate synthetic fleet data, as drop files in the format read by api.ingest (and the watcher).
+Each of the vehicles sends one detection event every interval seconds (with a random number of detections),
+and sometimes a status report. The events are written to the files in the order they arrive:
+mostly in time order, except for a given fraction of events that are delayed (arrive out of order),
+and a given fraction that are sent twice (duplicates, which the ingestion should skip).
+
+Usage: python -m benchmarks.generate output_dir --vehicles 100 --events 1000 --detections poisson:3
+"""
+import os
+import json
+import heapq
+import argparse
+import datetime
+import itertools
+
+import numpy as np
+
+from models.reports import REPORT_STATUSES
+from models.detections import OBJECT_TYPES
+
+START_TIME = datetime.datetime(2022, 1, 1)
+
+# how often each status is reported (in the order of REPORT_STATUSES)
+STATUS_WEIGHTS = [0.3, 0.69, 0.01]
+
+
+def parse_distribution(spec):
+    """
+    Get a function that draws the number of detections of each event, from a description of its distribution:
+    - "fixed:N" (or just "N"): always N detections.
+    - "uniform:A:B": any number from A to B (inclusive), with equal probability.
+    - "poisson:L": a Poisson distribution with a mean of L.
+
+    Returns
+    -------
+    draw: callable
+        A function draw(rng, size) that returns an array of size numbers of detections.
+    mean: float
+        The mean number of detections per event.
+    """
+    name, _, params = str(spec).partition(":")
+    if params == "" and name.isdigit():
+        name, params = "fixed", name
+    params = params.split(":")
+
+    if name == "fixed" and len(params) == 1:
+        n = int(params[0])
+        return (lambda rng, size: np.full(size, n)), float(n)
+    if name == "uniform" and len(params) == 2:
+        low, high = int(params[0]), int(params[1])
+        return (lambda rng, size: rng.integers(low, high + 1, size)), (low + high) / 2
+    if name == "poisson" and len(params) == 1:
+        mean = float(params[0])
+        return (lambda rng, size: rng.poisson(mean, size)), mean
+
+    raise ValueError(f'Unknown distribution: "{spec}". Use "fixed:N", "uniform:A:B" or "poisson:L".')
+
+
+def generate_payloads(
+    vehicles=100,
+    events_per_vehicle=100,
+    detections="poisson:3",
+    report_rate=0.1,
+    out_of_order_rate=0.0,
+    duplicate_rate=0.0,
+    max_delay=1000,
+    events_per_file=1000,
+    start_time=START_TIME,
+    interval=1.0,
+    seed=42,
+    stats=None,
+):
+    """
+    Generate the content of the drop files, one payload (dictionary) at a time,
+    so any amount of data can be generated with little memory.
+
+    Parameters
+    ----------
+    vehicles: int
+        Number of vehicles in the fleet.
+    events_per_vehicle: int
+        Number of detection events sent by each vehicle.
+    detections: str
+        The distribution of the number of detections in each event (see parse_distribution()).
+    report_rate: float
+        The probability that a vehicle also sends a status report with each event.
+    out_of_order_rate: float
+        The fraction of events (and their reports) that arrive late, after up to max_delay later events.
+    duplicate_rate: float
+        The fraction of events (and their reports) that are sent again, after up to max_delay later events.
+    max_delay: int
+        The maximal number of events that arrive between a late (or repeated) event and its original place.
+    events_per_file: int
+        Number of detection events in each payload (the last payload may have less).
+    start_time: datetime.datetime
+        Time of the first event of each vehicle.
+    interval: float
+        Time in seconds between consecutive events of the same vehicle.
+    seed: int
+        Seed of the random numbers, so the same parameters always give the same data.
+    stats: dict, optional
+        If given, the numbers of events, detections, reports, delayed events and duplicate events
+        that were generated are added to this dictionary.
+
+    Yields
+    ------
+    dict
+        A payload with "objects_detection_events" and "vehicle_status" lists, as read by api.ingest.ingest_data().
+    """
+    rng = np.random.default_rng(seed)
+    draw, _ = parse_distribution(detections)
+    vehicle_ids = [f"vehicle_{i:06d}" for i in range(vehicles)]
+    if stats is None:
+        stats = {}
+    for key in ["events", "detections", "reports", "delayed", "duplicates"]:
+        stats.setdefault(key, 0)
+
+    pending = []  # heap of (position in the output, tie breaker, event, report)
+    order = itertools.count()
+    events, reports = [], []
+    position = 0
+
+    for step in range(events_per_vehicle):
+        # all the random numbers of this step are drawn at once
+        counts = draw(rng, vehicles)
+        offsets = step * interval + rng.uniform(0, interval, vehicles)
+        has_report = rng.random(vehicles) < report_rate
+        statuses = rng.choice(len(REPORT_STATUSES), vehicles, p=STATUS_WEIGHTS)
+        delays = np.where(rng.random(vehicles) < out_of_order_rate, rng.integers(1, max_delay + 1, vehicles), 0)
+        repeats = np.where(rng.random(vehicles) < duplicate_rate, rng.integers(1, max_delay + 1, vehicles), 0)
+        types = rng.integers(0, len(OBJECT_TYPES), counts.sum())
+        values = np.round(rng.uniform(0, 100, counts.sum()), 2)
+        firsts = np.cumsum(counts) - counts  # the index of the first type and value of each vehicle
+
+        for v in np.argsort(offsets):  # the events of each step arrive in time order
+            time_string = (start_time + datetime.timedelta(seconds=offsets[v])).isoformat(timespec="milliseconds") + "Z"
+            event = dict(
+                vehicle_id=vehicle_ids[v],
+                detection_time=time_string,
+                detections=[
+                    dict(object_type=OBJECT_TYPES[types[i]], object_value=float(values[i]))
+                    for i in range(firsts[v], firsts[v] + counts[v])
+                ],
+            )
+            report = None
+            if has_report[v]:
+                report = dict(vehicle_id=vehicle_ids[v], report_time=time_string, status=REPORT_STATUSES[statuses[v]])
+
+            heapq.heappush(pending, (position + delays[v], next(order), event, report))
+            if repeats[v] > 0:
+                heapq.heappush(pending, (position + repeats[v], next(order), event, report))
+
+            copies = 2 if repeats[v] > 0 else 1
+            stats["events"] += copies
+            stats["detections"] += int(counts[v]) * copies
+            stats["reports"] += copies if report is not None else 0
+            stats["delayed"] += int(delays[v] > 0)
+            stats["duplicates"] += copies - 1
+            position += 1
+
+            while len(pending) > 0 and pending[0][0] < position:
+                _, _, event, report = heapq.heappop(pending)
+                events.append(event)
+                if report is not None:
+                    reports.append(report)
+                if len(events) >= events_per_file:
+                    yield dict(vehicle_status=reports, objects_detection_events=events)
+                    events, reports = [], []
+
+    while len(pending) > 0:  # the events that were delayed past the last event
+        _, _, event, report = heapq.heappop(pending)
+        events.append(event)
+        if report is not None:
+            reports.append(report)
+        if len(events) >= events_per_file:
+            yield dict(vehicle_status=reports, objects_detection_events=events)
+            events, reports = [], []
+
+    if len(events) > 0:
+        yield dict(vehicle_status=reports, objects_detection_events=events)
+
+
+def write_drop_files(directory, prefix="fleet", **kwargs):
+    """
+    Generate synthetic fleet data (see generate_payloads()) and write it into JSON files in a directory,
+    named <prefix>_000000.json, <prefix>_000001.json, etc. (in the order they arrive).
+    Each file is written under a temporary name and then renamed,
+    so a watcher of the directory never reads a partially written file.
+
+    Parameters
+    ----------
+    directory: str
+        The directory to write the files into. Created if it does not exist.
+    prefix: str
+        The start of the file names.
+    kwargs: dict
+        The parameters of generate_payloads().
+
+    Returns
+    -------
+    dict
+        The names of the files that were written (under "files"),
+        and the numbers of events, detections, reports, delayed events and duplicate events.
+    """
+    os.makedirs(directory, exist_ok=True)
+    stats = kwargs.pop("stats", {})
+    filenames = []
+    for index, payload in enumerate(generate_payloads(stats=stats, **kwargs)):
+        filename = os.path.join(directory, f"{prefix}_{index:06d}.json")
+        with open(filename + ".tmp", "w") as f:
+            json.dump(payload, f)
+        os.replace(filename + ".tmp", filename)
+        filenames.append(filename)
+
+    return dict(stats, files=filenames)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write synthetic fleet data into JSON drop files.")
+    parser.add_argument("directory", help="Directory to write the files into.")
+    parser.add_argument("--vehicles", type=int, default=100, help="Number of vehicles in the fleet.")
+    parser.add_argument("--events", type=int, default=1000, help="Number of detection events per vehicle.")
+    parser.add_argument(
+        "--detections",
+        default="poisson:3",
+        help='Distribution of the number of detections per event: "fixed:N", "uniform:A:B" or "poisson:L".',
+    )
+    parser.add_argument("--report-rate", type=float, default=0.1, help="Probability of a report with each event.")
+    parser.add_argument("--out-of-order", type=float, default=0.0, help="Fraction of events that arrive late.")
+    parser.add_argument("--duplicates", type=float, default=0.0, help="Fraction of events that are sent twice.")
+    parser.add_argument("--max-delay", type=int, default=1000, help="Maximal delay of late events (in events).")
+    parser.add_argument("--events-per-file", type=int, default=1000, help="Number of events in each file.")
+    parser.add_argument("--interval", type=float, default=1.0, help="Seconds between events of each vehicle.")
+    parser.add_argument("--seed", type=int, default=42, help="Seed of the random numbers.")
+    parser.add_argument("--prefix", default="fleet", help="Start of the file names.")
+    args = parser.parse_args()
+
+    result = write_drop_files(
+        args.directory,
+        prefix=args.prefix,
+        vehicles=args.vehicles,
+        events_per_vehicle=args.events,
+        detections=args.detections,
+        report_rate=args.report_rate,
+        out_of_order_rate=args.out_of_order,
+        duplicate_rate=args.duplicates,
+        max_delay=args.max_delay,
+        events_per_file=args.events_per_file,
+        interval=args.interval,
+        seed=args.seed,
+    )
+    files = result.pop("files")
+    print(f"wrote {len(files)} files to {args.directory}: {result}")
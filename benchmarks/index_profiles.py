@@ -0,0 +1,124 @@
+"""
+Measure the trade-off between ingest speed and query speed of each index profile (see models.indexes).
+For each profile, the tables of a scratch database are emptied and switched to that profile,
+then the same synthetic data is ingested (timing the ingest rate) and a few typical queries are timed.
+
+Usage: python -m benchmarks.index_profiles --rows 500000
+"""
+import time
+import random
+import datetime
+import argparse
+
+import sqlalchemy as sa
+from sqlalchemy_utils import database_exists, drop_database
+
+from models.base import Session, SmartSession, configure_engine, get_engine_config
+from models.indexes import INDEX_PROFILES, apply_index_profile
+
+from api.ingest import ingest_data, forget_vehicles
+from api.query import get_detections, get_reports
+
+START_TIME = datetime.datetime(2022, 1, 1)
+
+
+def make_batches(rows, vehicles, batch_rows, seed=42):
+    """
+    Generate payloads with about the given number of detections (and one report per 10 detections),
+    from the given number of vehicles, with times that mostly increase (as they would arrive from the vehicles).
+    """
+    rng = random.Random(seed)
+    batches = []
+    for start in range(0, rows, batch_rows):
+        events, reports = [], []
+        for i in range(start, min(start + batch_rows, rows)):
+            time_string = (START_TIME + datetime.timedelta(seconds=i, milliseconds=rng.randrange(1000))).isoformat()
+            vehicle_id = f"bench_vehicle_{rng.randrange(vehicles)}"
+            detection = dict(object_type=rng.choice(["pedestrians", "cars", "signs", "trucks"]), object_value=i)
+            events.append(dict(vehicle_id=vehicle_id, detection_time=time_string, detections=[detection]))
+            if i % 10 == 0:
+                status = rng.choice(["parking", "driving", "driving", "accident"])
+                reports.append(dict(vehicle_id=vehicle_id, report_time=time_string, status=status))
+        batches.append(dict(vehicle_status=reports, objects_detection_events=events))
+
+    return batches
+
+
+def best_time(func, repeats=5):
+    best = float("inf")
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - t0)
+
+    return best
+
+
+def run(rows, vehicles, batch_rows):
+    batches = make_batches(rows, vehicles, batch_rows)
+    window = (
+        START_TIME + datetime.timedelta(seconds=rows // 2),
+        START_TIME + datetime.timedelta(seconds=rows // 2 + 600),
+    )
+    queries = {
+        "vehicle + time": lambda: get_detections(
+            vehicle_id="bench_vehicle_1", start_time=window[0], end_time=window[1]
+        ),
+        "type + time": lambda: get_detections(types="trucks", start_time=window[0], end_time=window[1]),
+        "time": lambda: get_detections(start_time=window[0], end_time=window[1]),
+        "status": lambda: get_reports(statuses="accident", start_time=window[0], end_time=window[1]),
+    }
+
+    results = {}
+    for profile in INDEX_PROFILES:
+        with SmartSession() as session:
+            session.execute(sa.text("TRUNCATE vehicles, reports, detections"))
+            session.commit()
+        forget_vehicles()
+        apply_index_profile(profile)
+
+        t0 = time.perf_counter()
+        for batch in batches:
+            ingest_data(batch)
+        results[profile] = {"ingest rows/s": rows / (time.perf_counter() - t0)}
+
+        # in production, autovacuum does this in the background (this also summarizes the BRIN indexes)
+        with Session().get_bind().connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+            connection.execute(sa.text("VACUUM ANALYZE vehicles, reports, detections"))
+
+        with SmartSession() as session:
+            results[profile]["index MB"] = session.scalar(
+                sa.text("SELECT (pg_indexes_size('detections') + pg_indexes_size('reports')) / 1e6")
+            )
+        for name, query in queries.items():
+            results[profile][f"{name} ms"] = best_time(query) * 1000
+
+    print(f"{'':20s}" + "".join(f"{profile:>12s}" for profile in results))
+    for key in results["full"]:
+        print(f"{key:20s}" + "".join(f"{results[profile][key]:12.1f}" for profile in results))
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the ingest and query speed of each index profile.")
+    parser.add_argument("--rows", type=int, default=200_000, help="Number of detections to ingest.")
+    parser.add_argument("--vehicles", type=int, default=1000, help="Number of different vehicles.")
+    parser.add_argument("--batch-rows", type=int, default=5000, help="Number of detections in each ingest call.")
+    parser.add_argument(
+        "--url",
+        default=get_engine_config()["url"].rsplit("/", 1)[0] + "/mobileye_hw_bench",
+        help="URL of a scratch database, which is dropped at the end.",
+    )
+    args = parser.parse_args()
+
+    import models.vehicles  # noqa: F401 (needed to create the tables)
+
+    configure_engine(url=args.url)
+    engine = Session().get_bind()
+    try:
+        run(args.rows, args.vehicles, args.batch_rows)
+    finally:
+        configure_engine()
+        if database_exists(args.url):
+            drop_database(args.url)
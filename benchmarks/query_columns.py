@@ -0,0 +1,79 @@
+"""
+Compare the speed (rows per second) of loading detections as ORM objects (get_detections)
+and as numpy arrays (get_detections_columns).
+The detections are generated in a scratch database, which is dropped at the end.
+
+Usage: python -m benchmarks.query_columns --rows 1000000
+"""
+import time
+import argparse
+
+import sqlalchemy as sa
+from sqlalchemy_utils import database_exists, drop_database
+
+from models.base import SmartSession, configure_engine, get_engine_config
+from models.detections import OBJECT_TYPES
+
+from api.query import get_detections, get_detections_columns, iter_detections
+
+
+def fill(rows, vehicles):
+    types = ", ".join(f"'{t}'" for t in OBJECT_TYPES)
+    with SmartSession() as session:
+        session.execute(
+            sa.text(
+                "INSERT INTO vehicles (id, created_at, modified) "
+                "SELECT 'bench_vehicle_' || i, now(), now() FROM generate_series(0, :vehicles - 1) AS i"
+            ),
+            {"vehicles": vehicles},
+        )
+        session.execute(
+            sa.text(
+                "INSERT INTO detections (vehicle_id, type, value, timestamp, created_at, modified) "
+                f"SELECT 'bench_vehicle_' || (i % :vehicles), (ARRAY[{types}])[1 + i % {len(OBJECT_TYPES)}]::object_type, "
+                "random() * 100, '2022-01-01'::timestamp + i * interval '1 second', now(), now() "
+                "FROM generate_series(1, :rows) AS i"
+            ),
+            {"rows": rows, "vehicles": vehicles},
+        )
+        session.commit()
+
+
+def run(rows, vehicles):
+    fill(rows, vehicles)
+    methods = {
+        "get_detections": lambda: len(get_detections()),
+        "iter_detections": lambda: sum(1 for _ in iter_detections(chunk_size=10_000)),
+        "get_detections_columns": lambda: len(get_detections_columns()["value"]),
+    }
+    results = {}
+    for name, method in methods.items():
+        t0 = time.perf_counter()
+        num_rows = method()
+        results[name] = num_rows / (time.perf_counter() - t0)
+        print(f"{name:25s}{results[name]:12,.0f} rows/s")
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare loading detections as ORM objects and as numpy arrays.")
+    parser.add_argument("--rows", type=int, default=500_000, help="Number of detections to load.")
+    parser.add_argument("--vehicles", type=int, default=100, help="Number of different vehicles.")
+    parser.add_argument(
+        "--url",
+        default=get_engine_config()["url"].rsplit("/", 1)[0] + "/mobileye_hw_bench",
+        help="URL of a scratch database, which is dropped at the end.",
+    )
+    args = parser.parse_args()
+
+    import models.vehicles  # noqa: F401 (needed to create the tables)
+    import models.reports  # noqa: F401
+
+    configure_engine(url=args.url)
+    try:
+        run(args.rows, args.vehicles)
+    finally:
+        configure_engine()
+        if database_exists(args.url):
+            drop_database(args.url)
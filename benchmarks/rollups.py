@@ -0,0 +1,90 @@
+"""
+Compare the speed of aggregating detections over a long time range
+from the raw detections and from the rollup tables (aggregate_detections with from_rollups=True),
+and measure how long it takes to backfill the rollups.
+The detections are generated in a scratch database, which is dropped at the end.
+
+Usage: python -m benchmarks.rollups --rows 5000000
+"""
+import time
+import argparse
+
+import numpy as np
+import sqlalchemy as sa
+from sqlalchemy_utils import database_exists, drop_database
+
+from models.base import SmartSession, configure_engine, get_engine_config
+from models.detections import OBJECT_TYPES
+
+from api.rollups import backfill_rollups
+from api.aggregate import aggregate_detections
+
+
+def fill(rows, vehicles, seconds):
+    types = ", ".join(f"'{t}'" for t in OBJECT_TYPES)
+    with SmartSession() as session:
+        session.execute(
+            sa.text(
+                "INSERT INTO vehicles (id, created_at, modified) "
+                "SELECT 'bench_vehicle_' || i, now(), now() FROM generate_series(0, :vehicles - 1) AS i"
+            ),
+            {"vehicles": vehicles},
+        )
+        session.execute(
+            sa.text(
+                "INSERT INTO detections (vehicle_id, type, value, timestamp, created_at, modified) "
+                f"SELECT 'bench_vehicle_' || (i % :vehicles), (ARRAY[{types}])[1 + i % {len(OBJECT_TYPES)}]::object_type, "
+                "random() * 100, '2022-01-01'::timestamp + i * :seconds * interval '1 second', now(), now() "
+                "FROM generate_series(1, :rows) AS i"
+            ),
+            {"rows": rows, "vehicles": vehicles, "seconds": seconds},
+        )
+        session.commit()
+
+
+def timed(name, method, repeats=3):
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        result = method()
+        times.append(time.perf_counter() - t0)
+    print(f"{name:40s}{np.median(times) * 1000:10.1f} ms")
+    return result
+
+
+def run(rows, vehicles, seconds):
+    fill(rows, vehicles, seconds)  # written directly with SQL, so the rollups are still empty
+
+    t0 = time.perf_counter()
+    counts = backfill_rollups()
+    print(f"backfill: {counts} rollup rows in {time.perf_counter() - t0:.1f} s")
+
+    for bucket, group_by in [("day", "type"), ("hour", "type"), ("hour", "vehicle_id")]:
+        kwargs = dict(bucket=bucket, group_by=group_by, aggregates=["count", "avg", "max"])
+        raw = timed(f"raw, {bucket} per {group_by}", lambda: aggregate_detections(**kwargs))
+        rollup = timed(f"rollups, {bucket} per {group_by}", lambda: aggregate_detections(from_rollups=True, **kwargs))
+        assert np.array_equal(raw["count"], rollup["count"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare aggregating raw detections and rollups.")
+    parser.add_argument("--rows", type=int, default=2_000_000, help="Number of detections to generate.")
+    parser.add_argument("--vehicles", type=int, default=20, help="Number of different vehicles.")
+    parser.add_argument("--seconds", type=float, default=1.0, help="Time between consecutive detections.")
+    parser.add_argument(
+        "--url",
+        default=get_engine_config()["url"].rsplit("/", 1)[0] + "/mobileye_hw_bench",
+        help="URL of a scratch database, which is dropped at the end.",
+    )
+    args = parser.parse_args()
+
+    import models.vehicles  # noqa: F401 (needed to create the tables)
+    import models.reports  # noqa: F401
+
+    configure_engine(url=args.url)
+    try:
+        run(args.rows, args.vehicles, args.seconds)
+    finally:
+        configure_engine()
+        if database_exists(args.url):
+            drop_database(args.url)
@@ -0,0 +1,320 @@
+"""
+Run the benchmark suite: fill a scratch database with synthetic fleet data (see benchmarks.generate)
+up to each of the given sizes, measuring the ingest rate (rows per second) of ingest() and of the watcher,
+and measure the latency (p50 and p99) of each of the query functions at each size.
+The results are written into a JSON file, together with the commit they were measured on,
+so they can be compared across commits (using --compare).
+The scratch database is dropped at the end.
+
+Usage:
+    python -m benchmarks.suite --sizes 1e5,1e6,1e7 --output results.json
+    python -m benchmarks.suite --compare old.json new.json
+"""
+import os
+import sys
+import json
+import time
+import math
+import random
+import shutil
+import argparse
+import datetime
+import tempfile
+import subprocess
+import multiprocessing
+
+import numpy as np
+import sqlalchemy as sa
+from sqlalchemy_utils import database_exists, drop_database
+
+from models.base import CODE_ROOT, SmartSession, configure_engine, get_engine_config
+from models.reports import Report
+from models.detections import Detection
+
+from api.ingest import ingest
+from api.folder_watch import watcher
+from api.query import (
+    get_vehicle,
+    get_fleet,
+    get_reports,
+    get_detections,
+    get_detections_columns,
+    get_current_statuses,
+    iter_reports,
+    iter_detections,
+)
+
+from benchmarks.generate import START_TIME, parse_distribution, write_drop_files
+
+
+def get_commit():
+    """
+    Get the current commit of the code (with "-dirty" if there are uncommitted changes), or None outside git.
+    """
+    try:
+        result = subprocess.run(
+            ["git", "describe", "--always", "--dirty"], cwd=CODE_ROOT, capture_output=True, text=True, check=True
+        )
+        return result.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def count_rows():
+    with SmartSession() as session:
+        return sum(session.scalar(sa.select(sa.func.count()).select_from(t)) for t in [Report, Detection])
+
+
+def ingest_files(filenames):
+    """
+    Ingest each file by reading it into a string and calling ingest(), as a client sending payloads would.
+    """
+    saved = skipped = 0
+    for filename in filenames:
+        with open(filename) as f:
+            status = ingest(f.read())
+        if status["status"] != "success":
+            raise RuntimeError(f"Could not ingest {filename}: {status['errors']}")
+        saved += status["reports saved"] + status["detections saved"]
+        skipped += status["reports skipped"] + status["detections skipped"]
+
+    return saved, skipped
+
+
+def watch_files(directory, workers=None, poll=0.01):
+    """
+    Run the watcher on a directory of files in a separate process,
+    until all the files are ingested (and removed from the directory).
+    """
+    process = multiprocessing.get_context("fork").Process(
+        target=watcher, kwargs=dict(working_dir=directory, workers=workers)
+    )
+    process.start()
+    try:
+        while any(name.endswith(".json") for _, _, names in os.walk(directory) for name in names):
+            if not process.is_alive():
+                raise RuntimeError(f"The watcher stopped with exit code {process.exitcode}.")
+            time.sleep(poll)
+    finally:
+        process.terminate()
+        process.join()
+
+
+def measure_ingest(method, rows, args, start_time, seed):
+    """
+    Generate drop files with about the given number of rows (detections and reports),
+    and time how long it takes to ingest them using the given method ("ingest" or "watcher").
+    The time it takes to generate the files is not included.
+
+    Returns
+    -------
+    result: dict
+        The numbers of rows in the files and of rows that were saved, the time, and the rows per second.
+    end_time: datetime.datetime
+        The time after the last generated event, where the next data should start.
+    """
+    _, mean_detections = parse_distribution(args.detections)
+    rows_per_event = (mean_detections + args.report_rate) * (1 + args.duplicates)
+    events_per_vehicle = max(1, math.ceil(rows / (args.vehicles * rows_per_event)))
+    directory = tempfile.mkdtemp(prefix=f"benchmark_{method}_")
+    try:
+        stats = write_drop_files(
+            directory,
+            prefix=method,
+            vehicles=args.vehicles,
+            events_per_vehicle=events_per_vehicle,
+            detections=args.detections,
+            report_rate=args.report_rate,
+            out_of_order_rate=args.out_of_order,
+            duplicate_rate=args.duplicates,
+            events_per_file=args.events_per_file,
+            start_time=start_time,
+            interval=args.interval,
+            seed=seed,
+        )
+        num_rows = stats["detections"] + stats["reports"]
+
+        rows_before = count_rows()
+        t0 = time.perf_counter()
+        if method == "ingest":
+            ingest_files(stats["files"])
+        else:
+            watch_files(directory, workers=args.workers)
+        seconds = time.perf_counter() - t0
+        saved = count_rows() - rows_before
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    result = dict(
+        files=len(stats["files"]),
+        rows=num_rows,
+        saved=saved,
+        seconds=round(seconds, 3),
+        rows_per_second=round(num_rows / seconds, 1),
+    )
+    end_time = start_time + datetime.timedelta(seconds=events_per_vehicle * args.interval)
+
+    return result, end_time
+
+
+def make_queries(args, end_time, seed):
+    """
+    Get a function for each query function, that calls it with typical (random) criteria:
+    a random vehicle, and a random time window of args.window seconds.
+    """
+    rng = random.Random(seed)
+    window = datetime.timedelta(seconds=args.window)
+    latest = max(START_TIME, end_time - window)
+
+    def vehicle():
+        return f"vehicle_{rng.randrange(args.vehicles):06d}"
+
+    def start():
+        return START_TIME + (latest - START_TIME) * rng.random()
+
+    def in_window(function, **kwargs):
+        t = start()
+        return function(start_time=t, end_time=t + window, **kwargs)
+
+    return {
+        "get_vehicle": lambda: get_vehicle(vehicle()),
+        "get_fleet": lambda: in_window(get_fleet, vehicle_ids=[vehicle() for _ in range(10)]),
+        "get_reports": lambda: in_window(get_reports, vehicle_id=vehicle()),
+        "get_reports latest page": lambda: get_reports(vehicle_id=vehicle(), order_by="-timestamp", limit=100),
+        "get_detections": lambda: in_window(get_detections, vehicle_id=vehicle(), types="cars"),
+        "get_detections_columns": lambda: in_window(get_detections_columns, vehicle_id=vehicle()),
+        "get_current_statuses": lambda: get_current_statuses("accident"),
+        "iter_reports": lambda: sum(1 for _ in in_window(iter_reports, vehicle_id=vehicle())),
+        "iter_detections": lambda: sum(1 for _ in in_window(iter_detections, vehicle_id=vehicle())),
+    }
+
+
+def measure_queries(queries, repeats):
+    """
+    Call each query function repeats times (after one call to warm up), and get the percentiles of the latency.
+    """
+    results = {}
+    for name, query in queries.items():
+        query()
+        latencies = []
+        for _ in range(repeats):
+            t0 = time.perf_counter()
+            query()
+            latencies.append((time.perf_counter() - t0) * 1000)
+        results[name] = dict(
+            p50_ms=round(float(np.percentile(latencies, 50)), 3),
+            p99_ms=round(float(np.percentile(latencies, 99)), 3),
+            repeats=repeats,
+        )
+
+    return results
+
+
+def run(args):
+    """
+    Run the benchmarks at each of the sizes, and get the results (see the module docstring).
+    """
+    results = dict(
+        commit=get_commit(),
+        date=datetime.datetime.utcnow().isoformat(timespec="seconds"),
+        python=sys.version.split()[0],
+        settings={k: v for k, v in vars(args).items() if k not in ("output", "compare", "url")},
+        sizes=[],
+    )
+
+    end_time = START_TIME
+    for step, size in enumerate(args.sizes):
+        rows = count_rows()
+        if size <= rows:
+            continue
+
+        print(f"filling up to {size:,} rows")
+        result = dict(size=size)
+        for i, method in enumerate(["ingest", "watcher"]):  # each method adds half of the new rows
+            new_rows = (size - rows) // 2 if i == 0 else size - count_rows()
+            result[method], end_time = measure_ingest(method, new_rows, args, end_time, args.seed + 2 * step + i)
+            print(f"  {method:30s}{result[method]['rows_per_second']:12,.0f} rows/s")
+
+        with SmartSession() as session:
+            session.execute(sa.text("ANALYZE"))
+        result["rows"] = count_rows()
+
+        result["queries"] = measure_queries(make_queries(args, end_time, args.seed + step), args.repeats)
+        for name, latency in result["queries"].items():
+            print(f"  {name:30s}{latency['p50_ms']:10.2f} ms (p50){latency['p99_ms']:10.2f} ms (p99)")
+
+        results["sizes"].append(result)
+
+    return results
+
+
+def compare(old, new):
+    """
+    Print the ingest rates and query latencies of two result files side by side, for the sizes in both.
+    """
+    print(f"{'':40s}{old['commit'] or 'old':>15s}{new['commit'] or 'new':>15s}{'ratio':>10s}")
+    old_sizes = {result["size"]: result for result in old["sizes"]}
+    for result in new["sizes"]:
+        if result["size"] not in old_sizes:
+            continue
+        before = old_sizes[result["size"]]
+        print(f"{result['size']:,} rows")
+        lines = [(method, "rows_per_second", method + " (rows/s)") for method in ["ingest", "watcher"]]
+        lines += [(name, "p50_ms", f"{name} (p50 ms)") for name in result["queries"]]
+        lines += [(name, "p99_ms", f"{name} (p99 ms)") for name in result["queries"]]
+        for name, key, label in lines:
+            old_value = before.get(name, before.get("queries", {}).get(name, {})).get(key)
+            new_value = result.get(name, result["queries"].get(name, {})).get(key)
+            if old_value is None or new_value is None:
+                continue
+            print(f"  {label:38s}{old_value:15,.2f}{new_value:15,.2f}{new_value / old_value:10.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the ingest rate and query latency at several data sizes.")
+    parser.add_argument(
+        "--sizes",
+        default="1e5,1e6",
+        help="Comma separated numbers of rows (detections and reports) to measure at, e.g., 1e5,1e6,1e7.",
+    )
+    parser.add_argument("--output", help="JSON file to write the results into (default: benchmark_<commit>.json).")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="Compare two result files and exit.")
+    parser.add_argument("--vehicles", type=int, default=1000, help="Number of vehicles in the fleet.")
+    parser.add_argument("--detections", default="poisson:3", help="Distribution of detections per event.")
+    parser.add_argument("--report-rate", type=float, default=0.1, help="Probability of a report with each event.")
+    parser.add_argument("--out-of-order", type=float, default=0.01, help="Fraction of events that arrive late.")
+    parser.add_argument("--duplicates", type=float, default=0.01, help="Fraction of events that are sent twice.")
+    parser.add_argument("--events-per-file", type=int, default=1000, help="Number of events in each file.")
+    parser.add_argument("--interval", type=float, default=1.0, help="Seconds between events of each vehicle.")
+    parser.add_argument("--workers", type=int, help="Number of worker processes of the watcher.")
+    parser.add_argument("--window", type=float, default=600, help="Seconds in the time range of each query.")
+    parser.add_argument("--repeats", type=int, default=50, help="Number of calls to each query function.")
+    parser.add_argument("--seed", type=int, default=42, help="Seed of the random numbers.")
+    parser.add_argument(
+        "--url",
+        default=get_engine_config()["url"].rsplit("/", 1)[0] + "/mobileye_hw_bench",
+        help="URL of a scratch database, which is dropped at the end.",
+    )
+    args = parser.parse_args()
+
+    if args.compare is not None:
+        with open(args.compare[0]) as f_old, open(args.compare[1]) as f_new:
+            compare(json.load(f_old), json.load(f_new))
+        sys.exit(0)
+
+    args.sizes = sorted(int(float(size)) for size in args.sizes.split(","))
+
+    import models.vehicles  # noqa: F401 (needed to create the tables)
+
+    configure_engine(url=args.url)
+    try:
+        results = run(args)
+    finally:
+        configure_engine()
+        if database_exists(args.url):
+            drop_database(args.url)
+
+    output = args.output or f"benchmark_{results['commit'] or 'results'}.json"
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"results written to {output}")
@@ -0,0 +1,40 @@
+import sqlalchemy as sa
+
+from models.base import Base
+from models.reports import Report
+
+
+class CurrentStatus(Base):
+    """
+    The latest status reported by each vehicle, kept up to date when reports are ingested,
+    so queries about the state of the fleet do not need to scan the whole history of reports.
+    """
+
+    __tablename__ = "vehicle_current_status"
+
+    __table_args__ = (sa.Index("ix_vehicle_current_status_status", "status"),)
+
+    vehicle_id = sa.Column(
+        sa.String,
+        sa.ForeignKey("vehicles.id", ondelete="CASCADE"),
+        primary_key=True,
+        doc="ID of the vehicle",
+    )
+
+    vehicle = sa.orm.relationship(
+        "Vehicle",
+        uselist=False,
+        doc="The vehicle this status belongs to",
+    )
+
+    status = sa.Column(
+        Report.__table__.c.status.type,
+        nullable=False,
+        doc="Status of the latest report of the vehicle. ",
+    )
+
+    timestamp = sa.Column(
+        sa.DateTime,
+        nullable=False,
+        doc="Timestamp of the latest report of the vehicle. ",
+    )
@@ -1,16 +1,27 @@
 import sqlalchemy as sa
 
 from models.base import Base
+from models.partitions import PARTITION_INTERVAL, partition_table_args
+from models.indexes import profile_indexes
+
+OBJECT_TYPES = ["pedestrians", "cars", "signs", "trucks", "obstacles"]
 
 
 class Detection(Base):
 
     __tablename__ = "detections"
 
+    # the natural key of a detection: ingesting the same data twice does not add any new rows
+    # optionally, the table is partitioned by ranges of the timestamp (see models.partitions)
+    # other indexes depend on the index profile (see models.indexes)
+    __table_args__ = partition_table_args(
+        sa.Index("ix_detections_natural_key", "vehicle_id", "timestamp", "type", "value", unique=True),
+        *profile_indexes("detections"),
+    )
+
     id = sa.Column(
         sa.BigInteger,
         primary_key=True,
-        index=True,
         autoincrement=True,
         doc="Auto-incrementing unique identifier for this detection",
     )
@@ -19,7 +30,6 @@ class Detection(Base):
         sa.String,
         sa.ForeignKey("vehicles.id", ondelete="CASCADE"),
         nullable=False,
-        index=True,
         doc="ID of the vehicle this detection is associated with",
     )
 
@@ -30,23 +40,22 @@ class Detection(Base):
     )
 
     type = sa.Column(
-        sa.String,  # TODO: consider using an enum or an int that is translated to one of a set of strings
+        # a native enum takes 4 bytes per row (and per index entry), instead of repeating the type name in each row
+        sa.Enum(*OBJECT_TYPES, name="object_type"),
         nullable=False,
-        index=True,
-        doc="Type of object detected. Possible values are: pedestrians, cars, signs. ",
+        doc=f"Type of object detected. Possible values are: {', '.join(OBJECT_TYPES)}. ",
     )
 
     value = sa.Column(
         sa.Float,  # TODO: I am not sure if this information is just a placeholder, so maybe an int is ok too?
         nullable=False,
-        index=True,
         doc="Value of the detection. For example, the speed of a car, or the number of pedestrians. ",
     )
 
     timestamp = sa.Column(
         sa.DateTime,
         nullable=False,
-        index=True,
+        primary_key=PARTITION_INTERVAL is not None,  # the partition key must be part of the primary key
         doc="Timestamp of the detection. ",
     )
 
@@ -54,14 +63,8 @@ class Detection(Base):
         """
         Check inputs to this object.
         """
-        # TODO: this is nice but it is better to enforce enum-type strings at the DB level
-        if key == "type" and value not in [
-            "pedestrians",
-            "cars",
-            "signs",
-            "trucks",
-            "obstacles",
-        ]:
+        # the enum column rejects unknown types too, but only when flushing, with a less helpful error
+        if key == "type" and value not in OBJECT_TYPES:
             raise ValueError(f"Invalid object type: {value}")
 
         super().__setattr__(key, value)
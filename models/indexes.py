@@ -0,0 +1,168 @@
+import os
+
+import sqlalchemy as sa
+
+from models.base import SmartSession
+
+# the secondary indexes of each table, for each profile, as (name, columns, method) tuples.
+# the primary keys and the unique natural key indexes (which start with vehicle_id, timestamp)
+# are always created, so they are not part of any profile.
+INDEX_PROFILES = {
+    # a B-tree on (almost) every column, as in older versions of the schema:
+    # the fastest for ad-hoc filters on any column, but the slowest for ingesting.
+    "full": {
+        "vehicles": [("ix_vehicles_created_at", ["created_at"], "btree")],
+        "reports": [
+            ("ix_reports_vehicle_id", ["vehicle_id"], "btree"),
+            ("ix_reports_status", ["status"], "btree"),
+            ("ix_reports_timestamp", ["timestamp"], "btree"),
+            ("ix_reports_created_at", ["created_at"], "btree"),
+        ],
+        "detections": [
+            ("ix_detections_vehicle_id", ["vehicle_id"], "btree"),
+            ("ix_detections_type", ["type"], "btree"),
+            ("ix_detections_value", ["value"], "btree"),
+            ("ix_detections_timestamp", ["timestamp"], "btree"),
+            ("ix_detections_created_at", ["created_at"], "btree"),
+        ],
+    },
+    # indexes that match the filters used by api.query: by vehicle and time (the natural key),
+    # by type/status and time, and by time alone. the time index also includes the id,
+    # to match the order used for paging (see api.query.order_statement()).
+    "query": {
+        "vehicles": [],
+        "reports": [
+            ("ix_reports_status_timestamp", ["status", "timestamp"], "btree"),
+            ("ix_reports_timestamp_id", ["timestamp", "id"], "btree"),
+        ],
+        "detections": [
+            ("ix_detections_type_timestamp", ["type", "timestamp"], "btree"),
+            ("ix_detections_timestamp_id", ["timestamp", "id"], "btree"),
+        ],
+    },
+    # the least indexes to maintain while ingesting: only a BRIN index on the time,
+    # which is tiny and cheap to update, since rows mostly arrive in time order.
+    # new rows are only found through a BRIN index once they are summarized by (auto)vacuum.
+    "write": {
+        "vehicles": [],
+        "reports": [("ix_reports_timestamp_brin", ["timestamp"], "brin")],
+        "detections": [("ix_detections_timestamp_brin", ["timestamp"], "brin")],
+    },
+}
+
+# the profile used when creating the tables
+INDEX_PROFILE = os.environ.get("MOBILEYE_DB_INDEX_PROFILE") or "query"
+if INDEX_PROFILE not in INDEX_PROFILES:
+    raise ValueError(f"MOBILEYE_DB_INDEX_PROFILE must be one of {list(INDEX_PROFILES)}, got {INDEX_PROFILE}.")
+
+
+def profile_indexes(table_name, profile=None):
+    """
+    Get the secondary indexes of a table in an index profile,
+    as sqlalchemy.Index objects that can be added to the __table_args__ of a model.
+    Uses the profile given by the MOBILEYE_DB_INDEX_PROFILE environment variable by default.
+    """
+    profile = profile or INDEX_PROFILE
+    return tuple(
+        sa.Index(name, *columns, postgresql_using=method, postgresql_with=_index_options(method))
+        for name, columns, method in INDEX_PROFILES[profile][table_name]
+    )
+
+
+def _index_options(method):
+    # let autovacuum summarize new pages as soon as they fill up, instead of waiting for the next vacuum
+    return {"autosummarize": "on"} if method == "brin" else {}
+
+
+def get_secondary_indexes(table_name, session):
+    """
+    Get the names of the indexes on a table that are neither unique nor the primary key,
+    i.e., the indexes that are managed by the index profiles.
+    """
+    stmt = sa.text(
+        "SELECT c.relname FROM pg_index AS x JOIN pg_class AS c ON c.oid = x.indexrelid "
+        "WHERE x.indrelid = CAST(:table AS regclass) AND NOT x.indisunique AND NOT x.indisprimary"
+    )
+    return sorted(session.scalars(stmt, {"table": table_name}).all())
+
+
+def apply_index_profile(profile, session=None, concurrently=False):
+    """
+    Switch an existing database to another index profile:
+    create the indexes of the profile that do not exist yet,
+    and drop any other secondary (not unique, not primary key) indexes.
+
+    Parameters
+    ----------
+    profile: str
+        The name of the profile to apply. One of:
+        - "full": a B-tree on each column (fastest for ad-hoc filters, slowest for ingesting).
+        - "query": B-trees that match the filters used by api.query (the default).
+        - "write": only a BRIN index on the timestamp (fastest for ingesting).
+    session: sqlalchemy.orm.session.Session, optional
+        A session to use for the database connection. If not given, a new session will be created.
+    concurrently: bool
+        If True, create and drop the indexes without locking the tables against writes
+        (this takes longer, and runs outside of the session's transaction).
+        Not supported for partitioned tables, which are always locked while changing their indexes.
+
+    Returns
+    -------
+    dict
+        A dictionary with the names of the indexes that were "created" and "dropped".
+    """
+    if profile not in INDEX_PROFILES:
+        raise ValueError(f"Unknown index profile: {profile}. Use one of {list(INDEX_PROFILES)}.")
+
+    created = []
+    dropped = []
+    with SmartSession(session) as session:
+        statements = []
+        for table_name, indexes in INDEX_PROFILES[profile].items():
+            existing = get_secondary_indexes(table_name, session)
+            wanted = {name for name, _, _ in indexes}
+            partitioned = session.scalar(
+                sa.text("SELECT relkind = 'p' FROM pg_class WHERE oid = CAST(:table AS regclass)"),
+                {"table": table_name},
+            )
+            option = "CONCURRENTLY " if concurrently and not partitioned else ""
+
+            for name in existing:
+                if name not in wanted:
+                    statements.append(f"DROP INDEX {option}IF EXISTS {name}")
+                    dropped.append(name)
+            for name, columns, method in indexes:
+                if name not in existing:
+                    options = ", ".join(f"{key} = {value}" for key, value in _index_options(method).items())
+                    statements.append(
+                        f"CREATE INDEX {option}IF NOT EXISTS {name} ON {table_name} "
+                        f"USING {method} ({', '.join(columns)}){f' WITH ({options})' if options else ''}"
+                    )
+                    created.append(name)
+
+        if concurrently:  # cannot run inside a transaction block
+            session.commit()
+            with session.get_bind().connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+                for stmt in statements:
+                    connection.execute(sa.text(stmt))
+        else:
+            for stmt in statements:
+                session.execute(sa.text(stmt))
+            session.commit()
+
+    return {"created": created, "dropped": dropped}
+
+
+if __name__ == "__main__":
+    import argparse
+
+    import models.vehicles  # noqa: F401 (needed to create the tables)
+    import models.reports  # noqa: F401
+    import models.detections  # noqa: F401
+
+    parser = argparse.ArgumentParser(description="Switch the database to another index profile.")
+    parser.add_argument("profile", choices=list(INDEX_PROFILES), help="The index profile to apply.")
+    parser.add_argument("--concurrently", action="store_true", help="Do not lock the tables against writes.")
+    args = parser.parse_args()
+
+    print(apply_index_profile(args.profile, concurrently=args.concurrently))
@@ -0,0 +1,121 @@
+import sqlalchemy as sa
+
+from models.base import Base, SmartSession
+
+
+def get_column_type(table_name, column_name, session):
+    """
+    Get the name of the type of a column in the database (e.g., "varchar", or the name of an enum type),
+    or None if the column does not exist.
+    """
+    stmt = sa.text(
+        "SELECT udt_name FROM information_schema.columns "
+        "WHERE table_schema = current_schema() AND table_name = :table AND column_name = :column"
+    )
+    return session.scalar(stmt, {"table": table_name, "column": column_name})
+
+
+def convert_enum_column(column, session):
+    """
+    Convert a column that holds strings (as in older versions of the schema) into the native enum type of the model.
+    Raises a ValueError if the column has any values that are not part of the enum.
+    Does not commit the session.
+    """
+    table_name, enum = column.table.name, column.type
+    stmt = sa.text(
+        f"SELECT DISTINCT {column.name} FROM {table_name} WHERE CAST({column.name} AS text) NOT IN :values"
+    ).bindparams(sa.bindparam("values", expanding=True))
+    unknown = session.scalars(stmt, {"values": list(enum.enums)}).all()
+    if len(unknown) > 0:
+        raise ValueError(
+            f"Cannot convert {table_name}.{column.name} to {enum.name}: unknown values {sorted(map(str, unknown))}."
+        )
+
+    session.execute(
+        sa.text(
+            f"ALTER TABLE {table_name} ALTER COLUMN {column.name} TYPE {enum.name} "
+            f"USING CAST(CAST({column.name} AS text) AS {enum.name})"
+        )
+    )
+
+
+def remove_duplicates(table, columns, session):
+    """
+    Delete the rows of a table that repeat the values of the given columns,
+    keeping the row with the lowest id of each group. Does not commit the session.
+    Returns the number of rows that were deleted.
+    """
+    ranked = f"SELECT id, row_number() OVER (PARTITION BY {', '.join(columns)} ORDER BY id) AS n FROM {table.name}"
+    result = session.execute(
+        sa.text(f"DELETE FROM {table.name} WHERE id IN (SELECT id FROM ({ranked}) AS r WHERE n > 1)")
+    )
+
+    return result.rowcount
+
+
+def migrate_schema(session=None):
+    """
+    Bring a database that was created by an older version of the code up to the current schema:
+    - Create the tables (and enum types) that do not exist yet (e.g., the rollup tables).
+      The new tables are empty: fill the rollups and current statuses using "python -m api.rollups".
+    - Convert string columns into the native enum types of the models
+      (detections.type into object_type, reports.status into report_status).
+    - Delete duplicate rows and create the unique natural key indexes
+      (ix_detections_natural_key, ix_reports_natural_key), which the ingestion needs to skip duplicates:
+      without them, ingesting the same data twice saves it twice.
+      Of each group of duplicates, the row with the lowest id is kept.
+    Everything is done in one transaction, so if anything fails (e.g., a column has values
+    that are not part of its enum) nothing is changed. The tables are locked while they are converted,
+    and converting and indexing large tables can take a while, so this is best done while nothing is ingested.
+    Calling this on a database that is already up to date does nothing.
+
+    Parameters
+    ----------
+    session: sqlalchemy.orm.session.Session, optional
+        A session to use for the database connection. If not given, a new session will be created.
+
+    Returns
+    -------
+    dict
+        A dictionary with the names of the tables that were "created", the columns that were "converted",
+        the number of duplicate rows that were "deleted" from each table,
+        and the names of the unique "indexes" that were created.
+    """
+    import models.vehicles  # noqa: F401 (all the models must be loaded, to create any missing tables)
+    import models.reports  # noqa: F401
+    import models.detections  # noqa: F401
+    import models.rollups  # noqa: F401
+    import models.current_status  # noqa: F401
+
+    results = {"created": [], "converted": [], "deleted": {}, "indexes": []}
+    with SmartSession(session) as session:
+        connection = session.connection()
+        existing = set(sa.inspect(connection).get_table_names())
+        Base.metadata.create_all(connection)  # only creates the tables and types that are missing
+        results["created"] = sorted(set(Base.metadata.tables) - existing)
+
+        for table in Base.metadata.sorted_tables:
+            if table.name in results["created"]:
+                continue
+
+            for column in table.columns:
+                if not isinstance(column.type, sa.Enum):
+                    continue
+                if get_column_type(table.name, column.name, session) != column.type.name:
+                    convert_enum_column(column, session)
+                    results["converted"].append(f"{table.name}.{column.name}")
+
+            for index in sorted(table.indexes, key=lambda idx: idx.name):
+                if not index.unique or session.scalar(sa.select(sa.func.to_regclass(index.name))) is not None:
+                    continue
+                results["deleted"][table.name] = remove_duplicates(table, [col.name for col in index.columns], session)
+                index.create(connection)
+                results["indexes"].append(index.name)
+
+        session.commit()
+
+    return results
+
+
+if __name__ == "__main__":
+    print(migrate_schema())
@@ -0,0 +1,347 @@
+import os
+import re
+import datetime
+
+import sqlalchemy as sa
+
+from models.base import Base, SmartSession
+
+PARTITION_INTERVALS = {"day": "YYYYMMDD", "month": "YYYYMM"}  # name suffix format of each partition
+
+# if set to "day" or "month", the detections and reports tables are partitioned by ranges of their timestamp.
+# this must be decided before the tables are created, and cannot be changed for an existing database.
+PARTITION_INTERVAL = os.environ.get("MOBILEYE_DB_PARTITION") or None
+if PARTITION_INTERVAL is not None and PARTITION_INTERVAL not in PARTITION_INTERVALS:
+    raise ValueError(f"MOBILEYE_DB_PARTITION must be one of {list(PARTITION_INTERVALS)}, got {PARTITION_INTERVAL}.")
+
+PARTITIONS_AHEAD = 2  # create partitions for this many future intervals (see create_upcoming_partitions())
+PARTITIONS_CHECK_INTERVAL = 3600  # seconds between calls to create_upcoming_partitions() in long-running writers
+PARTITION_LOCK_TIMEOUT = "5s"  # how long to wait for the locks to attach a partition from another connection
+LOCK_NOT_AVAILABLE = "55P03"  # the SQLSTATE of a lock timeout
+
+
+def partition_table_args(*args):
+    """
+    Add the partitioning option to the __table_args__ of a model, if partitioning is enabled.
+    The table is partitioned by ranges of its timestamp column.
+    """
+    if PARTITION_INTERVAL is None:
+        return args
+
+    return args + ({"postgresql_partition_by": "RANGE (timestamp)"},)
+
+
+def is_partitioned(table):
+    """
+    Check if a table (sqlalchemy.Table) is partitioned.
+    """
+    return table.dialect_options["postgresql"].get("partition_by") is not None
+
+
+def partition_start(time, interval=None):
+    """
+    Get the start of the partition interval that contains the given time.
+    """
+    interval = interval or PARTITION_INTERVAL
+    time = datetime.datetime(time.year, time.month, time.day)
+    if interval == "month":
+        time = time.replace(day=1)
+
+    return time
+
+
+def partition_end(start, interval=None):
+    """
+    Get the end of the partition interval that begins at the given start time (which is the start of the next one).
+    """
+    interval = interval or PARTITION_INTERVAL
+    if interval == "month":
+        return (start + datetime.timedelta(days=32)).replace(day=1)
+
+    return start + datetime.timedelta(days=1)
+
+
+def partition_name(table_name, start, interval=None):
+    """
+    Get the name of the partition of a table that begins at the given start time,
+    e.g., "detections_p20220101" for daily partitions, or "detections_p202201" for monthly partitions.
+    """
+    interval = interval or PARTITION_INTERVAL
+    return f"{table_name}_p{start.strftime('%Y%m%d' if interval == 'day' else '%Y%m')}"
+
+
+def _create_partition(table_name, start, connection):
+    """
+    Create one partition of a table, if it does not exist yet.
+    The partition is created as a separate table and then attached to the partitioned table,
+    which only takes a SHARE UPDATE EXCLUSIVE lock on the partitioned table, so other sessions can keep
+    reading and writing it (CREATE TABLE ... PARTITION OF would lock them out until the end of the transaction).
+    An advisory lock makes concurrent writers that need the same partition wait for each other,
+    instead of failing when both try to create it.
+    """
+    name = partition_name(table_name, start)
+    end = partition_end(start)
+    connection.execute(sa.text("SELECT pg_advisory_xact_lock(hashtext(:name))"), {"name": name})
+    if connection.scalar(sa.select(sa.func.to_regclass(name))) is not None:
+        return name
+
+    connection.execute(sa.text(f"CREATE TABLE {name} (LIKE {table_name} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"))
+    connection.execute(
+        sa.text(
+            f"ALTER TABLE {table_name} ATTACH PARTITION {name} "
+            f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+        )
+    )
+
+    return name
+
+
+def _holds_conflicting_lock(table, session):
+    """
+    Check if the transaction of the session holds a lock that would block attaching a new partition to the table
+    from another connection: attaching a partition also adds the foreign keys of the table to it,
+    which locks the tables they refer to (e.g., the vehicles table) against writes.
+    """
+    referenced = sorted({fk.column.table.name for fk in table.foreign_keys})
+    if len(referenced) == 0:
+        return False
+
+    stmt = sa.text(
+        "SELECT EXISTS (SELECT 1 FROM pg_locks WHERE pid = pg_backend_pid() AND locktype = 'relation' "
+        "AND CAST(CAST(relation AS regclass) AS text) IN :tables "
+        "AND mode NOT IN ('AccessShareLock', 'RowShareLock'))"
+    ).bindparams(sa.bindparam("tables", expanding=True))
+
+    return session.scalar(stmt, {"tables": referenced})
+
+
+def create_missing_partitions(table, source, session):
+    """
+    Create the partitions needed to hold the rows in the source table (e.g., a staging table),
+    so they can be inserted into the partitioned table.
+    Uses a single query to find which partitions are missing, so when all of them
+    already exist this only costs one round trip.
+    The missing partitions are created in a short transaction of their own, on another connection,
+    so the locks needed to attach them are released right away, instead of being held
+    until the session commits. They are created in the session's own transaction (without committing it)
+    only if that is not possible: if the session already holds a lock that conflicts with attaching them
+    (e.g., after adding new vehicles), or if the other connection waits for its locks
+    longer than PARTITION_LOCK_TIMEOUT (e.g., for writers that are waiting for this session).
+    It is best to create the partitions ahead of time (see create_upcoming_partitions()),
+    so this is rarely needed.
+
+    Parameters
+    ----------
+    table: sqlalchemy.Table
+        The partitioned table.
+    source: sqlalchemy.Table or sqlalchemy.sql.expression.TableClause
+        A table with a timestamp column, with the rows that will be inserted.
+    session: sqlalchemy.orm.session.Session
+        The session to use for the database connection.
+
+    Returns
+    -------
+    list of str
+        The names of the partitions that were created.
+    """
+    starts = sa.select(sa.func.date_trunc(PARTITION_INTERVAL, source.c.timestamp).label("start")).distinct()
+    starts = starts.subquery()
+    names = sa.literal(f"{table.name}_p") + sa.func.to_char(starts.c.start, PARTITION_INTERVALS[PARTITION_INTERVAL])
+    missing = sorted(session.scalars(sa.select(starts.c.start).where(sa.func.to_regclass(names).is_(None))).all())
+    if len(missing) == 0:
+        return []
+
+    if not _holds_conflicting_lock(table, session):
+        try:
+            with session.get_bind().engine.connect() as connection, connection.begin():
+                connection.execute(sa.text(f"SET LOCAL lock_timeout = '{PARTITION_LOCK_TIMEOUT}'"))
+                return [_create_partition(table.name, start, connection) for start in missing]
+        except sa.exc.DBAPIError as e:
+            if getattr(e.orig, "pgcode", None) != LOCK_NOT_AVAILABLE:
+                raise
+
+    return [_create_partition(table.name, start, session.connection()) for start in missing]
+
+
+def create_partitions(start_time, end_time, session=None, tables=None):
+    """
+    Create the partitions that cover the given time range, if they do not exist yet.
+    Use this to create partitions ahead of time (e.g., once a day, for the next few days),
+    so writers do not have to create them while ingesting.
+    Partitions are also created automatically when ingesting data that needs them.
+
+    Parameters
+    ----------
+    start_time: datetime.datetime
+        The start of the time range.
+    end_time: datetime.datetime
+        The end of the time range (the partition that contains it is also created).
+    session: sqlalchemy.orm.session.Session, optional
+        A session to use for the database connection. If not given, a new session will be created.
+    tables: list of sqlalchemy.Table, optional
+        The tables to create partitions for. Defaults to all partitioned tables.
+
+    Returns
+    -------
+    list of str
+        The names of the partitions that cover the time range (including those that already existed).
+    """
+    if tables is None:
+        tables = [t for t in Base.metadata.sorted_tables if is_partitioned(t)]
+
+    names = []
+    with SmartSession(session) as session:
+        for table in tables:
+            start = partition_start(start_time)
+            while start <= end_time:
+                names.append(_create_partition(table.name, start, session.connection()))
+                start = partition_end(start)
+        session.commit()
+
+    return names
+
+
+def create_upcoming_partitions(ahead=PARTITIONS_AHEAD, session=None):
+    """
+    Create the partitions for the current interval and the next few ones, if they do not exist yet,
+    so they do not have to be created while ingesting.
+    The folder watcher and the ingest server call this when they start,
+    and again every PARTITIONS_CHECK_INTERVAL seconds while they run.
+    It can also be called from a scheduled job, using "python -m models.partitions".
+    Does nothing if partitioning is disabled.
+
+    Parameters
+    ----------
+    ahead: int
+        The number of intervals after the current one to create partitions for.
+    session: sqlalchemy.orm.session.Session, optional
+        A session to use for the database connection. If not given, a new session will be created.
+
+    Returns
+    -------
+    list of str
+        The names of the partitions for the current and upcoming intervals (including those that already existed).
+    """
+    if PARTITION_INTERVAL is None:
+        return []
+
+    start = end = partition_start(datetime.datetime.utcnow())
+    for _ in range(ahead):
+        end = partition_end(end)
+
+    return create_partitions(start, end, session=session)
+
+
+def list_partitions(table, session=None):
+    """
+    Get the partitions of a table, with the time range of each one.
+
+    Parameters
+    ----------
+    table: sqlalchemy.Table
+        The partitioned table.
+    session: sqlalchemy.orm.session.Session, optional
+        A session to use for the database connection. If not given, a new session will be created.
+
+    Returns
+    -------
+    list of tuple
+        A (name, start, end) tuple for each partition, sorted by start time.
+        The start and end are None for a partition without a lower or upper bound (e.g., a DEFAULT partition).
+    """
+    stmt = sa.text(
+        "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits AS i "
+        "JOIN pg_class AS c ON c.oid = i.inhrelid WHERE i.inhparent = CAST(:table AS regclass)"
+    )
+    with SmartSession(session) as session:
+        rows = session.execute(stmt, {"table": table.name}).all()
+
+    partitions = []
+    for name, bounds in rows:
+        values = re.findall(r"'([^']*)'|MINVALUE|MAXVALUE", bounds)
+        values = [datetime.datetime.fromisoformat(v) if v else None for v in values] + [None, None]
+        partitions.append((name, values[0], values[1]))
+
+    return sorted(partitions, key=lambda p: (p[1] is not None, p[1] or datetime.datetime.min))
+
+
+def drop_partitions(before, session=None, tables=None, derived=True):
+    """
+    Remove all the data older than the given time, by dropping whole partitions.
+    This is much faster than deleting the rows, and does not leave dead rows behind
+    for the vacuum to clean up. Only partitions that end before (or at) the given time are dropped,
+    so some rows older than that time may be kept, in the partition that contains that time.
+
+    The tables derived from the dropped rows are cleaned up too (unless derived=False),
+    so they match the data that is left: the rollup rows of the time buckets that were dropped
+    are deleted, and so are the current statuses of vehicles whose latest report was dropped
+    (these vehicles no longer have a current status, as if they had no reports at all).
+
+    Parameters
+    ----------
+    before: datetime.datetime
+        Drop partitions that only hold data older than this time.
+    session: sqlalchemy.orm.session.Session, optional
+        A session to use for the database connection. If not given, a new session will be created.
+    tables: list of sqlalchemy.Table, optional
+        The tables to drop partitions from. Defaults to all partitioned tables.
+    derived: bool
+        If True (default), also delete the rows of the derived tables (see api.rollups) that summarize
+        the dropped data. If False, they are kept, e.g., to keep the rollups for longer than the raw data.
+
+    Returns
+    -------
+    list of str
+        The names of the partitions that were dropped.
+    """
+    # the derived tables refer to the partitioned models, so they are only imported here
+    from models.rollups import DetectionRollup, ReportRollup
+    from models.current_status import CurrentStatus
+
+    derived_columns = {
+        "detections": [DetectionRollup.__table__.c.bucket],
+        "reports": [ReportRollup.__table__.c.bucket, CurrentStatus.__table__.c.timestamp],
+    }
+
+    if tables is None:
+        tables = [t for t in Base.metadata.sorted_tables if is_partitioned(t)]
+
+    dropped = []
+    with SmartSession(session) as session:
+        for table in tables:
+            ends = []
+            for name, start, end in list_partitions(table, session=session):
+                if end is not None and end <= before:
+                    session.execute(sa.text(f"DROP TABLE {name}"))
+                    dropped.append(name)
+                    ends.append(end)
+
+            # all the rows of the table before the end of the last dropped partition are gone
+            if derived and len(ends) > 0:
+                for column in derived_columns.get(table.name, []):
+                    session.execute(sa.delete(column.table).where(column < max(ends)))
+        session.commit()
+
+    return dropped
+
+
+@sa.event.listens_for(Base.metadata, "after_create")
+def _create_initial_partitions(metadata, connection, **kwargs):
+    """
+    When the tables are created, also create the partitions for the current and next few intervals.
+    """
+    now = datetime.datetime.utcnow()
+    for table in metadata.sorted_tables:
+        if is_partitioned(table):
+            start = partition_start(now)
+            for _ in range(PARTITIONS_AHEAD + 1):
+                _create_partition(table.name, start, connection)
+                start = partition_end(start)
+
+
+if __name__ == "__main__":
+    import models.vehicles  # noqa: F401 (needed to find the partitioned tables)
+    import models.reports  # noqa: F401
+    import models.detections  # noqa: F401
+
+    print(create_upcoming_partitions())
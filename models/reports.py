@@ -1,16 +1,27 @@
 import sqlalchemy as sa
 
 from models.base import Base
+from models.partitions import PARTITION_INTERVAL, partition_table_args
+from models.indexes import profile_indexes
+
+REPORT_STATUSES = ["parking", "driving", "accident"]
 
 
 class Report(Base):
 
     __tablename__ = "reports"
 
+    # the natural key of a report: ingesting the same data twice does not add any new rows
+    # optionally, the table is partitioned by ranges of the timestamp (see models.partitions)
+    # other indexes depend on the index profile (see models.indexes)
+    __table_args__ = partition_table_args(
+        sa.Index("ix_reports_natural_key", "vehicle_id", "timestamp", "status", unique=True),
+        *profile_indexes("reports"),
+    )
+
     id = sa.Column(
         sa.BigInteger,
         primary_key=True,
-        index=True,
         autoincrement=True,
         doc="Auto-incrementing unique identifier for this report",
     )
@@ -19,7 +30,6 @@ class Report(Base):
         sa.String,
         sa.ForeignKey("vehicles.id", ondelete="CASCADE"),
         nullable=False,
-        index=True,
         doc="ID of the vehicle this report is associated with",
     )
 
@@ -31,16 +41,16 @@ class Report(Base):
     )
 
     status = sa.Column(
-        sa.String,  # TODO: consider using an enum or an int that is translated to one of a set of strings
+        # stored as a native enum, like Detection.type, which is also part of the natural key index
+        sa.Enum(*REPORT_STATUSES, name="report_status"),
         nullable=False,
-        index=True,
-        doc="Status of the vehicle. Possible values are: parking, driving, accident. ",
+        doc=f"Status of the vehicle. Possible values are: {', '.join(REPORT_STATUSES)}. ",
     )
 
     timestamp = sa.Column(
         sa.DateTime,
         nullable=False,
-        index=True,
+        primary_key=PARTITION_INTERVAL is not None,  # the partition key must be part of the primary key
         doc="Timestamp of the report. ",
     )
 
@@ -48,8 +58,8 @@ class Report(Base):
         """
         Check inputs to this object.
         """
-        # TODO: this is nice but it is better to enforce enum-type strings at the DB level
-        if key == "status" and value not in ["parking", "driving", "accident"]:
+        # fail as soon as the report is made, instead of when the report_status enum rejects it on flush
+        if key == "status" and value not in REPORT_STATUSES:
             raise ValueError(f"Invalid status value: {value}")
 
         super().__setattr__(key, value)
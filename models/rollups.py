@@ -0,0 +1,110 @@
+import sqlalchemy as sa
+
+from models.base import Base
+from models.reports import Report
+from models.detections import Detection
+
+ROLLUP_RESOLUTIONS = ["minute", "hour"]  # the sizes of the time buckets that are kept in the rollup tables
+
+
+class DetectionRollup(Base):
+    """
+    Summary of the detections of each vehicle and type in each time bucket (minute or hour),
+    updated whenever detections are ingested, so aggregations over long time ranges
+    do not need to read all the detections.
+    """
+
+    __tablename__ = "detection_rollups"
+
+    __table_args__ = (sa.Index("ix_detection_rollups_bucket", "resolution", "bucket"),)
+
+    resolution = sa.Column(
+        sa.Enum(*ROLLUP_RESOLUTIONS, name="rollup_resolution"),
+        primary_key=True,
+        doc="Size of the time bucket: minute or hour. ",
+    )
+
+    vehicle_id = sa.Column(
+        sa.String,
+        sa.ForeignKey("vehicles.id", ondelete="CASCADE"),
+        primary_key=True,
+        doc="ID of the vehicle that made the detections",
+    )
+
+    type = sa.Column(
+        Detection.__table__.c.type.type,
+        primary_key=True,
+        doc="Type of object detected. ",
+    )
+
+    bucket = sa.Column(
+        sa.DateTime,
+        primary_key=True,
+        doc="Start time of the time bucket. ",
+    )
+
+    count = sa.Column(
+        sa.BigInteger,
+        nullable=False,
+        doc="Number of detections in the bucket. ",
+    )
+
+    value_sum = sa.Column(
+        sa.Float,
+        nullable=False,
+        doc="Sum of the values of the detections in the bucket. ",
+    )
+
+    value_min = sa.Column(
+        sa.Float,
+        nullable=False,
+        doc="Minimal value of the detections in the bucket. ",
+    )
+
+    value_max = sa.Column(
+        sa.Float,
+        nullable=False,
+        doc="Maximal value of the detections in the bucket. ",
+    )
+
+
+class ReportRollup(Base):
+    """
+    Number of reports of each vehicle and status in each time bucket (minute or hour),
+    updated whenever reports are ingested.
+    """
+
+    __tablename__ = "report_rollups"
+
+    __table_args__ = (sa.Index("ix_report_rollups_bucket", "resolution", "bucket"),)
+
+    resolution = sa.Column(
+        DetectionRollup.__table__.c.resolution.type,
+        primary_key=True,
+        doc="Size of the time bucket: minute or hour. ",
+    )
+
+    vehicle_id = sa.Column(
+        sa.String,
+        sa.ForeignKey("vehicles.id", ondelete="CASCADE"),
+        primary_key=True,
+        doc="ID of the vehicle that made the reports",
+    )
+
+    status = sa.Column(
+        Report.__table__.c.status.type,
+        primary_key=True,
+        doc="Status of the vehicle. ",
+    )
+
+    bucket = sa.Column(
+        sa.DateTime,
+        primary_key=True,
+        doc="Start time of the time bucket. ",
+    )
+
+    count = sa.Column(
+        sa.BigInteger,
+        nullable=False,
+        doc="Number of reports in the bucket. ",
+    )
@@ -1,12 +1,16 @@
 import sqlalchemy as sa
 
 from models.base import Base
+from models.indexes import profile_indexes
 
 
 class Vehicle(Base):
 
     __tablename__ = "vehicles"
 
+    # the indexes depend on the index profile (see models.indexes)
+    __table_args__ = profile_indexes("vehicles")
+
     id = sa.Column(
         sa.String,
         primary_key=True,
@@ -1,3 +1,19 @@
 import os
 
+import sqlalchemy as sa
+
+from models.base import SmartSession
+from models.vehicles import Vehicle
+
 DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data")
+
+
+def clear_vehicles(vehicle_ids):
+    """
+    Delete the given vehicles (and their reports and detections) from the database,
+    so each test starts (and ends) without the vehicles it uses.
+    """
+    with SmartSession() as session:
+        vehicles = session.scalars(sa.select(Vehicle).where(Vehicle.id.in_(vehicle_ids))).all()
+        [session.delete(v) for v in vehicles]
+        session.commit()
@@ -0,0 +1,94 @@
+import datetime
+
+import numpy as np
+import pytest
+import sqlalchemy as sa
+
+from tests.conftest import clear_vehicles
+
+from models.base import SmartSession
+from models.detections import OBJECT_TYPES
+from models.reports import REPORT_STATUSES
+
+from api.ingest import ingest_data
+from api.aggregate import aggregate_detections, aggregate_reports, bucket_expression
+
+
+def test_aggregations():
+    vehicle_ids = ["aggregate_vehicle_0", "aggregate_vehicle_1"]
+    clear_vehicles(vehicle_ids)
+
+    try:
+        # one detection per minute for 15 minutes, alternating between cars and signs,
+        # and an accident report every 20 minutes for 3 hours
+        events = [
+            dict(
+                vehicle_id=vehicle_ids[i % 2],
+                detection_time=f"2022-04-01T10:{i:02d}:30Z",
+                detections=[dict(object_type=["cars", "signs"][i % 2], object_value=i)],
+            )
+            for i in range(15)
+        ]
+        reports = [
+            dict(vehicle_id=vehicle_ids[0], report_time=f"2022-04-01T{10 + i // 3:02d}:{i % 3 * 20:02d}:00Z", status=s)
+            for i, s in enumerate(["accident", "driving", "parking"] * 3)
+        ]
+        ingest_data(dict(objects_detection_events=events, vehicle_status=reports))
+
+        # detections per type per 5 minutes
+        start, end = datetime.datetime(2022, 4, 1), datetime.datetime(2022, 4, 2)  # only this test has data there
+        result = aggregate_detections(start_time=start, end_time=end, aggregates=["count", "avg", "min"])
+        assert list(result["bucket"]) == list(np.repeat(np.arange(3) * 300, 2) + np.datetime64("2022-04-01T10:00:00"))
+        assert [OBJECT_TYPES[c] for c in result["type"]] == ["cars", "signs"] * 3
+        assert list(result["count"]) == [3, 2, 2, 3, 3, 2]
+        assert list(result["avg"]) == [2.0, 2.0, 7.0, 7.0, 12.0, 12.0]
+        assert list(result["min"]) == [0.0, 1.0, 6.0, 5.0, 10.0, 11.0]
+
+        # the same filters as get_detections(), and percentiles of the values
+        result = aggregate_detections(
+            bucket="hour", group_by=[], aggregates=["count", "p50", "max", "stddev"], vehicle_id=vehicle_ids[0]
+        )
+        assert list(result.keys()) == ["bucket", "count", "p50", "max", "stddev"]
+        assert list(result["count"]) == [8]
+        assert list(result["p50"]) == [7.0]
+        assert list(result["max"]) == [14.0]
+
+        result = aggregate_detections(
+            bucket=datetime.timedelta(minutes=10), group_by="vehicle_id", types="cars", vehicle_id=vehicle_ids[0]
+        )
+        assert list(result["count"]) == [5, 3]
+        assert set(result["vehicle_id"]) == {vehicle_ids[0]}
+
+        # accident count per hour
+        result = aggregate_reports(statuses="accident", vehicle_id=vehicle_ids[0])
+        assert list(result["bucket"]) == [np.datetime64(f"2022-04-01T{h}:00:00") for h in [10, 11, 12]]
+        assert list(result["count"]) == [1, 1, 1]
+        assert {REPORT_STATUSES[c] for c in result["status"]} == {"accident"}
+
+        result = aggregate_reports(bucket=None, group_by=[], vehicle_id=vehicle_ids[0])
+        assert list(result["count"]) == [9]
+
+        # buckets of several months or years start a whole number of buckets after the year 2000
+        for bucket, start in [("1 month", "2022-04"), ("2 months", "2022-03"), ("2 years", "2022-01")]:
+            for from_rollups in [False, True]:
+                result = aggregate_reports(
+                    bucket=bucket, group_by=[], vehicle_id=vehicle_ids[0], from_rollups=from_rollups
+                )
+                assert list(result["bucket"]) == [np.datetime64(f"{start}-01T00:00:00")]
+                assert list(result["count"]) == [9]
+        with SmartSession() as session:
+            time = sa.literal(datetime.datetime(1999, 12, 15), sa.DateTime)
+            assert session.scalar(sa.select(bucket_expression(time, "3 months"))) == datetime.datetime(1999, 10, 1)
+
+        result = aggregate_reports(vehicle_id="no such vehicle")
+        assert all([len(a) == 0 for a in result.values()])
+
+        with pytest.raises(ValueError):
+            aggregate_detections(aggregates="median")
+        with pytest.raises(ValueError):
+            aggregate_detections(group_by="value")
+        with pytest.raises(ValueError, match="whole number of months"):
+            aggregate_detections(bucket="1 month 2 days")
+
+    finally:
+        clear_vehicles(vehicle_ids)
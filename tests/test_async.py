@@ -0,0 +1,129 @@
+import asyncio
+import datetime
+
+import sqlalchemy as sa
+
+from tests.conftest import clear_vehicles
+
+from models.base import AsyncSmartSession, close_async_engine
+
+from api.ingest import add_ingest_listener, remove_ingest_listener
+from api.query import get_reports, get_detections, get_detections_columns
+from api.async_ingest import async_ingest, async_ingest_data, async_ingest_payloads
+from api.async_query import (
+    async_get_reports,
+    async_get_detections,
+    async_get_detections_columns,
+    async_get_fleet,
+    async_get_current_statuses,
+    async_aggregate_detections,
+    async_iter_detections,
+)
+
+
+def make_payload(vehicle_id, num_events, offset=0):
+    start = datetime.datetime(2023, 3, 1)
+    events = [
+        dict(
+            vehicle_id=vehicle_id,
+            detection_time=(start + datetime.timedelta(seconds=i + offset)).isoformat(),
+            detections=[
+                dict(object_type="cars", object_value=i + offset),
+                dict(object_type="pedestrians", object_value=1),
+            ],
+        )
+        for i in range(num_events)
+    ]
+    reports = [
+        dict(vehicle_id=vehicle_id, report_time=(start + datetime.timedelta(seconds=i)).isoformat(), status="driving")
+        for i in range(num_events // 2)
+    ]
+    return dict(objects_detection_events=events, vehicle_status=reports)
+
+
+def test_async_ingest_and_query():
+    vehicle_ids = [f"async_vehicle_{i}" for i in range(4)]
+    clear_vehicles(vehicle_ids)
+
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    ingested = []
+
+    def listener(table_name, ids, start, end):
+        ingested.append((table_name, ids))
+
+    async def main():
+        try:
+            # several payloads ingested concurrently, each in its own session and connection
+            statuses = await asyncio.gather(*[async_ingest_data(make_payload(vid, 20)) for vid in vehicle_ids])
+            assert all(s["status"] == "success" for s in statuses)
+            assert all(s["detections saved"] == 40 and s["reports saved"] == 10 for s in statuses)
+
+            # the rows are loaded with COPY, not inserted one by one
+            assert not any("INSERT INTO staging_" in s for s in statements)
+
+            # overlapping rows are skipped, and the listeners are told about the new ones
+            statuses = await async_ingest_payloads([make_payload(vehicle_ids[0], 30, offset=10), "not json"])
+            assert statuses[0]["status"] == "success"
+            assert statuses[0]["detections saved"] == 40
+            assert statuses[0]["detections skipped"] == 20
+            assert statuses[0]["reports skipped"] == 10
+            assert statuses[1]["status"] == "failure"
+            assert ("detections", {vehicle_ids[0]}) in ingested
+
+            status = await async_ingest("not json")
+            assert status["status"] == "failure"
+
+            # the same results as the synchronous functions
+            reports = await async_get_reports(vehicle_id=vehicle_ids[1], order_by="timestamp")
+            assert [r.id for r in reports] == [
+                r.id for r in get_reports(vehicle_id=vehicle_ids[1], order_by="timestamp")
+            ]
+            detections = await async_get_detections(vehicle_id=vehicle_ids[0], types="cars")
+            assert len(detections) == 40
+            assert {d.id for d in detections} == {d.id for d in get_detections(vehicle_id=vehicle_ids[0], types="cars")}
+
+            # the columns query runs its SQL directly on the driver's cursor, which is asyncpg here
+            columns = await async_get_detections_columns(
+                vehicle_id=vehicle_ids[0], types="cars", start_time=datetime.datetime(2023, 3, 1, 0, 0, 10)
+            )
+            expected = get_detections_columns(
+                vehicle_id=vehicle_ids[0], types="cars", start_time=datetime.datetime(2023, 3, 1, 0, 0, 10)
+            )
+            assert len(columns["value"]) == 30
+            assert sorted(columns["value"]) == sorted(expected["value"])
+            assert sorted(columns["timestamp"]) == sorted(expected["timestamp"])
+            assert set(columns["vehicle_id"]) == {vehicle_ids[0]}
+
+            counts = await async_aggregate_detections(bucket="hour", group_by="vehicle_id", vehicle_id=vehicle_ids[2])
+            assert list(counts["count"]) == [40]
+
+            fleet = await async_get_fleet(vehicle_ids)
+            assert [v.id for v in fleet] == vehicle_ids
+            assert [len(v.detections) for v in fleet] == [80, 40, 40, 40]
+
+            current = await async_get_current_statuses(vehicle_ids=vehicle_ids)
+            assert [c.status for c in current] == ["driving"] * 4
+
+            # using a given session, and iterating with a server-side cursor
+            async with AsyncSmartSession() as session:
+                streamed = [d async for d in async_iter_detections(vehicle_id=vehicle_ids[3], session=session)]
+                assert len(streamed) == 40
+                chunks = [c async for c in async_iter_detections(vehicle_id=vehicle_ids[3], chunk_size=15, chunks=True)]
+                assert [len(c) for c in chunks] == [15, 15, 10]
+                assert len(await async_get_reports(vehicle_id=vehicle_ids[3], session=session)) == 10
+
+        finally:
+            await close_async_engine()
+
+    sa.event.listen(sa.engine.Engine, "before_cursor_execute", record)
+    add_ingest_listener(listener)
+    try:
+        asyncio.run(main())
+    finally:
+        sa.event.remove(sa.engine.Engine, "before_cursor_execute", record)
+        remove_ingest_listener(listener)
+        clear_vehicles(vehicle_ids)
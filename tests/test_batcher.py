@@ -0,0 +1,165 @@
+import os
+import json
+import time
+import queue
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import sqlalchemy as sa
+
+from tests.conftest import clear_vehicles
+
+from models.base import CODE_ROOT, SmartSession
+from models.reports import Report
+
+from api.batcher import IngestBatcher
+from api.folder_watch import watcher
+
+
+def make_payload(vehicle_id, num_reports=1):
+    reports = [
+        dict(vehicle_id=vehicle_id, report_time=f"2022-01-01T00:00:{i:02d}Z", status="parking")
+        for i in range(num_reports)
+    ]
+    return dict(vehicle_status=reports)
+
+
+def test_batcher_group_commit():
+    vehicle_ids = [f"batcher_vehicle_{i}" for i in range(40)]
+    clear_vehicles(vehicle_ids)
+
+    try:
+        with IngestBatcher(max_delay=0.05) as batcher:
+            payloads = [make_payload(vid) for vid in vehicle_ids]
+            payloads.append(dict(vehicle_status=[dict(vehicle_id="foo bar", report_time="x", status="wrong!")]))
+
+            # many producers submit at the same time, each one waits for its own status report
+            with ThreadPoolExecutor(max_workers=len(payloads)) as executor:
+                statuses = list(executor.map(batcher.ingest, payloads))
+
+            assert all([s["status"] == "success" and s["reports saved"] == 1 for s in statuses[:-1]])
+            assert statuses[-1]["status"] == "failure"  # fails on its own, the others are saved
+            assert any(["Invalid status value: wrong!" in err for err in statuses[-1]["errors"]])
+
+            assert batcher.counters["payloads"] == len(payloads)
+            assert batcher.counters["batches"] < len(payloads)
+
+        with SmartSession() as session:
+            reports = session.scalars(sa.select(Report).where(Report.vehicle_id.in_(vehicle_ids))).all()
+            assert len(reports) == len(vehicle_ids)
+
+        # a batch that reaches the row limit is flushed without waiting for the delay
+        with IngestBatcher(max_batch_rows=10, max_delay=30) as batcher:
+            t0 = time.monotonic()
+            futures = [batcher.submit(make_payload(vid, num_reports=5)) for vid in vehicle_ids[:2]]
+            assert [f.result(timeout=10)["reports skipped"] for f in futures] == [1, 1]
+            assert time.monotonic() - t0 < 10
+
+            # closing saves everything that is still queued
+            future = batcher.submit(make_payload(vehicle_ids[2], num_reports=3))
+        assert future.result(timeout=0)["reports saved"] == 2
+
+        with pytest.raises(RuntimeError):
+            batcher.submit(make_payload(vehicle_ids[0]))
+
+    finally:
+        clear_vehicles(vehicle_ids)
+
+
+def test_batcher_bad_payloads_and_close():
+    vehicle_ids = [f"batcher_close_vehicle_{i}" for i in range(20)]
+    clear_vehicles(vehicle_ids)
+
+    try:
+        with IngestBatcher(max_delay=0.01) as batcher:
+            # payloads with fields of the wrong type fail on their own, instead of breaking submit()
+            bad_payloads = [{"vehicle_status": 5}, {"objects_detection_events": [{"detections": 3}]}, [1, 2]]
+            statuses = [batcher.ingest(payload) for payload in bad_payloads]
+            assert all([s["status"] == "failure" for s in statuses])
+
+        # payloads submitted while closing are either saved, or rejected by submit()
+        batcher = IngestBatcher(max_delay=0.01, flushers=2)
+
+        def submit(vehicle_id):
+            try:
+                return batcher.submit(make_payload(vehicle_id))
+            except RuntimeError:
+                return None
+
+        with ThreadPoolExecutor(max_workers=len(vehicle_ids)) as executor:
+            futures = [executor.submit(submit, vid) for vid in vehicle_ids]
+            batcher.close()
+            futures = [f.result() for f in futures]
+
+        accepted = [f for f in futures if f is not None]
+        assert all([f.result(timeout=0)["status"] == "success" for f in accepted])
+        with SmartSession() as session:
+            reports = session.scalars(sa.select(Report).where(Report.vehicle_id.in_(vehicle_ids))).all()
+            assert len(reports) == len(accepted)
+
+    finally:
+        clear_vehicles(vehicle_ids)
+
+
+def test_batcher_full_queue():
+    # without flushers, nothing is taken from the queue (and nothing is written), unless done here
+    batcher = IngestBatcher(max_queue=1, flushers=0)
+    batcher.submit(make_payload("full_queue_vehicle"))
+
+    # a producer waiting for room in the queue does not block the others, or close()
+    blocked = threading.Thread(target=batcher.submit, args=(make_payload("full_queue_vehicle"),))
+    blocked.start()
+    time.sleep(0.1)
+    t0 = time.monotonic()
+    with pytest.raises(queue.Full):
+        batcher.submit(make_payload("full_queue_vehicle"), block=False)
+    assert time.monotonic() - t0 < 0.5
+
+    closing = threading.Thread(target=batcher.close)
+    closing.start()
+    time.sleep(0.1)
+    assert batcher.closed
+    with pytest.raises(RuntimeError):
+        batcher.submit(make_payload("full_queue_vehicle"), block=False)
+
+    # close() waits for the payload that is being queued
+    assert closing.is_alive()
+    batcher.queue.get()
+    blocked.join(timeout=1)
+    closing.join(timeout=1)
+    assert not blocked.is_alive() and not closing.is_alive()
+    assert batcher.queue.qsize() == 1
+
+
+def test_watcher_with_batcher():
+    temp_dir = os.path.join(CODE_ROOT, "temp_batcher")
+    vehicle_ids = [f"batcher_file_vehicle_{i}" for i in range(10)]
+    clear_vehicles(vehicle_ids)
+
+    try:
+        os.makedirs(temp_dir, exist_ok=True)
+        for i, vid in enumerate(vehicle_ids):
+            with open(os.path.join(temp_dir, f"file_{i:02d}.json"), "w") as f:
+                json.dump(make_payload(vid, num_reports=i + 1), f)
+        with open(os.path.join(temp_dir, "file_99.json"), "w") as f:
+            f.write("this is not JSON")
+
+        with IngestBatcher(max_delay=0.05) as batcher:
+            statuses = watcher(temp_dir, timeout=1, interval=0.1, batcher=batcher)
+
+            # the small files were saved together, in fewer transactions than files
+            assert batcher.counters["batches"] < len(vehicle_ids)
+
+        assert [s["reports saved"] for s in statuses[:-1]] == [i + 1 for i in range(len(vehicle_ids))]
+        assert statuses[-1]["status"] == "failure"
+        assert len(os.listdir(temp_dir)) == 0
+
+        with pytest.raises(ValueError):
+            watcher(temp_dir, timeout=0.1, workers=2, batcher=batcher)
+
+    finally:
+        if os.path.isdir(temp_dir):
+            shutil.rmtree(temp_dir)
+        clear_vehicles(vehicle_ids)
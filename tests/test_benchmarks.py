@@ -0,0 +1,60 @@
+import os
+import json
+
+import pytest
+
+from tests.conftest import clear_vehicles
+
+from api.ingest import ingest_file
+
+from benchmarks.generate import generate_payloads, parse_distribution, write_drop_files
+
+
+def test_generate_payloads():
+    draw, mean = parse_distribution("uniform:1:3")
+    assert mean == 2
+    with pytest.raises(ValueError):
+        parse_distribution("normal:3")
+
+    kwargs = dict(vehicles=5, events_per_vehicle=200, detections="fixed:2", out_of_order_rate=0.1, duplicate_rate=0.05)
+    stats = {}
+    payloads = list(generate_payloads(events_per_file=150, max_delay=20, stats=stats, **kwargs))
+    events = [e for p in payloads for e in p["objects_detection_events"]]
+    assert [len(p["objects_detection_events"]) for p in payloads[:-1]] == [150] * (len(payloads) - 1)
+    assert len(events) == stats["events"] == 1000 + stats["duplicates"]
+    assert stats["detections"] == 2 * stats["events"]
+    assert stats["reports"] == sum(len(p["vehicle_status"]) for p in payloads)
+    assert 50 < stats["delayed"] < 150
+    assert 20 < stats["duplicates"] < 80
+
+    # mostly in time order, but some events arrive late
+    times = [e["detection_time"] for e in events]
+    late = sum(t1 > t2 for t1, t2 in zip(times[:-1], times[1:]))
+    assert 0 < late < stats["delayed"] + stats["duplicates"]
+
+    # the same seed gives the same data
+    assert list(generate_payloads(events_per_file=150, max_delay=20, **kwargs)) == payloads
+
+
+def test_write_drop_files(tmp_path):
+    result = write_drop_files(tmp_path, vehicles=3, events_per_vehicle=50, duplicate_rate=0.1, events_per_file=40)
+    assert result["files"] == [os.path.join(tmp_path, f"fleet_{i:06d}.json") for i in range(len(result["files"]))]
+    assert sorted(os.listdir(tmp_path)) == [os.path.basename(f) for f in result["files"]]
+
+    vehicle_ids = [f"vehicle_{i:06d}" for i in range(3)]
+    clear_vehicles(vehicle_ids)
+    try:
+        saved = skipped = 0
+        for filename in result["files"]:
+            with open(filename) as f:
+                json.load(f)  # each file is valid JSON
+            status = ingest_file(filename)
+            assert status["status"] == "success"
+            saved += status["reports saved"] + status["detections saved"]
+            skipped += status["reports skipped"] + status["detections skipped"]
+
+        # the duplicate events are skipped
+        assert saved + skipped == result["detections"] + result["reports"]
+        assert skipped >= result["duplicates"]  # each duplicate event has one or more detections or reports
+    finally:
+        clear_vehicles(vehicle_ids)
@@ -0,0 +1,46 @@
+import pytest
+
+from models.base import SmartSession
+from models.indexes import INDEX_PROFILE, INDEX_PROFILES, apply_index_profile, get_secondary_indexes
+
+from api.query import get_detections
+
+
+def profile_names(profile, table_name):
+    return sorted(name for name, _, _ in INDEX_PROFILES[profile][table_name])
+
+
+def test_index_profiles():
+    # the tables were created with the default profile
+    with SmartSession() as session:
+        for table_name in ["vehicles", "reports", "detections"]:
+            assert get_secondary_indexes(table_name, session) == profile_names(INDEX_PROFILE, table_name)
+
+    num_detections = len(get_detections())
+
+    try:
+        result = apply_index_profile("write")
+        assert "ix_detections_timestamp_brin" in result["created"]
+        assert "ix_detections_timestamp_brin" not in result["dropped"]
+        with SmartSession() as session:
+            assert get_secondary_indexes("detections", session) == ["ix_detections_timestamp_brin"]
+            assert get_secondary_indexes("vehicles", session) == []
+
+        # applying the same profile again does nothing
+        assert apply_index_profile("write") == {"created": [], "dropped": []}
+
+        # the indexes change how the data is found, not what is found
+        assert len(get_detections()) == num_detections
+
+        apply_index_profile("full", concurrently=True)
+        with SmartSession() as session:
+            assert get_secondary_indexes("detections", session) == profile_names("full", "detections")
+
+        with pytest.raises(ValueError):
+            apply_index_profile("fastest")
+
+    finally:
+        apply_index_profile(INDEX_PROFILE)
+
+    with SmartSession() as session:
+        assert get_secondary_indexes("detections", session) == profile_names(INDEX_PROFILE, "detections")
@@ -1,23 +1,29 @@
+import io
 import os
 import datetime
 import json
 
+import pytest
 import sqlalchemy as sa
 
-from tests.conftest import DATA_DIR
+from tests.conftest import DATA_DIR, clear_vehicles
 
 from models.base import SmartSession
 from models.reports import Report
 from models.detections import Detection
 from models.vehicles import Vehicle
 
-from api.ingest import ingest
+import api.ingest
+from api.ingest import ingest, ingest_file, resolve_vehicles, forget_vehicles
+from api.json_stream import iter_json_items
 
 
 def test_ingest_detections():
     with open(os.path.join(DATA_DIR, "objects.json")) as f:
         data_string = f.read()
 
+    clear_vehicles(["ebab5f787798416fb2b8afc1340d7a4e"])
+
     with SmartSession() as session:
         det_count_start = len(session.scalars(sa.select(Detection)).all())
 
@@ -25,7 +31,8 @@ def test_ingest_detections():
 
     assert status["status"] == "success"
     assert status["reports saved"] == 0
-    assert status["detections saved"] == 7
+    assert status["detections saved"] == 6
+    assert status["detections skipped"] == 1  # the file has one duplicate detection (pedestrians, 3)
     assert status["errors"] == []
 
     vid = "ebab5f787798416fb2b8afc1340d7a4e"
@@ -38,10 +45,10 @@ def test_ingest_detections():
 
     with SmartSession() as session:
         det_count_new = len(session.scalars(sa.select(Detection)).all())
-        assert det_count_new - det_count_start == 7
+        assert det_count_new - det_count_start == 6
 
         vehicle = session.scalars(sa.select(Vehicle).where(Vehicle.id == vid)).first()
-        assert len(vehicle.detections) >= 7  # there is no deduplication on detections, so past test may have added some
+        assert len(vehicle.detections) == 6
 
         for time, objs in zip(times, objects):
             det = session.scalars(sa.select(Detection).where(Detection.timestamp == time)).all()
@@ -49,6 +56,17 @@ def test_ingest_detections():
                 assert any([d.type == obj for d in det])  # this also verifies we have enough detections
             assert all([d.vehicle == vehicle for d in det])  # make sure all detections are for the right vehicle
 
+    # ingesting the same data again does not add any detections
+    status = ingest(data_string)
+
+    assert status["status"] == "success"
+    assert status["detections saved"] == 0
+    assert status["detections skipped"] == 7
+
+    with SmartSession() as session:
+        det_count_new = len(session.scalars(sa.select(Detection)).all())
+        assert det_count_new - det_count_start == 6
+
 
 def test_illegal_object_type():
     data = dict(
@@ -86,18 +104,27 @@ def test_ingest_reports():
     with open(os.path.join(DATA_DIR, "statuses.json")) as f:
         data_string = f.read()
 
+    vids = [
+        "ebab5f787798416fb2b8afc1340d7a4e",
+        "ebae3f787798416fb2b8afc1340d7a6d",
+        "qbae3f787798416fb2b8afc1340ddf19",
+    ]
+    clear_vehicles(vids)
+
     status = ingest(data_string)
 
     assert status["status"] == "success"
     assert status["reports saved"] == 3
+    assert status["reports skipped"] == 0
     assert status["detections saved"] == 0
     assert status["errors"] == []
 
-    vids = [
-        "ebab5f787798416fb2b8afc1340d7a4e",
-        "ebae3f787798416fb2b8afc1340d7a6d",
-        "qbae3f787798416fb2b8afc1340ddf19",
-    ]
+    # ingesting the same data again does not add any reports
+    status = ingest(data_string)
+
+    assert status["status"] == "success"
+    assert status["reports saved"] == 0
+    assert status["reports skipped"] == 3
     times = [
         datetime.datetime.strptime("2022-05-05T22:02:34.546Z", "%Y-%m-%dT%H:%M:%S.%fZ"),
         datetime.datetime.strptime("2022-05-06T00:02:34.546Z", "%Y-%m-%dT%H:%M:%S.%fZ"),
@@ -112,11 +139,11 @@ def test_ingest_reports():
             vehicles = session.scalars(sa.select(Vehicle).where(Vehicle.id == vid)).all()
             assert len(vehicles) == 1  # deduplication should make sure no vehicles are duplicated in the DB
             assert vehicles[0].id == vid
-            assert len(vehicles[0].reports) > 0  # no deduplication on reports, so there could be more than one
+            assert len(vehicles[0].reports) == 1  # duplicate reports are not saved
             assert all([rep.status == status for rep in vehicles[0].reports])  # make sure all reports are as expected
 
             reports = session.scalars(sa.select(Report).where(Report.vehicle_id == vid)).all()
-            assert len(reports) >= 1  # no deduplication on reports, so there could be more than one
+            assert len(reports) == 1
             assert reports[0].vehicle_id == vid
             assert reports[0].timestamp == time
             assert all([rep.status == status for rep in reports])  # make sure all reports are as expected
@@ -155,3 +182,137 @@ def test_illegal_report_type():
     assert status["reports saved"] == 0
     assert status["detections saved"] == 0
     assert status["errors"] == []
+
+
+def test_bulk_and_orm_ingest_modes():
+    with open(os.path.join(DATA_DIR, "objects.json")) as f:
+        data_string = f.read()
+
+    vid = "ebab5f787798416fb2b8afc1340d7a4e"
+
+    for first, second in [(True, False), (False, True)]:
+        clear_vehicles([vid])
+
+        status = ingest(data_string, bulk=first)
+
+        assert status["status"] == "success"
+        assert status["detections saved"] == 6
+        assert status["detections skipped"] == 1
+        assert status["errors"] == []
+
+        with SmartSession() as session:
+            detections = session.scalars(sa.select(Detection).where(Detection.vehicle_id == vid)).all()
+            assert len(detections) == 6
+            assert all([det.created_at is not None for det in detections])
+            assert {"pedestrians", "cars", "signs", "trucks", "obstacles"} == {det.type for det in detections}
+
+        # both modes skip the same duplicates
+        status = ingest(data_string, bulk=second)
+
+        assert status["status"] == "success"
+        assert status["detections saved"] == 0
+        assert status["detections skipped"] == 7
+
+
+def test_vehicle_id_cache():
+    with open(os.path.join(DATA_DIR, "statuses.json")) as f:
+        data_string = f.read()
+
+    vids = [
+        "ebab5f787798416fb2b8afc1340d7a4e",
+        "ebae3f787798416fb2b8afc1340d7a6d",
+        "qbae3f787798416fb2b8afc1340ddf19",
+    ]
+
+    status = ingest(data_string)
+    assert status["status"] == "success"
+    assert all([vid in api.ingest._known_vehicles for vid in vids])
+
+    # known vehicles are not looked up again
+    with SmartSession() as session:
+        assert resolve_vehicles(vids, session) == []
+
+    # deleting a vehicle using the ORM removes it from the cache
+    with SmartSession() as session:
+        session.delete(session.scalars(sa.select(Vehicle).where(Vehicle.id == vids[1])).first())
+        session.commit()
+
+    assert vids[1] not in api.ingest._known_vehicles
+    assert vids[0] in api.ingest._known_vehicles
+
+    # the deleted vehicle is re-created on the next ingest
+    status = ingest(data_string)
+    assert status["status"] == "success"
+    assert status["reports saved"] == 1
+    assert status["reports skipped"] == 2
+
+    with SmartSession() as session:
+        vehicles = session.scalars(sa.select(Vehicle).where(Vehicle.id.in_(vids))).all()
+        assert len(vehicles) == 3
+
+    # a vehicle deleted without the ORM (e.g., by another process) is still in the cache,
+    # but the ingestion re-creates it instead of failing on the foreign key
+    with SmartSession() as session:
+        session.execute(sa.delete(Vehicle).where(Vehicle.id == vids[2]))
+        session.commit()
+    assert vids[2] in api.ingest._known_vehicles
+
+    for bulk in [True, False]:
+        status = ingest(data_string, bulk=bulk)
+        assert status["status"] == "success"
+        assert status["reports saved"] == (1 if bulk else 0)
+
+    with SmartSession() as session:
+        assert session.scalar(sa.select(Vehicle).where(Vehicle.id == vids[2])) is not None
+
+    forget_vehicles()
+    assert len(api.ingest._known_vehicles) == 0
+
+
+def test_json_stream_reader():
+    for filename in ["objects.json", "statuses.json"]:
+        with open(os.path.join(DATA_DIR, filename)) as f:
+            data_dict = json.load(f)
+
+        # use tiny blocks to make sure values that straddle block boundaries are parsed correctly
+        for block_size in [1, 3, 7, 2**16]:
+            items = list(iter_json_items(os.path.join(DATA_DIR, filename), block_size=block_size))
+            expected = [(key, item) for key, value in data_dict.items() for item in value]
+            assert items == expected
+
+    values = [12345678, -1.5e-7, 'caf\u00e9 \\ "quoted"', None]
+    data_string = json.dumps(dict(a=values, b=dict(c=[1, 2]), d=[], e=[[1]]))
+    for block_size in [1, 2, 5, 100]:
+        items = list(iter_json_items(io.BytesIO(data_string.encode()), block_size=block_size))
+        assert items == [("a", 12345678), ("a", -1.5e-7), ("a", 'caf\u00e9 \\ "quoted"'), ("a", None), ("e", [1])]
+
+    for bad_string in ['{"a": [1, 2', '{"a": [1 2]}', "[1, 2]", '{"a": [1]} extra']:
+        with pytest.raises(ValueError):
+            list(iter_json_items(io.StringIO(bad_string), block_size=2))
+
+
+def test_ingest_file_in_chunks():
+    filename = os.path.join(DATA_DIR, "objects.json")
+    vid = "ebab5f787798416fb2b8afc1340d7a4e"
+    clear_vehicles([vid])
+
+    # each chunk is saved separately, but the status adds up all the chunks
+    status = ingest_file(filename, chunk_size=2)
+    assert status["status"] == "success"
+    assert status["detections saved"] == 6
+    assert status["detections skipped"] == 1
+    assert status["errors"] == []
+
+    with open(filename, "rb") as stream:
+        status = ingest_file(stream)
+    assert status["status"] == "success"
+    assert status["detections saved"] == 0
+    assert status["detections skipped"] == 7
+
+    with SmartSession() as session:
+        det_count = len(session.scalars(sa.select(Detection).where(Detection.vehicle_id == vid)).all())
+        assert det_count == 6
+
+    status = ingest_file(io.StringIO('{"vehicle_status": [{"vehicle_id": "foo bar", "report_time": '))
+    assert status["status"] == "failure"
+    assert any(["Could not parse data" in err for err in status["errors"]])
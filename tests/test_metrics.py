@@ -0,0 +1,121 @@
+import os
+import time
+import shutil
+import socket
+import threading
+import urllib.request
+
+import sqlalchemy as sa
+
+from tests.conftest import DATA_DIR, clear_vehicles
+
+from api.ingest import ingest, ingest_file
+from api.metrics import INGEST_STAGES, IngestMetrics, serve_metrics, record_metrics, _count_statement
+from api.folder_watch import watcher
+
+VEHICLE_IDS = [
+    "ebab5f787798416fb2b8afc1340d7a4e",
+    "ebae3f787798416fb2b8afc1340d7a6d",
+    "qbae3f787798416fb2b8afc1340ddf19",
+]
+
+
+def test_ingest_instrumentation():
+    clear_vehicles(VEHICLE_IDS)
+    with open(os.path.join(DATA_DIR, "objects.json")) as f:
+        data = f.read()
+
+    try:
+        status = ingest(data)
+        assert status["status"] == "success"
+        assert "timings" not in status  # only when asked for
+
+        for bulk in [True, False]:
+            status = ingest(data, bulk=bulk, instrument=True)
+            assert status["status"] == "success"
+            assert status["detections skipped"] == 7
+            assert list(status["timings"]) == INGEST_STAGES + ["total"]
+            assert all(status["timings"][name] >= 0 for name in INGEST_STAGES)
+            assert sum(status["timings"][name] for name in INGEST_STAGES) <= status["timings"]["total"] + 1e-5
+            assert status["timings"]["write"] > 0 and status["timings"]["commit"] > 0
+            # at least the COPY and the insert from the staging table, plus the begin and the commit
+            assert status["sql statements"] >= 2
+            assert status["sql round trips"] >= status["sql statements"] + 2
+            assert status["rows per second"] > 0
+
+        status = ingest_file(os.path.join(DATA_DIR, "statuses.json"), instrument=True)
+        assert status["reports saved"] == 3
+        assert status["timings"]["vehicles"] > 0
+        assert status["sql statements"] >= 4  # also creates the vehicles
+
+        status = ingest("not json", instrument=True)
+        assert status["status"] == "failure"
+        assert status["sql statements"] == 0
+
+        # the statements are only counted (by listening to the engine events) while an ingest call is measured
+        assert not sa.event.contains(sa.engine.Engine, "before_cursor_execute", _count_statement)
+        with record_metrics({}):
+            assert sa.event.contains(sa.engine.Engine, "before_cursor_execute", _count_statement)
+        assert not sa.event.contains(sa.engine.Engine, "before_cursor_execute", _count_statement)
+
+    finally:
+        clear_vehicles(VEHICLE_IDS)
+
+
+def test_prometheus_metrics(tmp_path):
+    metrics = IngestMetrics()
+    metrics.observe(dict(status="failure", errors=["bad"], **{"reports saved": 0, "detections saved": 0}))
+    text = metrics.render()
+    assert 'mobileye_ingest_calls_total{status="failure"} 1' in text
+    assert "duration_seconds" not in text  # the status report was not instrumented
+
+    # label values are escaped
+    escaped = IngestMetrics()
+    escaped.increment("escaped_total", path='C:\\data\n"new"')
+    assert 'mobileye_ingest_escaped_total{path="C:\\\\data\\n\\"new\\""} 1' in escaped.render()
+
+    # the watcher adds the status of each file, and serves the metrics while it runs
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    clear_vehicles(VEHICLE_IDS)
+    try:
+        for name in ["objects.json", "statuses.json"]:
+            shutil.copyfile(os.path.join(DATA_DIR, name), os.path.join(tmp_path, name))
+        kwargs = dict(working_dir=str(tmp_path), timeout=3, interval=0.1, metrics=metrics, metrics_port=port)
+        thread = threading.Thread(target=watcher, kwargs=kwargs)
+        thread.start()
+
+        t0 = time.monotonic()
+        while 'calls_total{status="success"} 2' not in metrics.render() and time.monotonic() - t0 < 3:
+            time.sleep(0.05)
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics") as response:
+            assert response.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+            text = response.read().decode()
+        thread.join()
+
+        assert 'mobileye_ingest_calls_total{status="success"} 2' in text
+        assert 'mobileye_ingest_rows_total{result="saved",table="detections"} 6' in text
+        assert 'mobileye_ingest_rows_total{result="skipped",table="detections"} 1' in text
+        assert 'mobileye_ingest_rows_total{result="saved",table="reports"} 3' in text
+        assert "# TYPE mobileye_ingest_duration_seconds histogram" in text
+        assert 'mobileye_ingest_duration_seconds_bucket{le="+Inf"} 2' in text
+        assert "mobileye_ingest_duration_seconds_count 2" in text
+        assert 'mobileye_ingest_stage_duration_seconds_count{stage="commit"} 2' in text
+        assert "mobileye_ingest_sql_statements_total" in text
+
+        # the buckets are cumulative
+        buckets = [line for line in text.splitlines() if line.startswith("mobileye_ingest_duration_seconds_bucket")]
+        counts = [int(line.split()[-1]) for line in buckets]
+        assert counts == sorted(counts)
+    finally:
+        clear_vehicles(VEHICLE_IDS)
+
+    # a server can also be started on its own
+    server = serve_metrics(metrics, 0)
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{server.server_address[1]}/metrics") as response:
+            assert response.read().decode() == metrics.render()
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,75 @@
+import pytest
+import sqlalchemy as sa
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy_utils import database_exists, create_database, drop_database
+
+from models.base import get_engine_config
+from models.migrate import migrate_schema, get_column_type
+
+# the schema of older versions: strings instead of enums, and no unique natural keys
+OLD_SCHEMA = [
+    "CREATE TABLE vehicles (id VARCHAR PRIMARY KEY, created_at TIMESTAMP NOT NULL, modified TIMESTAMP)",
+    "CREATE TABLE reports (id BIGSERIAL PRIMARY KEY, vehicle_id VARCHAR NOT NULL REFERENCES vehicles(id), "
+    "status VARCHAR NOT NULL, timestamp TIMESTAMP NOT NULL, created_at TIMESTAMP NOT NULL, modified TIMESTAMP)",
+    "CREATE TABLE detections (id BIGSERIAL PRIMARY KEY, vehicle_id VARCHAR NOT NULL REFERENCES vehicles(id), "
+    "type VARCHAR NOT NULL, value FLOAT NOT NULL, timestamp TIMESTAMP NOT NULL, "
+    "created_at TIMESTAMP NOT NULL, modified TIMESTAMP)",
+    "INSERT INTO vehicles VALUES ('old_vehicle', now(), now())",
+]
+
+
+def test_migrate_schema():
+    url = get_engine_config()["url"].rsplit("/", 1)[0] + "/mobileye_hw_migrate"
+    if database_exists(url):
+        drop_database(url)
+    create_database(url)
+    engine = sa.create_engine(url)
+
+    try:
+        with engine.begin() as connection:
+            for stmt in OLD_SCHEMA:
+                connection.execute(sa.text(stmt))
+            insert = "INSERT INTO reports VALUES (DEFAULT, 'old_vehicle', :status, '2022-01-01', now())"
+            for status in ["parking", "parking", "driving"]:
+                connection.execute(sa.text(insert), {"status": status})
+            insert = "INSERT INTO detections VALUES (DEFAULT, 'old_vehicle', :type, 1, '2022-01-01', now())"
+            for object_type in ["cars", "cars", "signs", "boats"]:
+                connection.execute(sa.text(insert), {"type": object_type})
+
+        # a value that is not part of the enum stops the migration, without changing anything
+        with sessionmaker(bind=engine)() as session:
+            with pytest.raises(ValueError, match="boats"):
+                migrate_schema(session=session)
+        with sessionmaker(bind=engine)() as session:
+            assert get_column_type("detections", "type", session) == "varchar"
+            assert session.scalar(sa.select(sa.func.to_regclass("detection_rollups"))) is None
+
+        with engine.begin() as connection:
+            connection.execute(sa.text("DELETE FROM detections WHERE type = 'boats'"))
+
+        with sessionmaker(bind=engine)() as session:
+            results = migrate_schema(session=session)
+        assert "detection_rollups" in results["created"]
+        assert sorted(results["converted"]) == ["detections.type", "reports.status"]
+        assert results["deleted"] == {"reports": 1, "detections": 1}
+        assert sorted(results["indexes"]) == ["ix_detections_natural_key", "ix_reports_natural_key"]
+
+        with sessionmaker(bind=engine)() as session:
+            assert get_column_type("detections", "type", session) == "object_type"
+            assert get_column_type("reports", "status", session) == "report_status"
+
+            # duplicates are now skipped by the natural key
+            inserted = session.execute(
+                sa.text(
+                    "INSERT INTO reports (vehicle_id, status, timestamp, created_at) "
+                    "VALUES ('old_vehicle', 'parking', '2022-01-01', now()) ON CONFLICT DO NOTHING"
+                )
+            )
+            assert inserted.rowcount == 0
+
+            # a database that is up to date is not changed
+            assert migrate_schema(session=session) == {"created": [], "converted": [], "deleted": {}, "indexes": []}
+
+    finally:
+        engine.dispose()
+        drop_database(url)
@@ -0,0 +1,104 @@
+import os
+import sys
+import subprocess
+
+from models.base import CODE_ROOT, get_engine_config
+
+# the tables are partitioned (or not) when the models are defined, so this runs in a separate process,
+# with its own database (partitioning cannot be added to the tables of the main test database)
+PARTITIONED_SCRIPT = """
+import datetime
+import sqlalchemy as sa
+from sqlalchemy_utils import database_exists, drop_database
+
+from models.base import Session, SmartSession
+from models.detections import Detection
+from models.reports import Report
+from models.rollups import DetectionRollup
+from models.current_status import CurrentStatus
+from models.partitions import list_partitions, create_partitions, drop_partitions, is_partitioned
+from models.partitions import create_upcoming_partitions
+from api.ingest import ingest_data
+from api.query import get_detections
+
+engine = Session().get_bind()
+assert is_partitioned(Detection.__table__) and is_partitioned(Report.__table__)
+
+# partitions for the current and next days are created together with the tables
+today = datetime.datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+names = [p[0] for p in list_partitions(Detection.__table__)]
+assert names[0] == f"detections_p{today:%Y%m%d}", names
+names = create_upcoming_partitions()
+assert len(names) == 6 and f"reports_p{today:%Y%m%d}" in names, names
+
+data = dict(
+    vehicle_status=[dict(vehicle_id="partition_vehicle", report_time=f"2022-01-0{d}T10:00:00Z", status="parking")
+                    for d in range(1, 4)],
+    objects_detection_events=[
+        dict(vehicle_id="partition_vehicle", detection_time=f"2022-01-0{d}T10:00:00Z",
+             detections=[dict(object_type="cars", object_value=d)])
+        for d in range(1, 4)
+    ],
+)
+status = ingest_data(data)
+assert status["status"] == "success", status
+assert status["detections saved"] == 3 and status["reports saved"] == 3, status
+
+# the missing partitions were created while ingesting
+partitions = list_partitions(Detection.__table__)
+assert [p[0] for p in partitions[:3]] == [f"detections_p2022010{d}" for d in range(1, 4)], partitions
+assert partitions[0][1:] == (datetime.datetime(2022, 1, 1), datetime.datetime(2022, 1, 2))
+
+# ingesting the same data again still skips the duplicates
+status = ingest_data(data)
+assert status["detections skipped"] == 3 and status["reports skipped"] == 3, status
+
+# new partitions for a known vehicle are created and committed on another connection,
+# so they are not kept locked until the ingestion commits (and remain even if it is rolled back)
+new_report = dict(vehicle_id="partition_vehicle", report_time="2022-02-01T10:00:00Z", status="driving")
+new_data = dict(vehicle_status=[new_report])
+with SmartSession() as session:
+    status = ingest_data(new_data, session=session, commit=False)
+    assert status["reports saved"] == 1, status
+    assert "reports_p20220201" in [p[0] for p in list_partitions(Report.__table__)]
+    session.rollback()
+
+# querying a time range only scans the partitions that overlap with it
+start, end = datetime.datetime(2022, 1, 2), datetime.datetime(2022, 1, 2, 23)
+assert [d.value for d in get_detections(start_time=start, end_time=end)] == [2]
+with SmartSession() as session:
+    stmt = sa.select(Detection).where(Detection.timestamp >= start, Detection.timestamp <= end)
+    plan = session.execute(sa.text("EXPLAIN " + str(stmt.compile(engine, compile_kwargs={"literal_binds": True}))))
+    plan = "\\n".join(row[0] for row in plan)
+    assert "detections_p20220102" in plan and "detections_p20220101" not in plan, plan
+
+assert create_partitions(datetime.datetime(2022, 1, 3), datetime.datetime(2022, 1, 4), tables=[Report.__table__]) == [
+    "reports_p20220103", "reports_p20220104"
+]
+
+# old data is removed by dropping whole partitions
+dropped = drop_partitions(datetime.datetime(2022, 1, 3))
+assert sorted(dropped) == ["detections_p20220101", "detections_p20220102", "reports_p20220101", "reports_p20220102"]
+assert [d.value for d in get_detections()] == [3]
+
+# the rollups of the dropped data are deleted, and so are the current statuses that refer to dropped reports
+with SmartSession() as session:
+    buckets = session.scalars(sa.select(DetectionRollup.bucket).distinct()).all()
+    assert len(buckets) > 0 and min(buckets) >= datetime.datetime(2022, 1, 3), buckets
+    assert session.scalar(sa.select(CurrentStatus.timestamp)) == datetime.datetime(2022, 1, 3, 10)
+assert drop_partitions(datetime.datetime(2022, 1, 4), tables=[Report.__table__]) == ["reports_p20220103"]
+with SmartSession() as session:
+    assert session.scalar(sa.select(sa.func.count()).select_from(CurrentStatus)) == 0
+
+Session().close()
+engine.dispose()
+drop_database(engine.url)
+"""
+
+
+def test_partitioned_tables():
+    url = get_engine_config()["url"].rsplit("/", 1)[0] + "/mobileye_hw_partitioned"
+    env = dict(os.environ, MOBILEYE_DB_URL=url, MOBILEYE_DB_PARTITION="day", PYTHONPATH=CODE_ROOT)
+    result = subprocess.run([sys.executable, "-c", PARTITIONED_SCRIPT], env=env, capture_output=True, text=True)
+
+    assert result.returncode == 0, result.stderr
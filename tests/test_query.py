@@ -2,17 +2,22 @@ import os
 import datetime
 import json
 
+import numpy as np
+import pytest
 import sqlalchemy as sa
 
-from tests.conftest import DATA_DIR
+from tests.conftest import DATA_DIR, clear_vehicles
 
 from models.base import SmartSession
 from models.reports import Report
-from models.detections import Detection
+from models.detections import Detection, OBJECT_TYPES
 from models.vehicles import Vehicle
 
-from api.query import get_reports, get_detections, get_vehicle
-from api.ingest import ingest
+import api.query
+from api.query import get_reports, get_detections, get_vehicle, iter_detections, iter_reports, get_detections_columns
+from api.query import get_current_statuses, make_cursor, get_fleet
+from api.rollups import backfill_current_status
+from api.ingest import ingest, ingest_data
 
 
 def test_query_parameters():
@@ -46,7 +51,7 @@ def test_query_parameters():
         vid = vehicle_ids[0]
         vehicle = get_vehicle(vid, session=session)
         assert vehicle.id == vid
-        assert len(vehicle.detections) == 7
+        assert len(vehicle.detections) == 6  # one of the detections in the file is a duplicate
         assert len(vehicle.reports) == 1
         assert vehicle.reports[0].status == "driving"
 
@@ -124,6 +129,11 @@ def test_query_parameters():
         detections = get_detections(types=["cars", "trucks"], session=session)
         assert len(detections) == 3
 
+        # types are stored as an enum in the database, but are still given and returned as strings
+        assert isinstance(detections[0].type, str)
+        assert get_detections(types="unicorns", session=session) == []
+        assert len(get_detections(types=["unicorns", "trucks"], session=session)) == 1
+
         # filter by exact values
         detections = get_detections(exact_values=5.0, session=session)
         assert len(detections) == 1
@@ -140,7 +150,7 @@ def test_query_parameters():
         assert {"trucks", "cars"} == {det.type for det in detections}
 
         detections = get_detections(value_maximum=4.0, session=session)
-        assert len(detections) == 6
+        assert len(detections) == 5
         assert all([det.value <= 4.0 for det in detections])
         assert {"pedestrians", "signs", "obstacles", "cars"} == {det.type for det in detections}  # no trucks!
 
@@ -155,12 +165,318 @@ def test_query_parameters():
         assert {"obstacles", "trucks", "cars"} == {det.type for det in detections}
 
         detections = get_detections(end_time=datetime.datetime(2022, 6, 5, 21, 5, 20, 0), session=session)
-        assert len(detections) == 4
+        assert len(detections) == 3
         assert {"pedestrians", "signs", "cars"} == {det.type for det in detections}
 
         # check that mixed filters work
         detections = get_detections(
             end_time=datetime.datetime(2022, 6, 5, 21, 5, 20, 0), types="pedestrians", session=session
         )
-        assert len(detections) == 2
+        assert len(detections) == 1
         assert all([det.type == "pedestrians" for det in detections])
+
+
+def test_iter_detections():
+    vehicle_id = "iter_vehicle"
+    clear_vehicles([vehicle_id])
+
+    try:
+        events = [
+            dict(
+                vehicle_id=vehicle_id,
+                detection_time=f"2022-02-01T00:{i // 60:02d}:{i % 60:02d}Z",
+                detections=[dict(object_type="signs", object_value=i)],
+            )
+            for i in range(2500)
+        ]
+        reports = [dict(vehicle_id=vehicle_id, report_time="2022-02-01T00:00:00Z", status="parking")]
+        status = ingest_data(dict(objects_detection_events=events, vehicle_status=reports))
+        assert status["detections saved"] == 2500
+
+        # the results are streamed in chunks, with the same criteria as get_detections()
+        chunks = list(iter_detections(vehicle_id=vehicle_id, chunk_size=1000, chunks=True))
+        assert [len(chunk) for chunk in chunks] == [1000, 1000, 500]
+        values = sorted(det.value for chunk in chunks for det in chunk)
+        assert values == sorted(det.value for det in get_detections(vehicle_id=vehicle_id))
+
+        detections = iter_detections(vehicle_id=vehicle_id, value_maximum=99, chunk_size=7)
+        assert sorted(det.value for det in detections) == list(range(100))
+
+        assert [r.status for r in iter_reports(vehicle_id=vehicle_id)] == ["parking"]
+
+        # stopping early releases the cursor and the session
+        detections = iter_detections(vehicle_id=vehicle_id, chunk_size=10)
+        assert next(detections).vehicle_id == vehicle_id
+        detections.close()
+
+        # with an external session, the objects can still lazy load their relationships
+        with SmartSession() as session:
+            for det in iter_detections(vehicle_id=vehicle_id, value_maximum=2, session=session):
+                assert det.vehicle.id == vehicle_id
+            assert len(get_detections(vehicle_id=vehicle_id, session=session)) == 2500  # session is usable after
+
+    finally:
+        clear_vehicles([vehicle_id])
+
+
+def test_get_detections_columns():
+    vehicle_id = "columns_vehicle"
+    clear_vehicles([vehicle_id])
+
+    try:
+        events = [
+            dict(
+                vehicle_id=vehicle_id,
+                detection_time=f"2022-03-01T12:00:{i:02d}.250Z",
+                detections=[dict(object_type=OBJECT_TYPES[i % 3], object_value=i / 2)],
+            )
+            for i in range(30)
+        ]
+        assert ingest_data(dict(objects_detection_events=events))["detections saved"] == 30
+
+        arrays = get_detections_columns(vehicle_id=vehicle_id)
+        assert set(arrays.keys()) == {"timestamp", "vehicle_id", "type", "value"}
+        assert arrays["timestamp"].dtype == np.dtype("datetime64[us]")
+        assert arrays["type"].dtype == np.int8
+        assert arrays["value"].dtype == np.float64
+        assert all([len(a) == 30 for a in arrays.values()])
+
+        # the arrays match the ORM objects, row by row
+        order = np.argsort(arrays["value"])
+        detections = sorted(get_detections(vehicle_id=vehicle_id), key=lambda d: d.value)
+        assert list(arrays["value"][order]) == [d.value for d in detections]
+        assert [OBJECT_TYPES[c] for c in arrays["type"][order]] == [d.type for d in detections]
+        assert list(arrays["timestamp"][order]) == [np.datetime64(d.timestamp, "us") for d in detections]
+        assert set(arrays["vehicle_id"]) == {vehicle_id}
+
+        arrays = get_detections_columns(["value", "id"], vehicle_id=vehicle_id, types="cars", value_minimum=5)
+        assert sorted(arrays["value"]) == [i / 2 for i in range(30) if i % 3 == 1 and i / 2 >= 5]
+        assert arrays["id"].dtype == np.int64
+
+        arrays = get_detections_columns(vehicle_id="no such vehicle")
+        assert all([len(a) == 0 for a in arrays.values()])
+        assert arrays["timestamp"].dtype == np.dtype("datetime64[us]")
+
+        with pytest.raises(ValueError):
+            get_detections_columns(["speed"])
+
+    finally:
+        clear_vehicles([vehicle_id])
+
+
+def test_query_cache(monkeypatch):
+    vehicle_ids = ["cache_vehicle_0", "cache_vehicle_1"]
+    clear_vehicles(vehicle_ids)
+    api.query.invalidate_query_cache()
+
+    def event(vehicle_id, minute, value):
+        detections = [dict(object_type="cars", object_value=value)]
+        return dict(vehicle_id=vehicle_id, detection_time=f"2022-06-01T10:{minute:02d}:00Z", detections=detections)
+
+    try:
+        ingest_data(dict(objects_detection_events=[event(vehicle_ids[0], i, i) for i in range(10)]))
+        kwargs = dict(vehicle_id=vehicle_ids[0], start_time="2022-06-01T10:00:00Z", end_time="2022-06-01T10:30:00")
+        detections = get_detections(cache=True, **kwargs)
+        assert len(detections) == 10
+
+        # the same criteria (given in a different way) get the same objects, without querying again
+        again = get_detections(cache=True, types=["cars"], **kwargs)
+        assert len(again) == 10  # not the same key
+        again = get_detections(cache=True, **dict(kwargs, start_time=datetime.datetime(2022, 6, 1, 10)))
+        assert all(a is b for a, b in zip(again, detections))
+        assert len(get_detections(**kwargs)) == 10 and get_detections(**kwargs)[0] is not detections[0]
+
+        # ingesting other vehicles, or outside the time range, does not evict the results
+        ingest_data(dict(objects_detection_events=[event(vehicle_ids[1], 5, 100)]))
+        ingest_data(dict(objects_detection_events=[event(vehicle_ids[0], 45, 100)]))
+        ingest_data(dict(objects_detection_events=[event(vehicle_ids[0], 5, 5)]))  # a duplicate
+        assert get_detections(cache=True, **kwargs)[0] is detections[0]
+
+        # ingesting new rows that match the criteria evicts the results
+        ingest_data(dict(objects_detection_events=[event(vehicle_ids[0], 20, 100)]))
+        assert len(get_detections(cache=True, **kwargs)) == 11
+        assert len(get_detections(cache=True, types="cars", **kwargs)) == 11
+
+        reports = [dict(vehicle_id=vehicle_ids[0], report_time="2022-06-01T10:00:00Z", status="accident")]
+        assert len(get_reports(statuses="accident", vehicle_id=vehicle_ids[0], cache=True)) == 0
+        ingest_data(dict(vehicle_status=reports))
+        assert len(get_reports(statuses="accident", vehicle_id=vehicle_ids[0], cache=True)) == 1
+
+        # expired results are queried again
+        monkeypatch.setattr(api.query, "QUERY_CACHE_TTL", 0)
+        cached = get_detections(cache=True, value_maximum=5, **kwargs)
+        assert get_detections(cache=True, value_maximum=5, **kwargs)[0] is not cached[0]
+
+        # the least recently used results are evicted
+        monkeypatch.setattr(api.query, "QUERY_CACHE_SIZE", 2)
+        for i in range(5):
+            get_detections(cache=True, value_minimum=i, **kwargs)
+        assert len(api.query._query_cache) == 2
+
+    finally:
+        clear_vehicles(vehicle_ids)
+        api.query.invalidate_query_cache()
+
+
+def test_current_statuses():
+    vehicle_ids = ["current_vehicle_0", "current_vehicle_1", "current_vehicle_2"]
+    clear_vehicles(vehicle_ids)
+
+    def report(i, time, status):
+        return dict(vehicle_id=vehicle_ids[i], report_time=f"2022-07-01T{time}:00Z", status=status)
+
+    try:
+        ingest_data(dict(vehicle_status=[report(0, "10:00", "driving"), report(0, "11:00", "accident")]))
+        ingest_data(dict(vehicle_status=[report(1, "10:00", "driving"), report(2, "09:00", "parking")]))
+        statuses = get_current_statuses(vehicle_ids=vehicle_ids)
+        assert [(s.vehicle_id, s.status) for s in statuses] == [
+            (vehicle_ids[0], "accident"),
+            (vehicle_ids[1], "driving"),
+            (vehicle_ids[2], "parking"),
+        ]
+        assert statuses[0].timestamp == datetime.datetime(2022, 7, 1, 11)
+
+        # a report that arrives late does not replace a newer status
+        ingest_data(dict(vehicle_status=[report(0, "10:30", "parking"), report(1, "12:00", "accident")]))
+        accidents = get_current_statuses("accident", vehicle_ids=vehicle_ids)
+        assert [s.vehicle_id for s in accidents] == vehicle_ids[:2]
+        assert get_current_statuses(["parking", "unicorns"], vehicle_ids=vehicle_ids)[0].vehicle_id == vehicle_ids[2]
+
+        # reports with the same time keep the most severe status, in any order
+        ingest_data(dict(vehicle_status=[report(2, "13:00", "accident")]))
+        ingest_data(dict(vehicle_status=[report(2, "13:00", "driving")]))
+        assert get_current_statuses(vehicle_ids=vehicle_ids[2])[0].status == "accident"
+
+        # the same statuses are recomputed from all the reports
+        expected = [(s.vehicle_id, s.status, s.timestamp) for s in get_current_statuses()]
+        assert backfill_current_status() == len(expected)
+        assert [(s.vehicle_id, s.status, s.timestamp) for s in get_current_statuses()] == expected
+
+    finally:
+        clear_vehicles(vehicle_ids)
+
+
+def test_pagination():
+    vehicle_id = "paging_vehicle"
+    clear_vehicles([vehicle_id])
+
+    try:
+        # three detections per second, so pages must also be split between rows with the same time
+        events = [
+            dict(
+                vehicle_id=vehicle_id,
+                detection_time=f"2022-08-01T00:{i // 60:02d}:{i % 60:02d}Z",
+                detections=[dict(object_type="cars", object_value=i + j / 10) for j in range(3)],
+            )
+            for i in range(100)
+        ]
+        reports = [
+            dict(vehicle_id=vehicle_id, report_time=f"2022-08-01T00:00:{i:02d}Z", status="driving") for i in range(5)
+        ]
+        ingest_data(dict(objects_detection_events=events, vehicle_status=reports))
+
+        for order_by in ["timestamp", "-timestamp"]:
+            pages = [get_detections(vehicle_id=vehicle_id, order_by=order_by, limit=40)]
+            while len(pages[-1]) == 40:
+                cursor = make_cursor(pages[-1][-1], order_by)
+                pages.append(get_detections(vehicle_id=vehicle_id, limit=40, cursor=cursor))  # order from the cursor
+            assert [len(page) for page in pages] == [40] * 7 + [20]
+
+            detections = [det for page in pages for det in page]
+            assert len({det.id for det in detections}) == 300
+            keys = [(det.timestamp, det.id) for det in detections]
+            assert keys == sorted(keys, reverse=order_by.startswith("-"))
+
+        # the cursor can be combined with the other criteria
+        first = get_detections(vehicle_id=vehicle_id, value_minimum=50, order_by="timestamp", limit=1)
+        assert first[0].value == 50
+        cursor = make_cursor(first[0])
+        detections = get_detections(value_minimum=50, vehicle_id=vehicle_id, limit=2, cursor=cursor)
+        assert [d.value for d in detections] == [50.1, 50.2]
+
+        newest = get_reports(vehicle_id=vehicle_id, order_by="-timestamp", limit=2)
+        assert [r.timestamp.second for r in newest] == [4, 3]
+        older = get_reports(vehicle_id=vehicle_id, order_by="-timestamp", cursor=make_cursor(newest[-1], "-timestamp"))
+        assert [r.timestamp.second for r in older] == [2, 1, 0]
+
+        with pytest.raises(ValueError):
+            get_reports(order_by="status")
+        with pytest.raises(ValueError):
+            get_reports(order_by="timestamp", cursor=make_cursor(newest[-1], "-timestamp"))
+        with pytest.raises(ValueError):
+            get_reports(cursor="not a cursor")
+
+    finally:
+        clear_vehicles([vehicle_id])
+
+
+def test_get_fleet():
+    vehicle_ids = [f"fleet_vehicle_{i}" for i in range(20)]
+    late_id = "fleet_late_vehicle"
+    clear_vehicles(vehicle_ids + [late_id])
+
+    try:
+        events = [
+            dict(
+                vehicle_id=vid,
+                detection_time=f"2022-09-01T{h:02d}:00:00Z",
+                detections=[dict(object_type="signs", object_value=i * 100 + h)],
+            )
+            for i, vid in enumerate(vehicle_ids)
+            for h in range(i % 4)
+        ]
+        reports = [
+            dict(vehicle_id=vid, report_time=f"2022-09-01T0{h}:00:00Z", status="driving")
+            for vid in vehicle_ids
+            for h in range(3)
+        ]
+        ingest_data(dict(objects_detection_events=events, vehicle_status=reports))
+
+        statements = []
+        with SmartSession() as session:
+            engine = session.get_bind()
+
+            def count_statements(conn, cursor, statement, parameters, context, executemany):
+                statements.append(statement)
+
+            sa.event.listen(engine, "before_cursor_execute", count_statements)
+            try:
+                ids = list(reversed(vehicle_ids)) + ["no such vehicle"]
+                fleet = get_fleet(ids, start_time="2022-09-01T01:00:00", session=session)
+                assert [v.id for v in fleet] == ids[:-1]
+                for vehicle in fleet:
+                    i = vehicle_ids.index(vehicle.id)
+                    assert [d.value for d in vehicle.detections] == [i * 100 + h for h in range(1, i % 4)]
+                    assert [r.timestamp.hour for r in vehicle.reports] == [1, 2]
+                    assert all(r.vehicle is vehicle for r in vehicle.reports)
+                assert len(statements) == 3  # no lazy loads, no matter how many vehicles
+
+                # the same data, lazy loaded one vehicle at a time
+                session.expunge_all()
+                del statements[:]
+                vehicles = [get_vehicle(vid, session=session) for vid in vehicle_ids]
+                assert sum(len(v.detections) for v in vehicles) == len(events)
+                assert sum(len(v.reports) for v in vehicles) == len(reports)
+                assert len(statements) == 3 * len(vehicle_ids)
+            finally:
+                sa.event.remove(engine, "before_cursor_execute", count_statements)
+
+        # without a session, the loaded objects can be used after it is closed
+        fleet = get_fleet(vehicle_ids[:4], end_time="2022-09-01T01:30:00", reports=False)
+        assert [len(v.detections) for v in fleet] == [0, 1, 2, 2]
+        assert get_fleet([]) == []
+
+        # a vehicle that is added after the vehicles were loaded (before loading the reports) is skipped
+        def add_late_vehicle(orm_execute_state):
+            if sa.inspect(Report) in orm_execute_state.all_mappers:
+                report = dict(vehicle_id=late_id, report_time="2022-09-01T00:00:00Z", status="driving")
+                ingest_data(dict(vehicle_status=[report]))
+
+        with SmartSession() as session:
+            sa.event.listen(session, "do_orm_execute", add_late_vehicle)
+            fleet = get_fleet(vehicle_ids[:2] + [late_id], detections=False, session=session)
+            assert [v.id for v in fleet] == vehicle_ids[:2]
+            sa.event.remove(session, "do_orm_execute", add_late_vehicle)
+
+    finally:
+        clear_vehicles(vehicle_ids + [late_id])
@@ -0,0 +1,100 @@
+import datetime
+
+import numpy as np
+import pytest
+import sqlalchemy as sa
+
+from tests.conftest import clear_vehicles
+
+from models.base import SmartSession
+from models.rollups import DetectionRollup, ReportRollup
+
+from api.ingest import ingest_data, ingest_payloads
+from api.rollups import backfill_rollups
+from api.aggregate import aggregate_detections, aggregate_reports
+
+
+def compare_results(result1, result2):
+    assert list(result1.keys()) == list(result2.keys())
+    for key in result1:
+        assert np.array_equal(result1[key], result2[key])
+
+
+def test_rollups():
+    vehicle_ids = ["rollup_vehicle_0", "rollup_vehicle_1"]
+    clear_vehicles(vehicle_ids)
+
+    try:
+        # two detections every 7 minutes for 5 hours, and a report every 13 minutes
+        events = [
+            dict(
+                vehicle_id=vehicle_ids[i % 2],
+                detection_time=(datetime.datetime(2022, 5, 1, 8) + datetime.timedelta(minutes=7 * i)).isoformat(),
+                detections=[dict(object_type="cars", object_value=i), dict(object_type="signs", object_value=-i)],
+            )
+            for i in range(43)
+        ]
+        reports = [
+            dict(
+                vehicle_id=vehicle_ids[0],
+                report_time=(datetime.datetime(2022, 5, 1, 8) + datetime.timedelta(minutes=13 * i)).isoformat(),
+                status=["driving", "parking", "accident"][i % 3],
+            )
+            for i in range(23)
+        ]
+        status = ingest_data(dict(objects_detection_events=events[:30], vehicle_status=reports[:10]))
+        assert status["status"] == "success"
+
+        # overlapping payloads: only the new rows are added to the rollups (the duplicates are not counted again)
+        statuses = ingest_payloads(
+            [dict(objects_detection_events=events[20:]), dict(vehicle_status=reports), dict(vehicle_status=reports)]
+        )
+        assert all(s["status"] == "success" for s in statuses)
+        assert statuses[0]["detections skipped"] == 20
+
+        with SmartSession() as session:
+            stmt = sa.select(sa.func.sum(DetectionRollup.count)).where(DetectionRollup.vehicle_id.in_(vehicle_ids))
+            assert session.scalar(stmt.where(DetectionRollup.resolution == "hour")) == 86
+            assert session.scalar(stmt.where(DetectionRollup.resolution == "minute")) == 86
+            stmt = sa.select(sa.func.sum(ReportRollup.count)).where(ReportRollup.vehicle_id.in_(vehicle_ids))
+            assert session.scalar(stmt) == 23 * 2
+
+        # the same results from the rollups and from the raw rows
+        start, end = datetime.datetime(2022, 5, 1), datetime.datetime(2022, 5, 1, 23, 59)  # only this test has data
+        for bucket in ["hour", "day", "15 minutes", datetime.timedelta(hours=2), None]:
+            kwargs = dict(bucket=bucket, start_time=start, end_time=end, aggregates=["count", "sum", "avg", "min"])
+            compare_results(aggregate_detections(**kwargs), aggregate_detections(from_rollups=True, **kwargs))
+            kwargs = dict(bucket=bucket, group_by=["status", "vehicle_id"], vehicle_id=vehicle_ids[0])
+            compare_results(aggregate_reports(**kwargs), aggregate_reports(from_rollups=True, **kwargs))
+
+        kwargs = dict(
+            bucket="minute", group_by="vehicle_id", types="signs", vehicle_id=vehicle_ids[1], aggregates="max"
+        )
+        compare_results(aggregate_detections(**kwargs), aggregate_detections(from_rollups=True, **kwargs))
+
+        # whole rollup buckets are included, even if the range starts or ends inside them
+        kwargs = dict(bucket="hour", group_by=[], start_time="2022-05-01T09:30:00", end_time="2022-05-01T10:10:00")
+        assert list(aggregate_detections(**kwargs)["count"]) == [10, 2]
+        assert list(aggregate_detections(from_rollups=True, **kwargs)["count"]) == [18, 16]
+
+        # recompute the rollups from the raw rows (e.g., after they were lost)
+        with SmartSession() as session:
+            session.execute(sa.delete(DetectionRollup).where(DetectionRollup.vehicle_id.in_(vehicle_ids)))
+            session.commit()
+        assert len(aggregate_detections(bucket="hour", start_time=start, end_time=end, from_rollups=True)["count"]) == 0
+
+        backfill_rollups(start_time="2022-05-01T08:30:00", end_time="2022-05-01T12:00:00")
+        kwargs = dict(bucket="hour", start_time=start, end_time=end, aggregates=["count", "avg"])
+        compare_results(aggregate_detections(**kwargs), aggregate_detections(from_rollups=True, **kwargs))
+
+        with pytest.raises(ValueError):
+            aggregate_detections(bucket="second", from_rollups=True)
+        with pytest.raises(ValueError):
+            aggregate_detections(bucket="90 seconds", from_rollups=True)
+        with pytest.raises(ValueError):
+            aggregate_detections(aggregates="p50", from_rollups=True)
+        with pytest.raises(ValueError):
+            aggregate_detections(value_minimum=3, from_rollups=True)
+
+    finally:
+        clear_vehicles(vehicle_ids)
@@ -0,0 +1,193 @@
+import json
+import asyncio
+import threading
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+
+import sqlalchemy as sa
+
+from tests.conftest import clear_vehicles
+
+from models.base import SmartSession
+from models.reports import Report
+
+import api.server
+from api.server import IngestServer
+from api.batcher import IngestBatcher
+
+
+def post(port, body):
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    try:
+        connection.request("POST", "/ingest", body=body, headers={"Content-Type": "application/json"})
+        response = connection.getresponse()
+        return response.status, json.loads(response.read())
+    finally:
+        connection.close()
+
+
+def test_server_coalesces_requests():
+    vehicle_ids = [f"server_vehicle_{i}" for i in range(50)]
+    clear_vehicles(vehicle_ids)
+
+    loop = asyncio.new_event_loop()
+    server = IngestServer(port=0, max_delay=0.05, flushers=1)
+    loop.run_until_complete(server.start())
+    thread = threading.Thread(target=loop.run_forever)
+    thread.start()
+
+    try:
+        payloads = [
+            json.dumps(
+                dict(vehicle_status=[dict(vehicle_id=vid, report_time="2022-01-01T00:00:00Z", status="parking")])
+            )
+            for vid in vehicle_ids
+        ]
+        payloads.append(json.dumps(dict(vehicle_status=[dict(vehicle_id="foo bar", report_time="x", status="wrong!")])))
+        # this one is only rejected by the database, so the batch is written again one payload at a time
+        payloads.append(
+            json.dumps(dict(vehicle_status=[dict(vehicle_id="foo bar", report_time="x", status="parking")]))
+        )
+
+        with ThreadPoolExecutor(max_workers=len(payloads)) as executor:
+            responses = list(executor.map(lambda body: post(server.port, body), payloads))
+
+        # each request gets its own status report
+        for code, status in responses[:-2]:
+            assert code == 200
+            assert status["status"] == "success"
+            assert status["reports saved"] == 1
+
+        # a bad payload fails on its own, without affecting the others in the same batch
+        code, status = responses[-2]
+        assert code == 422
+        assert status["status"] == "failure"
+        assert any(["Invalid status value: wrong!" in err for err in status["errors"]])
+
+        code, status = responses[-1]
+        assert code == 422
+        assert status["status"] == "failure"
+        assert status["reports saved"] == 0
+
+        # the requests were saved in fewer transactions than there were requests
+        assert server.counters["requests"] == len(payloads)
+        assert server.batcher.counters["batches"] < len(payloads)
+
+        code, status = post(server.port, "this is not JSON")
+        assert code == 400
+
+        with SmartSession() as session:
+            reports = session.scalars(sa.select(Report).where(Report.vehicle_id.in_(vehicle_ids))).all()
+            assert len(reports) == len(vehicle_ids)
+
+    finally:
+        asyncio.run_coroutine_threadsafe(server.stop(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+        clear_vehicles(vehicle_ids)
+
+
+def test_server_backpressure():
+    async def request(server, body):
+        reader = asyncio.StreamReader()
+        reader.feed_data(body)
+        return await server.handle_request("POST", "/ingest", {"content-length": str(len(body))}, reader)
+
+    async def run():
+        server = IngestServer(max_queue=1)
+        server.batcher = IngestBatcher(max_queue=server.max_queue, flushers=0)
+        server.accepting = True
+
+        # the queue is full (no flusher is running), so the request is rejected right away
+        server.batcher.submit(dict(vehicle_status=[]))
+        code, body, keep_alive = await request(server, b'{"vehicle_status": []}')
+        assert code == 429 and keep_alive
+
+        # while shutting down, requests are rejected as well
+        server.accepting = False
+        code, body, keep_alive = await request(server, b'{"vehicle_status": []}')
+        assert code == 503
+
+        assert server.counters["rejected"] == 2
+
+    asyncio.run(run())
+
+
+def test_server_bad_requests():
+    async def send(server, data):
+        reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+        try:
+            writer.write(data)
+            await writer.drain()
+            status_line = await reader.readline()
+            response = await reader.read()  # the server closes the connection after answering
+            return int(status_line.split()[1]), json.loads(response.split(b"\r\n\r\n", 1)[1])
+        finally:
+            writer.close()
+
+    async def run():
+        server = IngestServer(port=0)
+        await server.start()
+        try:
+            # requests that cannot be read are answered with 400, and the connection is closed
+            code, body = await send(server, b"GARBAGE\r\n\r\n")
+            assert code == 400
+            assert "Malformed request line" in body["error"]
+
+            code, body = await send(server, b"POST /ingest HTTP/1.1\r\nContent-Length: many\r\n\r\n{}")
+            assert code == 400
+            assert "Invalid Content-Length" in body["error"]
+
+            # unexpected errors are answered with 500
+            async def broken(*args):
+                raise RuntimeError("something went wrong")
+
+            server.handle_request = broken
+            code, body = await send(server, b"GET /health HTTP/1.1\r\n\r\n")
+            assert code == 500
+        finally:
+            await server.stop()
+
+    asyncio.run(run())
+
+
+def test_server_unread_bodies(monkeypatch):
+    async def run():
+        server = IngestServer(port=0, max_body_size=1000)
+        await server.start()
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, check_connection, server.port)
+        finally:
+            await server.stop()
+
+    def check_connection(port):
+        connection = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+        try:
+            # the bodies of requests that are answered without reading them are skipped,
+            # so the next request on the same connection is read correctly
+            for method, path, code in [("POST", "/other", 404), ("PUT", "/ingest", 405), ("GET", "/health", 200)]:
+                connection.request(method, path, body=b"x" * 500)
+                response = connection.getresponse()
+                response.read()
+                assert response.status == code
+                assert response.getheader("Connection") == "keep-alive"
+
+            # large bodies are parsed in a thread
+            monkeypatch.setattr(api.server, "THREAD_PARSE_SIZE", 10)
+            connection.request("POST", "/ingest", body=json.dumps(dict(vehicle_status=[])))
+            response = connection.getresponse()
+            assert response.status == 200
+            assert json.loads(response.read())["status"] == "success"
+
+            # a body that is too large is never read, so the connection is closed
+            connection.request("POST", "/ingest", body=b"x" * 2000)
+            response = connection.getresponse()
+            response.read()
+            assert response.status == 413
+            assert response.getheader("Connection") == "close"
+        finally:
+            connection.close()
+
+    asyncio.run(run())
@@ -0,0 +1,119 @@
+import os
+import multiprocessing
+
+import pytest
+import sqlalchemy as sa
+from sqlalchemy_utils import database_exists, create_database, drop_database
+
+from models.base import Base, Session, SmartSession, get_engine_config, configure_engine, read_from_primary
+from models.vehicles import Vehicle
+
+from api.ingest import ingest_data, forget_vehicles
+from api.query import get_reports
+
+
+def backend_pid():
+    with SmartSession() as session:
+        return session.scalar(sa.text("SELECT pg_backend_pid()"))
+
+
+def test_engine_pool_reuses_connections():
+    assert get_engine_config()["pool_size"] > 0
+    configure_engine()  # start with an empty pool (other tests may leave several idle connections, used in turn)
+
+    # consecutive sessions use the same connection from the pool, instead of opening a new one
+    assert backend_pid() == backend_pid()
+
+    try:
+        os.environ["MOBILEYE_DB_POOL_SIZE"] = "2"
+        os.environ["MOBILEYE_DB_PRE_PING"] = "false"
+        config = get_engine_config()
+        assert config["pool_size"] == 2
+        assert config["pool_pre_ping"] is False
+
+        configure_engine(pool_size=3)
+        assert get_engine_config()["pool_size"] == 3
+        assert backend_pid() == backend_pid()
+    finally:
+        del os.environ["MOBILEYE_DB_POOL_SIZE"]
+        del os.environ["MOBILEYE_DB_PRE_PING"]
+        configure_engine()
+
+
+def test_engine_after_fork():
+    configure_engine()  # start with an empty pool, so the parent always gets the same connection
+    parent_pid = backend_pid()
+
+    # a forked child must not use the connections it inherited from the parent
+    with multiprocessing.get_context("fork").Pool(2) as pool:
+        child_pids = pool.starmap(backend_pid, [()] * 4)
+
+    assert parent_pid not in child_pids
+
+    # the parent's pooled connection still works after the children are gone
+    assert backend_pid() == parent_pid
+
+
+def test_read_replicas():
+    primary_url = get_engine_config()["url"]
+    replica_url = primary_url.rsplit("/", 1)[0] + "/mobileye_hw_replica"
+    other_url = replica_url.replace("localhost", "127.0.0.1")  # the same stand-in replica, using a different URL
+    bad_url = primary_url.rsplit("/", 1)[0].rsplit(":", 1)[0] + ":1/mobileye_hw_replica"  # nothing listens there
+    vehicle_id = "replica_vehicle"
+
+    # an empty database stands in for a replica that did not get any of the new data yet
+    if not database_exists(replica_url):
+        create_database(replica_url)
+    engine = sa.create_engine(replica_url)
+    Base.metadata.create_all(engine)
+    engine.dispose()
+
+    try:
+        configure_engine(replica_urls=f"{replica_url},{other_url}")
+        assert get_engine_config()["replica_urls"] == [replica_url, other_url]
+
+        status = ingest_data(
+            dict(vehicle_status=[dict(vehicle_id=vehicle_id, report_time="2023-01-01", status="driving")])
+        )
+        assert status["reports saved"] == 1
+
+        # reads go to the replicas in turn, writes go to the primary
+        urls = []
+        for _ in range(4):
+            with SmartSession(role="read") as session:
+                urls.append(session.bind.url.render_as_string(hide_password=False))
+        assert sorted(urls) == sorted([replica_url, other_url] * 2)
+        assert urls[0] != urls[1]
+        with SmartSession() as session:
+            assert session.bind.url.render_as_string(hide_password=False) == primary_url
+
+        # the query functions read from the replica, which does not have the new report yet
+        assert len(get_reports(vehicle_id=vehicle_id)) == 0
+        with SmartSession() as session:  # a given session is used as is
+            assert len(get_reports(vehicle_id=vehicle_id, session=session)) == 1
+
+        # read your writes
+        with read_from_primary():
+            assert len(get_reports(vehicle_id=vehicle_id)) == 1
+        assert len(get_reports(vehicle_id=vehicle_id)) == 0
+
+        # a replica that cannot be reached is skipped, and if none can be reached the primary is used
+        configure_engine(replica_urls=[bad_url, replica_url])
+        for _ in range(3):
+            with SmartSession(role="read") as session:
+                assert session.bind.url.database == "mobileye_hw_replica"
+                assert session.bind.url.port != 1
+        configure_engine(replica_urls=[bad_url])
+        assert len(get_reports(vehicle_id=vehicle_id)) == 1
+
+        with pytest.raises(ValueError):
+            Session(role="admin")
+
+    finally:
+        configure_engine()
+        with SmartSession() as session:
+            session.execute(sa.delete(Vehicle).where(Vehicle.id == vehicle_id))
+            session.commit()
+        forget_vehicles([vehicle_id])
+        if database_exists(replica_url):
+            drop_database(replica_url)
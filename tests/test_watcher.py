@@ -1,18 +1,26 @@
 import os
+import json
 import time
 import shutil
+import socket
+import threading
+import multiprocessing
 
+import pytest
 import sqlalchemy as sa
 
 from functools import partial
 from multiprocessing import Pool
 
+from tests.conftest import clear_vehicles
+
 from models.base import CODE_ROOT, SmartSession
 from models.vehicles import Vehicle
 from models.reports import Report
 from models.detections import Detection
 
-from api.folder_watch import watcher
+import api.folder_watch
+from api.folder_watch import watcher, recover_stale_claims, is_stale_claim, PROCESSING_DIR
 
 
 def test_watcher_new_files():
@@ -61,7 +69,8 @@ def test_watcher_new_files():
         for f in os.listdir(data_dir):
             if f.endswith(".json"):
                 # print(f'copying {f} to {temp_dir}')
-                shutil.copy2(os.path.join(data_dir, f), temp_dir)
+                # the file may be claimed as soon as it is closed, so do not copy its metadata afterwards
+                shutil.copyfile(os.path.join(data_dir, f), os.path.join(temp_dir, f))
 
         p.close()
         p.join()
@@ -71,10 +80,10 @@ def test_watcher_new_files():
         successes = [stat["status"] == "success" for stat in statuses]
         assert all(successes)
 
-        # should find 0 and 7 detections
+        # should find 0 and 6 detections (one detection in the file is a duplicate)
         dets = [stat["detections saved"] for stat in statuses]
         assert 0 in dets
-        assert 7 in dets
+        assert 6 in dets
 
         # should find 0 and 3 reports
         reps = [stat["reports saved"] for stat in statuses]
@@ -88,7 +97,7 @@ def test_watcher_new_files():
 
             # check the detections
             detections = session.scalars(sa.select(Detection).where(Detection.vehicle_id.in_(vehicle_ids))).all()
-            assert len(detections) == 7
+            assert len(detections) == 6
             assert {"pedestrians", "cars", "signs", "trucks", "obstacles"} == {det.type for det in detections}
 
             reports = session.scalars(sa.select(Report).where(Report.vehicle_id.in_(vehicle_ids))).all()
@@ -101,3 +110,184 @@ def test_watcher_new_files():
 
         if os.path.isdir(temp_dir):
             shutil.rmtree(temp_dir)
+
+
+def test_watcher_parallel_workers():
+    temp_dir = os.path.join(CODE_ROOT, "temp_parallel")
+    try:
+        if not os.path.isdir(temp_dir):
+            os.makedirs(temp_dir)
+
+        vehicle_ids = [f"parallel_vehicle_{i}" for i in range(12)]
+        clear_vehicles(vehicle_ids)
+
+        # one file per vehicle, each with a different number of reports
+        for i, vid in enumerate(vehicle_ids):
+            reports = [
+                dict(vehicle_id=vid, report_time=f"2022-01-01T00:00:{j:02d}Z", status="driving") for j in range(i + 1)
+            ]
+            with open(os.path.join(temp_dir, f"file_{i:02d}.json"), "w") as f:
+                json.dump(dict(vehicle_status=reports), f)
+
+        statuses = watcher(temp_dir, timeout=1, interval=0.1, workers=3)
+
+        assert len(statuses) == len(vehicle_ids)
+        assert all([stat["status"] == "success" for stat in statuses])
+        # the statuses are in the same order as the (sorted) file names
+        assert [stat["reports saved"] for stat in statuses] == [i + 1 for i in range(len(vehicle_ids))]
+        assert len(os.listdir(temp_dir)) == 0
+
+        with SmartSession() as session:
+            reports = session.scalars(sa.select(Report).where(Report.vehicle_id.in_(vehicle_ids))).all()
+            assert len(reports) == sum(range(1, len(vehicle_ids) + 1))
+
+        with pytest.raises(ValueError):
+            with SmartSession() as session:
+                watcher(temp_dir, timeout=0.1, session=session, workers=2)
+
+    finally:  # cleanup
+        if os.path.isdir(temp_dir):
+            shutil.rmtree(temp_dir)
+
+        clear_vehicles(vehicle_ids)  # other tests count all the reports in the DB
+
+
+@pytest.mark.parametrize("backend", ["poll", "inotify"])
+def test_watcher_backends(backend):
+    temp_dir = os.path.join(CODE_ROOT, f"temp_{backend}")
+    try:
+        if not os.path.isdir(temp_dir):
+            os.makedirs(temp_dir)
+
+        # an idle watcher (including the delay) should not use any noticeable CPU time
+        cpu_start = time.process_time()
+        statuses = watcher(temp_dir, timeout=1, interval=0.1, delay=0.5, backend=backend)
+        assert len(statuses) == 0
+        assert time.process_time() - cpu_start < 0.2
+
+        # with inotify, a long polling interval does not matter
+        interval = 0.1 if backend == "poll" else 10
+        statuses = []
+        kwargs = dict(timeout=3, interval=interval, statuses=statuses, backend=backend)
+        thread = threading.Thread(target=watcher, args=(temp_dir,), kwargs=kwargs)
+        thread.start()
+        time.sleep(0.5)
+
+        data_dir = os.path.join(CODE_ROOT, "data")
+        shutil.copyfile(os.path.join(data_dir, "statuses.json"), os.path.join(temp_dir, "statuses.json"))
+        copy_time = time.time()
+        while len(statuses) == 0 and time.time() - copy_time < 2:
+            time.sleep(0.01)
+        latency = time.time() - copy_time
+
+        thread.join()
+        assert len(statuses) == 1
+        assert statuses[0]["status"] == "success"
+        assert latency < 1
+        assert len(os.listdir(temp_dir)) == 0
+
+    finally:  # cleanup
+        if os.path.isdir(temp_dir):
+            shutil.rmtree(temp_dir)
+
+
+def test_watchers_share_directory():
+    temp_dir = os.path.join(CODE_ROOT, "temp_shared")
+    vehicle_ids = [f"shared_vehicle_{i}" for i in range(30)]
+    try:
+        if not os.path.isdir(temp_dir):
+            os.makedirs(temp_dir)
+
+        for i, vid in enumerate(vehicle_ids):
+            reports = [dict(vehicle_id=vid, report_time="2022-01-01T00:00:00Z", status="parking")]
+            with open(os.path.join(temp_dir, f"file_{i:02d}.json"), "w") as f:
+                json.dump(dict(vehicle_status=reports), f)
+
+        # files claimed by a watcher that died should be recovered by the others
+        dead = multiprocessing.Process(target=time.sleep, args=(0,))
+        dead.start()
+        dead.join()
+        stale_dir = os.path.join(temp_dir, PROCESSING_DIR, f"{socket.gethostname()}-{dead.pid}")
+        os.makedirs(stale_dir)
+        shutil.move(os.path.join(temp_dir, "file_00.json"), stale_dir)
+
+        # three watchers on the same directory
+        p = Pool(3)
+        output = p.map_async(partial(watcher, timeout=2, interval=0.1), [temp_dir] * 3)
+        p.close()
+        p.join()
+        statuses = [stat for stats in output.get() for stat in stats]
+
+        # each file was ingested exactly once
+        assert len(statuses) == len(vehicle_ids)
+        assert all([stat["status"] == "success" for stat in statuses])
+        assert sum([stat["reports saved"] for stat in statuses]) == len(vehicle_ids)
+        assert sum([stat["reports skipped"] for stat in statuses]) == 0
+        assert len(os.listdir(temp_dir)) == 0
+
+    finally:  # cleanup
+        if os.path.isdir(temp_dir):
+            shutil.rmtree(temp_dir)
+
+        clear_vehicles(vehicle_ids)
+
+
+def test_watcher_slow_ingest_keeps_claim(monkeypatch):
+    temp_dir = os.path.join(CODE_ROOT, "temp_slow_ingest")
+    stale_timeout = 0.2
+    try:
+        os.makedirs(temp_dir, exist_ok=True)
+        for i in range(2):
+            with open(os.path.join(temp_dir, f"file_{i}.json"), "w") as f:
+                json.dump(dict(vehicle_status=[]), f)
+
+        # pretend to run on another host, so the claim is considered stale based only on its heartbeat
+        monkeypatch.setattr(api.folder_watch, "get_worker_id", lambda: "otherhost-1")
+        stale_checks = []
+
+        def slow_ingest(filename, session=None):
+            # the ingestion takes much longer than stale_timeout, but the claim stays alive
+            for _ in range(10):
+                time.sleep(stale_timeout / 2)
+                stale_checks.append(is_stale_claim(os.path.dirname(filename), stale_timeout))
+            if filename.endswith("file_1.json"):
+                os.remove(filename)  # as if another watcher recovered the file anyway
+            return dict(status="success")
+
+        monkeypatch.setattr(api.folder_watch, "ingest_file", slow_ingest)
+        statuses = watcher(temp_dir, timeout=1, interval=0.05, backend="poll", stale_timeout=stale_timeout)
+
+        # the watcher did not crash on the file that disappeared, and finished both files
+        assert len(statuses) == 2
+        assert len(stale_checks) == 20
+        assert not any(stale_checks)
+        assert len(os.listdir(temp_dir)) == 0
+
+    finally:  # cleanup
+        if os.path.isdir(temp_dir):
+            shutil.rmtree(temp_dir)
+
+
+def test_recover_stale_claims_does_not_overwrite():
+    temp_dir = os.path.join(CODE_ROOT, "temp_recover")
+    try:
+        stale_dir = os.path.join(temp_dir, PROCESSING_DIR, "otherhost-1")
+        os.makedirs(stale_dir)
+        for directory, content in [(stale_dir, "old"), (temp_dir, "new")]:
+            with open(os.path.join(directory, "file.json"), "w") as f:
+                f.write(content)
+        os.utime(stale_dir, (0, 0))  # no heartbeat for a long time
+
+        # a new file with the same name was dropped while the old one was claimed: both are kept
+        recovered = recover_stale_claims(temp_dir, stale_timeout=1)
+        assert recovered == [os.path.join(temp_dir, "file.recovered-1.json")]
+        contents = {}
+        for name in ["file.json", "file.recovered-1.json"]:
+            with open(os.path.join(temp_dir, name)) as f:
+                contents[name] = f.read()
+        assert contents == {"file.json": "new", "file.recovered-1.json": "old"}
+        assert not os.path.exists(stale_dir)
+
+    finally:  # cleanup
+        if os.path.isdir(temp_dir):
+            shutil.rmtree(temp_dir)